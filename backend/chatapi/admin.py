@@ -1,10 +1,10 @@
 from __future__ import annotations
 
 from django.contrib import admin
-from django.db.models import Count
 from django.utils.html import format_html
 from django.urls import reverse
 from .models import Conversation, Message
+from .services import conversation_stats
 
 # ---- Admin site branding (helps orientation / a11y) ----
 admin.site.site_header = "Chatbot Admin"
@@ -31,7 +31,7 @@ class MessageInline(admin.TabularInline):
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
     # clean, scannable list
-    list_display = ("title_or_id", "character", "owner_link", "message_count", "created_at", "updated_at")
+    list_display = ("title_or_id", "character", "owner_link", "message_count", "last_message_at", "created_at", "updated_at")
     list_filter = ("character", "created_at")
     search_fields = ("title", "owner__username", "owner__email", "id")
     ordering = ("-created_at",)
@@ -41,23 +41,18 @@ class ConversationAdmin(admin.ModelAdmin):
     raw_id_fields = ("owner",)  # avoids huge dropdowns; works with any user model
 
     # detail form
-    readonly_fields = ("created_at", "updated_at")
+    # counters are denormalized (no COUNT over messages per changelist row)
+    readonly_fields = ("created_at", "updated_at", "message_count", "last_message_at", "last_message_preview",
+                       "user_tokens", "assistant_tokens")
     fieldsets = (
         ("Conversation", {"fields": ("title", "character", "owner")}),
+        ("Activity", {"fields": ("message_count", "last_message_at", "last_message_preview",
+                                 "user_tokens", "assistant_tokens")}),
         ("Timestamps", {"fields": ("created_at", "updated_at")}),
     )
 
     inlines = [MessageInline]
 
-    def get_queryset(self, request):
-        # annotate message counts for sorting/column
-        qs = super().get_queryset(request)
-        return qs.annotate(_message_count=Count("messages"))
-
-    @admin.display(description="Messages", ordering="_message_count")
-    def message_count(self, obj: Conversation) -> int:
-        return getattr(obj, "_message_count", 0)
-
     @admin.display(description="Title")
     def title_or_id(self, obj: Conversation) -> str:
         # fall back to character + id if title is blank
@@ -93,6 +88,16 @@ class MessageAdmin(admin.ModelAdmin):
     readonly_fields = ("created_at",)
     fields = ("conversation", "role", "content", "meta", "created_at")
 
+    # deletes can't be expressed as F() decrements; recount the affected conversations
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        conversation_stats.refresh([obj.conversation_id])
+
+    def delete_queryset(self, request, queryset):
+        conversation_ids = list(queryset.values_list("conversation_id", flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        conversation_stats.refresh(conversation_ids)
+
     @admin.display(description="Content")
     def short_content(self, obj: Message) -> str:
         text = (obj.content or "").strip().replace("\n", " ")
@@ -1,6 +1,19 @@
+from importlib import import_module
+
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def _ensure_search_triggers(sender, using, **kwargs):
+    # a migration that rebuilt chatapi_message on SQLite took the search triggers with it
+    search = import_module("chatapi.migrations.0009_message_search_rows")
+    search.ensure_triggers(connections[using])
 
 
 class ChatapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatapi'
+
+    def ready(self):
+        post_migrate.connect(_ensure_search_triggers, sender=self)
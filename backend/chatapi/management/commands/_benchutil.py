@@ -0,0 +1,70 @@
+"""Shared helpers for the bench_* management commands (not a command itself)."""
+from __future__ import annotations
+import os, statistics, subprocess, tempfile, time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import connection
+
+
+@contextmanager
+def throwaway_database(verbosity: int = 0, on_disk: bool = False):
+    """
+    Run the block against a freshly migrated test database so benchmarks never touch real data.
+    on_disk: SQLite only -- use a temp file instead of the shared in-memory DB, so many threads can write.
+    """
+    old_name = connection.settings_dict["NAME"]
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    old_test_name = test_settings.get("NAME")
+    tmpdir = None
+    if on_disk and connection.vendor == "sqlite":
+        tmpdir = tempfile.TemporaryDirectory()
+        test_settings["NAME"] = os.path.join(tmpdir.name, "bench.sqlite3")
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        test_settings["NAME"] = old_test_name
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+
+def git_commit() -> Optional[str]:
+    """HEAD of the checkout being measured, so result files can be diffed between commits."""
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def summarize(samples: Sequence[float], unit: str = "ms", ndigits: int = 3) -> Dict[str, float]:
+    """mean/p50/p95/max of `samples`, keys suffixed with `unit`."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {
+        f"mean_{unit}": round(statistics.fmean(ordered), ndigits),
+        f"p50_{unit}": round(ordered[len(ordered) // 2], ndigits),
+        f"p95_{unit}": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], ndigits),
+        f"max_{unit}": round(ordered[-1], ndigits),
+    }
+
+
+def time_calls(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Wall-clock stats in milliseconds over `repeat` calls (after one warm-up call)."""
+    fn()
+    samples: List[float] = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
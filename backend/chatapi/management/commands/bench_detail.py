@@ -0,0 +1,69 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework import generics, serializers
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chatapi.models import Conversation, Message
+from chatapi.serializers import MessageSerializer
+from chatapi.views import ConversationDetailView
+from ._benchutil import throwaway_database, time_calls
+
+
+class _NestedDetailSerializer(serializers.ModelSerializer):
+    # what ConversationDetailView used to return: every message through MessageSerializer
+    messages = MessageSerializer(many=True, read_only=True)
+    class Meta:
+        model = Conversation
+        fields = ("id","character","title","created_at","updated_at","messages")
+
+
+class _NestedDetailView(generics.RetrieveAPIView):
+    serializer_class = _NestedDetailSerializer
+    def get_queryset(self):
+        return Conversation.objects.filter(owner=self.request.user)
+
+
+class Command(BaseCommand):
+    help = "Time GET /api/conversations/<id> for a long conversation: old nested serializer vs metadata + tail."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=5000)
+        parser.add_argument("--tail", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--json", action="store_true", help="print machine-readable results")
+
+    def handle(self, *args, **opts):
+        with throwaway_database():
+            user = get_user_model().objects.create_user(username="bench", password="x")
+            conv = Conversation.objects.create(owner=user, character="Bronn", title="bench")
+            Message.objects.bulk_create(
+                Message(conversation=conv, role="user" if i % 2 else "assistant", content="Gold first. " * 20)
+                for i in range(opts["messages"]))
+            factory = APIRequestFactory()
+
+            def call(view, query=""):
+                def run():
+                    req = factory.get(f"/api/conversations/{conv.pk}{query}")
+                    force_authenticate(req, user=user)
+                    resp = view(req, pk=conv.pk)
+                    resp.render()
+                    return resp
+                return run
+
+            old = call(_NestedDetailView.as_view())
+            new_meta = call(ConversationDetailView.as_view())
+            new_tail = call(ConversationDetailView.as_view(), f"?tail={opts['tail']}")
+            report = {
+                "messages": opts["messages"],
+                "nested_all_messages": dict(time_calls(old, opts["repeat"]), bytes=len(old().content)),
+                "metadata_only": dict(time_calls(new_meta, opts["repeat"]), bytes=len(new_meta().content)),
+                f"tail_{opts['tail']}": dict(time_calls(new_tail, opts["repeat"]), bytes=len(new_tail().content)),
+            }
+        if opts["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for name, r in report.items():
+            if name != "messages":
+                self.stdout.write(f"{name}: p50 {r['p50_ms']} ms / p95 {r['p95_ms']} ms, {r['bytes']} bytes")
@@ -0,0 +1,85 @@
+import json, random, time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from chatapi.models import Conversation, Message
+from chatapi.services.search_backend import get_search_backend
+from chatapi.services.token_budget import with_token_count
+from ._benchutil import throwaway_database, time_calls
+
+THEMED = (
+    "gold sellsword blackwater wildfire knight lannister stark dragon crown wall winter "
+    "trial combat tyrion bronn castle oath honor coin blade arrow fleet river lord lady "
+    "king queen north south tavern wine debt price risk reward cut steel bastard raven"
+).split()
+VOCAB_SIZE = 20000  # Zipf-distributed vocabulary: a few very common words, a long tail of rare ones
+
+
+class Command(BaseCommand):
+    help = "Seed a throwaway DB with N messages and compare /api/search full-text vs the old icontains scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--per-conversation", type=int, default=200)
+        parser.add_argument("--repeat", type=int, default=20)
+        # common, mid-frequency and rare terms (tail words are named w<rank>)
+        parser.add_argument("--queries", nargs="+", default=["gold", "trial combat", "w1500", "w19000"])
+        parser.add_argument("--json", action="store_true", help="print machine-readable results")
+
+    def handle(self, *args, **opts):
+        with throwaway_database():
+            users = self._seed(opts["messages"], opts["users"], opts["per_conversation"])
+            user = users[0]
+            backend = get_search_backend()
+            results = []
+            for q in opts["queries"]:
+                def old_path(q=q):
+                    # previous SearchView implementation
+                    return list(Message.objects
+                                .filter(conversation__owner=user, content__icontains=q)
+                                .order_by("-created_at")[:20]
+                                .values("id", "conversation_id", "role", "content", "created_at"))
+
+                def new_path(q=q):
+                    return backend.search_messages(user, q, limit=20)
+
+                results.append({
+                    "query": q,
+                    "icontains": time_calls(old_path, opts["repeat"]),
+                    backend.name: time_calls(new_path, opts["repeat"]),
+                })
+        report = {"messages": opts["messages"], "users": opts["users"], "backend": backend.name, "results": results}
+        if opts["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for r in results:
+            old, new = r["icontains"], r[backend.name]
+            self.stdout.write(f"{r['query']!r}: icontains p50 {old['p50_ms']} ms / p95 {old['p95_ms']} ms  ->  "
+                              f"{backend.name} p50 {new['p50_ms']} ms / p95 {new['p95_ms']} ms")
+
+    def _seed(self, n_messages, n_users, per_conv):
+        rng = random.Random(7)
+        vocab = THEMED + [f"w{i}" for i in range(len(THEMED), VOCAB_SIZE)]
+        cum, total = [], 0.0
+        for rank in range(len(vocab)):
+            total += 1.0 / (rank + 1)
+            cum.append(total)
+        User = get_user_model()
+        users = [User.objects.create_user(username=f"bench{i}", password="x") for i in range(n_users)]
+        t0 = time.perf_counter()
+        convs = Conversation.objects.bulk_create(
+            Conversation(owner=users[i % n_users], character="Bronn") for i in range(max(1, n_messages // per_conv)))
+        batch = []
+        for i in range(n_messages):
+            text = " ".join(rng.choices(vocab, cum_weights=cum, k=rng.randint(8, 40)))
+            batch.append(Message(conversation=convs[i % len(convs)], role="user" if i % 2 else "assistant",
+                                 content=text, meta=with_token_count(text)))  # finished, so indexed
+            if len(batch) >= 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Message.objects.bulk_create(batch)
+        self.stderr.write(f"seeded {n_messages} messages in {time.perf_counter() - t0:.1f}s")
+        return users
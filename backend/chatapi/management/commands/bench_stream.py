@@ -0,0 +1,231 @@
+import asyncio, json, threading, time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chatapi.models import Conversation, Message
+from chatapi.services import bot_service
+from chatapi.services.llm_providers import FakeProvider, set_llm_provider
+from chatapi.services.token_budget import with_token_count
+from chatapi.stream_views import chat_stream_async_view, chat_stream_view
+from ._benchutil import git_commit, summarize, throwaway_database
+
+# per-reply query counters; set around each request, read by the execute wrapper on every connection
+_reply: ContextVar[Optional[Dict[str, float]]] = ContextVar("bench_reply", default=None)
+_WRITES = ("INSERT", "UPDATE", "DELETE")
+
+
+def _count_queries(execute, sql, params, many, context):
+    stats = _reply.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats["db_ms"] += (time.perf_counter() - t0) * 1000
+        stats["queries"] += 1
+        if sql.lstrip()[:6].upper() in _WRITES:
+            stats["writes"] += 1
+
+
+class _CountingProvider:
+    """Counts upstream deltas per reply, since coalesced frames no longer map 1:1 to tokens."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def stream(self, **params):
+        for delta in self.provider.stream(**params):
+            _reply.get()["tokens"] += 1
+            yield delta
+
+    async def astream(self, **params):
+        async for delta in self.provider.astream(**params):
+            _reply.get()["tokens"] += 1
+            yield delta
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+
+def _instrument(sender, connection, **kwargs):
+    # fires again when request_finished closes and a later query reopens the same wrapper
+    if _count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_queries)
+
+
+class Command(BaseCommand):
+    help = ("End-to-end load test of the chat streaming view against the deterministic fake LLM: "
+            "time-to-first-token, tokens/sec, DB queries/writes and SSE frames/bytes per reply under N concurrent clients. "
+            "Calls the view directly (no middleware/URL routing) on a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+        parser.add_argument("--replies", type=int, default=3, help="replies streamed per client")
+        parser.add_argument("--history", type=int, default=20, help="prior messages in each conversation")
+        parser.add_argument("--tokens", default="200", help='fake reply length spec, e.g. "200" or "uniform:50,400"')
+        parser.add_argument("--tokens-per-sec", type=float, default=100.0, help="fake provider pacing (0 = unthrottled)")
+        parser.add_argument("--ttft-ms", default="100", help='fake first-token latency spec, e.g. "lognormal:300,0.5"')
+        parser.add_argument("--coalesce-ms", type=float, help="SSE coalescing window (default CHAT_STREAM_COALESCE_MS; 0 = a frame per delta)")
+        parser.add_argument("--compact", action="store_true", help='request stream_format "compact" token frames')
+        parser.add_argument("--async", dest="use_async", action="store_true", help="drive the async (ASGI) view")
+        parser.add_argument("--json", action="store_true", help="print machine-readable results")
+
+    def handle(self, *args, **opts):
+        provider = FakeProvider(tokens=opts["tokens"], tokens_per_sec=opts["tokens_per_sec"], ttft_ms=opts["ttft_ms"])
+        connection_created.connect(_instrument)
+        set_llm_provider(_CountingProvider(provider))
+        coalesce = {} if opts["coalesce_ms"] is None else {"CHAT_STREAM_COALESCE_MS": opts["coalesce_ms"]}
+        self.compact = opts["compact"]
+        try:
+            with throwaway_database(on_disk=True), \
+                    override_settings(CHAT_SUMMARY_ENABLED=False, CHAT_CACHE_ENABLED=False, CHAT_ADMISSION_ENABLED=False,
+                                      **coalesce):
+                _instrument(None, connection)
+                sessions = self._setup(opts["clients"], opts["history"])
+                started = time.perf_counter()
+                if opts["use_async"]:
+                    samples = asyncio.run(self._run_async(sessions, opts["replies"]))
+                else:
+                    samples = self._run_threads(sessions, opts["replies"])
+                wall = time.perf_counter() - started
+                connection.execute_wrappers.remove(_count_queries)
+        finally:
+            set_llm_provider(None)
+            connection_created.disconnect(_instrument)
+
+        tokens = sum(s["tokens"] for s in samples)
+        report = {
+            "bench": "stream",
+            "commit": git_commit(),
+            "config": {k: opts[k] for k in ("clients", "replies", "history", "tokens", "tokens_per_sec", "ttft_ms")}
+                      | {"view": "async" if opts["use_async"] else "sync",
+                         "coalesce_ms": settings.CHAT_STREAM_COALESCE_MS if opts["coalesce_ms"] is None else opts["coalesce_ms"],
+                         "format": "compact" if opts["compact"] else "standard",
+                         "persona_prompts": bot_service.build_system_prompt is not None},
+            "replies": len(samples),
+            "errors": sum(1 for s in samples if s["tokens"] == 0),
+            "wall_s": round(wall, 3),
+            "throughput_tokens_per_s": round(tokens / wall, 1) if wall else 0.0,
+            "ttft": summarize([s["ttft_ms"] for s in samples if s["ttft_ms"] is not None]),
+            "duration": summarize([s["duration_ms"] for s in samples]),
+            "stream_tokens_per_s": summarize([s["tokens_per_s"] for s in samples if s["tokens_per_s"]], unit="tps", ndigits=1),
+            "queries_per_reply": summarize([s["queries"] for s in samples], unit="n", ndigits=1),
+            "writes_per_reply": summarize([s["writes"] for s in samples], unit="n", ndigits=1),
+            "db_time": summarize([s["db_ms"] for s in samples]),
+            "frames_per_reply": summarize([s["frames"] for s in samples], unit="n", ndigits=1),
+            "bytes_per_reply": summarize([s["bytes"] for s in samples], unit="n", ndigits=0),
+        }
+        if opts["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        self.stdout.write(f"{report['replies']} replies ({report['config']['view']} view, {opts['clients']} clients) "
+                          f"in {report['wall_s']} s, {report['throughput_tokens_per_s']} tokens/s total, {report['errors']} errors")
+        for name in ("ttft", "duration", "stream_tokens_per_s", "queries_per_reply", "writes_per_reply", "db_time",
+                     "frames_per_reply", "bytes_per_reply"):
+            self.stdout.write(f"  {name:<20} " + "  ".join(f"{k}={v}" for k, v in report[name].items()))
+        if not report["config"]["persona_prompts"]:
+            self.stdout.write("  (chatbot package not importable: prompts used the strict-IC fallback; "
+                              "run with PYTHONPATH=.. to include KB retrieval)")
+
+    # ---------- setup ----------
+
+    def _setup(self, clients: int, history: int) -> List[Dict[str, str]]:
+        User = get_user_model()
+        sessions = []
+        for i in range(clients):
+            user = User.objects.create_user(username=f"bench{i}", password="x")
+            conv = Conversation.objects.create(owner=user, character="Bronn", title="bench")
+            Message.objects.bulk_create([
+                Message(conversation=conv, role=("user", "assistant")[j % 2], content=f"turn {j} about gold and steel",
+                        meta=with_token_count(f"turn {j} about gold and steel"))
+                for j in range(history)
+            ])
+            sessions.append({"token": str(RefreshToken.for_user(user).access_token), "conversation_id": str(conv.id)})
+        return sessions
+
+    @staticmethod
+    def _request_kwargs(session: Dict[str, str], n: int, compact: bool = False) -> Dict[str, object]:
+        body = {"conversation_id": session["conversation_id"], "prompt": f"Tell me about the Blackwater, round {n}"}
+        if compact:
+            body["stream_format"] = "compact"
+        return {"path": "/api/chat/stream", "data": json.dumps(body), "content_type": "application/json",
+                "headers": {"Authorization": "Bearer " + session["token"]}}
+
+    @staticmethod
+    def _new_stats() -> Dict[str, float]:
+        return {"queries": 0, "writes": 0, "db_ms": 0.0, "tokens": 0, "frames": 0, "bytes": 0}
+
+    @staticmethod
+    def _read(stats: Dict[str, float], chunk: bytes) -> bool:
+        """Account one response chunk; True if it carries token text (anything but start/end)."""
+        stats["bytes"] += len(chunk)
+        stats["frames"] += chunk.count(b"\n\n")
+        return not chunk.startswith((b"event: start", b"event: end"))
+
+    @staticmethod
+    def _sample(stats: Dict[str, float], t0: float, first: Optional[float], end: float) -> Dict[str, float]:
+        gen = end - first if first is not None else 0.0
+        tokens = stats["tokens"]
+        return {"ttft_ms": (first - t0) * 1000 if first is not None else None, "duration_ms": (end - t0) * 1000,
+                "tokens_per_s": tokens / gen if gen > 0 else 0.0, **stats}
+
+    # ---------- drivers ----------
+
+    def _run_threads(self, sessions: List[Dict[str, str]], replies: int) -> List[Dict[str, float]]:
+        samples: List[Dict[str, float]] = []
+        lock = threading.Lock()
+
+        def client(session):
+            factory = RequestFactory()
+            try:
+                for n in range(replies):
+                    stats = self._new_stats()
+                    token = _reply.set(stats)
+                    t0, first = time.perf_counter(), None
+                    resp = chat_stream_view(factory.post(**self._request_kwargs(session, n, self.compact)))
+                    for chunk in resp.streaming_content:
+                        if self._read(stats, chunk) and first is None:
+                            first = time.perf_counter()
+                    resp.close()
+                    sample = self._sample(stats, t0, first, time.perf_counter())
+                    _reply.reset(token)
+                    with lock:
+                        samples.append(sample)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client, args=(s,)) for s in sessions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return samples
+
+    async def _run_async(self, sessions: List[Dict[str, str]], replies: int) -> List[Dict[str, float]]:
+        factory = AsyncRequestFactory()
+
+        async def client(session):
+            out = []
+            for n in range(replies):
+                stats = self._new_stats()
+                token = _reply.set(stats)
+                t0, first = time.perf_counter(), None
+                resp = await chat_stream_async_view(factory.post(**self._request_kwargs(session, n, self.compact)))
+                async for chunk in resp.streaming_content:
+                    if self._read(stats, chunk) and first is None:
+                        first = time.perf_counter()
+                out.append(self._sample(stats, t0, first, time.perf_counter()))
+                _reply.reset(token)
+            return out
+
+        results = await asyncio.gather(*(client(s) for s in sessions))
+        return [s for r in results for s in r]
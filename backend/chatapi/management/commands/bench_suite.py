@@ -0,0 +1,79 @@
+import io, json, sys
+from typing import Any, Dict
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from ._benchutil import git_commit
+
+
+def _flatten(obj: Any, prefix: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            out.update(_flatten(v, f"{prefix}.{k}" if prefix else str(k)))
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            # kb_scaling rows are keyed by persona/size so reordering doesn't break comparisons
+            label = "/".join(str(v[k]) for k in ("persona", "kb_entries") if k in v) if isinstance(v, dict) else ""
+            out.update(_flatten(v, f"{prefix}[{label or i}]"))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        out[prefix] = obj
+    return out
+
+
+class Command(BaseCommand):
+    help = ("Run the benchmark suite (KB scaling, streaming load sync+async, conversation detail) and write one "
+            "JSON file; --baseline prints the metrics that moved compared to an earlier run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default="bench-results.json")
+        parser.add_argument("--baseline", help="earlier bench_suite JSON to compare against")
+        parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported with --baseline")
+        parser.add_argument("--quick", action="store_true", help="smaller sizes for a fast smoke run")
+
+    def handle(self, *args, **opts):
+        quick = opts["quick"]
+        # chatbot/ lives next to backend/
+        root = str(settings.BASE_DIR.parent)
+        if root not in sys.path:
+            sys.path.insert(0, root)
+        from chatbot import bench as prompt_bench
+
+        sizes = [100, 1000] if quick else prompt_bench.DEFAULT_SIZES
+        results: Dict[str, Any] = {"commit": git_commit(), "quick": quick}
+        self.stderr.write(f"kb scaling {sizes} ...")
+        results["kb_scaling"] = [r for p in prompt_bench.PERSONAS
+                                 for r in prompt_bench.bench_kb_scaling(p, sizes, 100 if quick else 500)]
+        stream_opts = {"clients": 4, "replies": 2} if quick else {"clients": 16, "replies": 5}
+        for view in ("sync", "async"):
+            self.stderr.write(f"stream ({view}) ...")
+            results[f"stream_{view}"] = self._run("bench_stream", use_async=(view == "async"), **stream_opts)
+        self.stderr.write("detail ...")
+        results["detail"] = self._run("bench_detail", messages=500 if quick else 5000)
+
+        with open(opts["out"], "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write(f"wrote {opts['out']} (commit {results['commit']})")
+        if opts["baseline"]:
+            self._compare(opts["baseline"], results, opts["threshold"])
+
+    def _run(self, command: str, **kw) -> Dict[str, Any]:
+        buf = io.StringIO()
+        call_command(command, json=True, stdout=buf, **kw)
+        return json.loads(buf.getvalue().strip().splitlines()[-1])
+
+    def _compare(self, path: str, results: Dict[str, Any], threshold: float) -> None:
+        with open(path, encoding="utf-8") as f:
+            base = json.load(f)
+        old, new = _flatten(base), _flatten(results)
+        self.stdout.write(f"vs {path} (commit {base.get('commit')}), changes over {threshold:.0%}:")
+        moved = 0
+        for key in sorted(old.keys() & new.keys()):
+            a, b = old[key], new[key]
+            if a and abs(b - a) / abs(a) >= threshold:
+                moved += 1
+                self.stdout.write(f"  {key}: {a} -> {b} ({(b - a) / abs(a):+.0%})")
+        if not moved:
+            self.stdout.write("  none")
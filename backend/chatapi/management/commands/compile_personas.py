@@ -0,0 +1,43 @@
+import glob, os, sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Validate every chatbot/*_kb.jsonl and *_style.yml and compile each KB (entries + retrieval index) into "
+            "a memory-mapped <name>_kb.pkb (in PERSONA_CACHE_DIR) the bot loads instead of parsing the JSONL. "
+            "Exits non-zero on any validation error; KBs with rejected rows are not compiled.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("personas", nargs="*", help="persona names, e.g. bronn tyrion (default: all KBs found)")
+        parser.add_argument("--dir", help="persona asset directory (default: chatbot/ next to backend/)")
+        parser.add_argument("--check", action="store_true", help="validate only, write nothing")
+
+    def handle(self, *args, **opts):
+        root = str(settings.BASE_DIR.parent)
+        if root not in sys.path:
+            sys.path.insert(0, root)
+        from chatbot import bot
+
+        base = opts["dir"] or os.path.join(root, "chatbot")
+        kbs = sorted(glob.glob(os.path.join(base, "*_kb.jsonl")))
+        if opts["personas"]:
+            wanted = {p.lower() for p in opts["personas"]}
+            kbs = [p for p in kbs if os.path.basename(p)[:-len("_kb.jsonl")] in wanted]
+        if not kbs:
+            raise CommandError(f"no *_kb.jsonl files to compile in {base}")
+
+        failed = 0
+        for kb_path in kbs:
+            persona = os.path.basename(kb_path)[:-len("_kb.jsonl")]
+            report = bot.compile_persona(kb_path, os.path.join(base, f"{persona}_style.yml"), write=not opts["check"])
+            line = f"{persona}: {report['entries']} entries, {report['tokens']} tokens, {report['postings']} postings"
+            if report["artifact"]:
+                line += f" -> {report['artifact']} ({report['bytes'] / 1024:.1f} KiB)"
+            self.stdout.write(line)
+            for err in report["errors"]:
+                self.stderr.write(f"  {err}")
+            failed += bool(report["errors"])
+        if failed:
+            raise CommandError(f"validation errors in {failed} of {len(kbs)} personas")
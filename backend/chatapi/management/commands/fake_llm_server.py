@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from chatapi.services.llm_providers import fake_provider_from_settings
+from chatapi.services.llm_stub_server import make_stub_server
+
+
+class Command(BaseCommand):
+    help = ("Serve a deterministic fake OpenAI-compatible API (POST /v1/chat/completions) for load tests. "
+            "Point the backend at it with CHAT_LLM_PROVIDER=openai-compatible CHAT_LLM_BASE_URL=http://HOST:PORT/v1.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--tokens", help='reply length, e.g. "200" or "uniform:50,400" (default CHAT_FAKE_LLM_TOKENS)')
+        parser.add_argument("--tokens-per-sec", type=float, help="pacing, 0 = unthrottled (default CHAT_FAKE_LLM_TOKENS_PER_SEC)")
+        parser.add_argument("--ttft-ms", help='first-token latency, e.g. "300" or "lognormal:300,0.5" (default CHAT_FAKE_LLM_TTFT_MS)')
+        parser.add_argument("--seed", type=int)
+
+    def handle(self, *args, **opts):
+        provider = fake_provider_from_settings(tokens=opts["tokens"], tokens_per_sec=opts["tokens_per_sec"],
+                                               ttft_ms=opts["ttft_ms"], seed=opts["seed"])
+        server = make_stub_server(provider, opts["host"], opts["port"])
+        self.stdout.write(f"fake LLM on http://{opts['host']}:{server.server_port}/v1 "
+                          f"(tokens={provider.tokens.spec}, {provider.tokens_per_sec:g} tok/s, ttft_ms={provider.ttft_ms.spec})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
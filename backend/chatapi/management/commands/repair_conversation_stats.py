@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from chatapi.models import Conversation
+from chatapi.services.conversation_stats import computed
+
+
+class Command(BaseCommand):
+    help = "Backfill/repair Conversation.message_count, last_message_* and token totals from the Message table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("conversation_ids", nargs="*", help="limit to these conversations (default: all)")
+        parser.add_argument("--dry-run", action="store_true", help="report drift without writing")
+
+    def handle(self, *args, **opts):
+        qs = Conversation.objects.all()
+        if opts["conversation_ids"]:
+            qs = qs.filter(pk__in=opts["conversation_ids"])
+        fields = ("message_count", "last_message_at", "last_message_preview", "user_tokens", "assistant_tokens")
+        checked = fixed = 0
+        for conv in qs.only("id", *fields).iterator(chunk_size=500):
+            checked += 1
+            want = computed(conv.pk)
+            if all(getattr(conv, f) == want[f] for f in fields):
+                continue
+            fixed += 1
+            if not opts["dry_run"]:
+                # .update() so updated_at (the sidebar sort key) is left alone
+                Conversation.objects.filter(pk=conv.pk).update(**want)
+        verb = "would fix" if opts["dry_run"] else "fixed"
+        self.stdout.write(f"checked {checked} conversations, {verb} {fixed}")
+
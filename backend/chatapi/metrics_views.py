@@ -0,0 +1,15 @@
+import hmac
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
+from .services import metrics
+
+def metrics_view(request):
+    # Prometheus scrape target; 404 unless CHAT_METRICS_ENABLED so it doesn't advertise itself
+    if not metrics.enabled():
+        raise Http404()
+    token = getattr(settings, "CHAT_METRICS_TOKEN", "")
+    if token:
+        given = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return JsonResponse({"detail": "Unauthorized"}, status=401)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
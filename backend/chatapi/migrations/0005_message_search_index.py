@@ -0,0 +1,64 @@
+from django.db import migrations
+
+# Full-text index for /api/search (see chatapi/services/search_backend.py).
+# SQLite: FTS5 external-content table over chatapi_message.content, kept in sync by triggers.
+# Note: SQLite table rebuilds of Message or Conversation (AddField/AlterField) break the view and
+# triggers; drop them before such operations and recreate them after (see 0006).
+# Replaced on SQLite by 0008, which reads chatapi_message directly.
+# Postgres: GIN expression index; the expression must match the search query exactly.
+
+# The FTS table reads from a view that adds the conversation owner as an indexed
+# token column ("u<owner_id>"), so a search only ranks the requesting user's hits.
+_OWNER = "(SELECT 'u' || owner_id FROM chatapi_conversation WHERE id = {row}.conversation_id)"
+SQLITE_FORWARD = [
+    "CREATE VIEW IF NOT EXISTS chatapi_message_fts_src AS "
+    "SELECT m.id AS id, m.content AS content, 'u' || c.owner_id AS owner "
+    "FROM chatapi_message m JOIN chatapi_conversation c ON c.id = m.conversation_id",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chatapi_message_fts USING fts5("
+    "content, owner, content='chatapi_message_fts_src', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ai AFTER INSERT ON chatapi_message BEGIN "
+    "INSERT INTO chatapi_message_fts(rowid, content, owner) VALUES (new.id, new.content, " + _OWNER.format(row="new") + "); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ad AFTER DELETE ON chatapi_message BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, owner) "
+    "VALUES ('delete', old.id, old.content, " + _OWNER.format(row="old") + "); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_au AFTER UPDATE OF content ON chatapi_message BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, owner) "
+    "VALUES ('delete', old.id, old.content, " + _OWNER.format(row="old") + "); "
+    "INSERT INTO chatapi_message_fts(rowid, content, owner) VALUES (new.id, new.content, " + _OWNER.format(row="new") + "); END",
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_au",
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_ai",
+    "DROP TABLE IF EXISTS chatapi_message_fts",
+    "DROP VIEW IF EXISTS chatapi_message_fts_src",
+]
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS msg_content_tsv_idx ON chatapi_message USING GIN (to_tsvector('english', content))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS msg_content_tsv_idx",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for sql in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapi', '0004_message_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            _run({"sqlite": SQLITE_BACKWARD, "postgresql": POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:01
+
+from importlib import import_module
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+# AddField rebuilds chatapi_conversation on SQLite, which fails while the FTS
+# view/triggers from 0005 reference it: drop them first, recreate them after.
+fts = import_module("chatapi.migrations.0005_message_search_index")
+
+PREVIEW_CHARS = 200
+CHARS_PER_TOKEN = 4
+
+
+def backfill(apps, schema_editor):
+    Conversation = apps.get_model("chatapi", "Conversation")
+    Message = apps.get_model("chatapi", "Message")
+    for conv in Conversation.objects.only("id").iterator(chunk_size=500):
+        msgs = Message.objects.filter(conversation_id=conv.pk)
+        agg = msgs.aggregate(n=Count("id"), last=Max("created_at"))
+        last = msgs.exclude(content="").order_by("-created_at", "-id").values_list("content", flat=True).first()
+        last = " ".join((last or "").split())
+        if len(last) > PREVIEW_CHARS:
+            last = last[:PREVIEW_CHARS - 1] + "…"
+        tokens = {"user": 0, "assistant": 0}
+        for role, meta, content in msgs.filter(role__in=tokens).values_list("role", "meta", "content").iterator():
+            n = (meta or {}).get("tokens")
+            tokens[role] += int(n) if n is not None else (len(content) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        Conversation.objects.filter(pk=conv.pk).update(
+            message_count=agg["n"], last_message_at=agg["last"], last_message_preview=last,
+            user_tokens=tokens["user"], assistant_tokens=tokens["assistant"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapi', '0005_message_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            fts._run({"sqlite": fts.SQLITE_BACKWARD}),
+            fts._run({"sqlite": fts.SQLITE_FORWARD}),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='assistant_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(
+            fts._run({"sqlite": fts.SQLITE_FORWARD}),
+            fts._run({"sqlite": fts.SQLITE_BACKWARD}),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
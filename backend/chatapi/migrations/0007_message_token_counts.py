@@ -0,0 +1,32 @@
+from django.db import migrations
+
+# The summarizer treats a message without meta["tokens"] as a reply still being
+# streamed and never folds it or anything after it. Rows written before token
+# counts were stored would block summaries forever, so give them a count now.
+CHARS_PER_TOKEN = 4
+
+
+def backfill(apps, schema_editor):
+    Message = apps.get_model("chatapi", "Message")
+    batch = []
+    for m in Message.objects.only("id", "content", "meta").order_by("id").iterator(chunk_size=1000):
+        if "tokens" in (m.meta or {}):
+            continue
+        m.meta = dict(m.meta or {}, tokens=(len(m.content) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+        batch.append(m)
+        if len(batch) >= 500:
+            Message.objects.bulk_update(batch, ["meta"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["meta"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapi', '0006_conversation_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,100 @@
+from importlib import import_module
+
+from django.db import migrations
+
+# Superseded by 0009, which gives the index a row source of its own.
+#
+# Replaces the SQLite search objects from 0005. The view they read from broke
+# any later table rebuild of chatapi_message / chatapi_conversation, and the
+# content trigger re-indexed a streaming reply on every flush.
+#
+# Now the FTS5 external-content table reads chatapi_message itself. The owner
+# token ("u<owner_id>") is supplied by the triggers' subqueries. FTS5 reads its
+# columns back by name from the content table (for snippet()), so the owner
+# column borrows the name of chatapi_message.conversation_id. Only column 0
+# (content) is ever read back, but for the same reason the index must never be
+# rebuilt with 'rebuild'; repopulate it with POPULATE instead.
+#
+# Only finished messages are indexed, i.e. those with a token count in meta:
+# user messages on insert, replies when finalize() stores their count. Flushes
+# of a streaming reply don't touch the index.
+#
+# SQLite drops a table's triggers along with the table, so a migration that
+# rebuilds chatapi_message (AddField/AlterField/... on Message) must wrap its
+# operations with rebuilding_message_table() below, or search silently stops
+# following new messages. The triggers survive rebuilds of chatapi_conversation.
+previous = import_module("chatapi.migrations.0005_message_search_index")
+
+_OWNER = "(SELECT 'u' || owner_id FROM chatapi_conversation WHERE id = {row}.conversation_id)"
+_FINAL = "json_extract({row}.meta, '$.tokens') IS NOT NULL"
+_CHANGED = "old.content IS NOT new.content"
+
+CREATE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ai AFTER INSERT ON chatapi_message "
+    "WHEN " + _FINAL.format(row="new") + " BEGIN "
+    "INSERT INTO chatapi_message_fts(rowid, content, conversation_id) "
+    "VALUES (new.id, new.content, " + _OWNER.format(row="new") + "); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ad AFTER DELETE ON chatapi_message "
+    "WHEN " + _FINAL.format(row="old") + " BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, conversation_id) "
+    "VALUES ('delete', old.id, old.content, " + _OWNER.format(row="old") + "); END",
+    # a reply becoming final is added; an edited final message is re-indexed; streaming flushes do nothing
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_au AFTER UPDATE OF content, meta ON chatapi_message "
+    "WHEN " + _FINAL.format(row="old") + " OR " + _FINAL.format(row="new") + " BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, conversation_id) "
+    "SELECT 'delete', old.id, old.content, " + _OWNER.format(row="old") + " "
+    "WHERE " + _FINAL.format(row="old") + " AND (NOT (" + _FINAL.format(row="new") + ") OR " + _CHANGED + "); "
+    "INSERT INTO chatapi_message_fts(rowid, content, conversation_id) "
+    "SELECT new.id, new.content, " + _OWNER.format(row="new") + " "
+    "WHERE " + _FINAL.format(row="new") + " AND (NOT (" + _FINAL.format(row="old") + ") OR " + _CHANGED + "); END",
+]
+DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_au",
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chatapi_message_fts_ai",
+]
+POPULATE = [
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts) VALUES ('delete-all')",
+    "INSERT INTO chatapi_message_fts(rowid, content, conversation_id) "
+    "SELECT m.id, m.content, 'u' || c.owner_id FROM chatapi_message m "
+    "JOIN chatapi_conversation c ON c.id = m.conversation_id WHERE " + _FINAL.format(row="m"),
+]
+SQLITE_FORWARD = previous.SQLITE_BACKWARD + [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chatapi_message_fts USING fts5("
+    "content, conversation_id, content='chatapi_message', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+] + CREATE_TRIGGERS + POPULATE
+SQLITE_BACKWARD = DROP_TRIGGERS + ["DROP TABLE IF EXISTS chatapi_message_fts"] + previous.SQLITE_FORWARD
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for sql in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+def rebuilding_message_table(*operations):
+    """
+    `operations` preceded by dropping the search triggers and followed by
+    recreating them (SQLite only), for migrations that rebuild chatapi_message:
+
+        search = import_module("chatapi.migrations.0008_message_search_triggers")
+        operations = search.rebuilding_message_table(migrations.AlterField(...))
+    """
+    return [
+        migrations.RunPython(_run({"sqlite": DROP_TRIGGERS}), _run({"sqlite": CREATE_TRIGGERS})),
+        *operations,
+        migrations.RunPython(_run({"sqlite": CREATE_TRIGGERS}), _run({"sqlite": DROP_TRIGGERS})),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapi', '0007_message_token_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run({"sqlite": SQLITE_FORWARD}), _run({"sqlite": SQLITE_BACKWARD})),
+    ]
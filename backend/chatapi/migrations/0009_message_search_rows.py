@@ -0,0 +1,116 @@
+from importlib import import_module
+
+from django.db import migrations
+
+# Replaces the SQLite search objects from 0008, whose FTS5 table read its rows
+# back from chatapi_message under a borrowed column name: 'rebuild' (or an
+# integrity-check) would have re-read the real conversation_id as the owner.
+#
+# The index now reads from chatapi_message_search (id, content, owner), a plain
+# table holding one row per finished message, i.e. one with a token count in
+# meta. Its columns are exactly the FTS columns, so the FTS5 table can always
+# be rebuilt from it, and triggers on it keep the FTS5 table in sync the usual
+# external-content way. Triggers on chatapi_message keep the rows in sync:
+# user messages on insert, replies when finalize() stores their count; flushes
+# of a streaming reply don't touch them.
+#
+# SQLite drops a table's triggers along with the table, so a migration that
+# rebuilds chatapi_message (AddField/AlterField/... on Message) loses the
+# chatapi_message ones. ensure_triggers() puts them back after every migrate
+# (ChatapiConfig connects it to post_migrate) and resyncs the rows if any were
+# missing.
+previous = import_module("chatapi.migrations.0008_message_search_triggers")
+
+_OWNER = "(SELECT 'u' || owner_id FROM chatapi_conversation WHERE id = {row}.conversation_id)"
+_FINAL = "json_extract({row}.meta, '$.tokens') IS NOT NULL"
+
+MESSAGE_TRIGGERS = {
+    "chatapi_message_search_ai":
+        "CREATE TRIGGER IF NOT EXISTS chatapi_message_search_ai AFTER INSERT ON chatapi_message "
+        "WHEN " + _FINAL.format(row="new") + " BEGIN "
+        "INSERT INTO chatapi_message_search(id, content, owner) "
+        "VALUES (new.id, new.content, " + _OWNER.format(row="new") + "); END",
+    "chatapi_message_search_ad":
+        "CREATE TRIGGER IF NOT EXISTS chatapi_message_search_ad AFTER DELETE ON chatapi_message "
+        "WHEN " + _FINAL.format(row="old") + " BEGIN "
+        "DELETE FROM chatapi_message_search WHERE id = old.id; END",
+    # a reply becoming final is added; an edited final message is updated; streaming flushes do nothing
+    "chatapi_message_search_au":
+        "CREATE TRIGGER IF NOT EXISTS chatapi_message_search_au AFTER UPDATE OF content, meta ON chatapi_message "
+        "WHEN " + _FINAL.format(row="old") + " OR " + _FINAL.format(row="new") + " BEGIN "
+        "DELETE FROM chatapi_message_search WHERE id = old.id AND NOT (" + _FINAL.format(row="new") + "); "
+        "UPDATE chatapi_message_search SET content = new.content "
+        "WHERE id = old.id AND " + _FINAL.format(row="new") + " AND content IS NOT new.content; "
+        "INSERT INTO chatapi_message_search(id, content, owner) "
+        "SELECT new.id, new.content, " + _OWNER.format(row="new") + " "
+        "WHERE " + _FINAL.format(row="new") + " AND NOT (" + _FINAL.format(row="old") + "); END",
+}
+FTS_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ai AFTER INSERT ON chatapi_message_search BEGIN "
+    "INSERT INTO chatapi_message_fts(rowid, content, owner) VALUES (new.id, new.content, new.owner); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_ad AFTER DELETE ON chatapi_message_search BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, owner) "
+    "VALUES ('delete', old.id, old.content, old.owner); END",
+    "CREATE TRIGGER IF NOT EXISTS chatapi_message_fts_au AFTER UPDATE ON chatapi_message_search BEGIN "
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts, rowid, content, owner) "
+    "VALUES ('delete', old.id, old.content, old.owner); "
+    "INSERT INTO chatapi_message_fts(rowid, content, owner) VALUES (new.id, new.content, new.owner); END",
+]
+POPULATE = [
+    "DELETE FROM chatapi_message_search",
+    "INSERT INTO chatapi_message_search(id, content, owner) "
+    "SELECT m.id, m.content, 'u' || c.owner_id FROM chatapi_message m "
+    "JOIN chatapi_conversation c ON c.id = m.conversation_id WHERE " + _FINAL.format(row="m"),
+    "INSERT INTO chatapi_message_fts(chatapi_message_fts) VALUES ('rebuild')",
+]
+SQLITE_FORWARD = previous.DROP_TRIGGERS + ["DROP TABLE IF EXISTS chatapi_message_fts"] + [
+    "CREATE TABLE IF NOT EXISTS chatapi_message_search ("
+    "id INTEGER PRIMARY KEY, content TEXT NOT NULL, owner TEXT NOT NULL)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chatapi_message_fts USING fts5("
+    "content, owner, content='chatapi_message_search', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+] + FTS_TRIGGERS + list(MESSAGE_TRIGGERS.values()) + POPULATE
+SQLITE_BACKWARD = [f"DROP TRIGGER IF EXISTS {name}" for name in MESSAGE_TRIGGERS] + [
+    "DROP TABLE IF EXISTS chatapi_message_fts",  # its triggers go with chatapi_message_search
+    "DROP TABLE IF EXISTS chatapi_message_search",
+] + previous.SQLITE_FORWARD
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for sql in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+def ensure_triggers(connection) -> bool:
+    """
+    Recreate any chatapi_message search trigger a table rebuild dropped and, if
+    one was missing, resync the search rows. True if anything was repaired.
+    """
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cur:
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chatapi_message_search'")
+        if not cur.fetchone():
+            return False  # not migrated this far (yet)
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chatapi_message'")
+        missing = set(MESSAGE_TRIGGERS) - {r[0] for r in cur.fetchall()}
+        if not missing:
+            return False
+        for name in sorted(missing):
+            cur.execute(MESSAGE_TRIGGERS[name])
+        for sql in POPULATE:
+            cur.execute(sql)
+    return True
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapi', '0008_message_search_triggers'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run({"sqlite": SQLITE_FORWARD}), _run({"sqlite": SQLITE_BACKWARD})),
+    ]
@@ -10,10 +10,26 @@ class Conversation(models.Model):
     title = models.CharField(max_length=200, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Rolling summary of every message with id <= summary_until_id (see services/summarizer.py)
+    summary = models.TextField(blank=True, default="")
+    summary_until_id = models.BigIntegerField(null=True, blank=True)
+    # Denormalized for the sidebar/admin; maintained with F() updates by
+    # services/conversation_stats.py, repaired by `manage.py repair_conversation_stats`
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=200, blank=True, default="")
+    user_tokens = models.PositiveBigIntegerField(default=0)
+    assistant_tokens = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        # sidebar / conversation list: owner's conversations, most recently active first
+        indexes = [models.Index(fields=["owner", "-updated_at"], name="conv_owner_updated_idx")]
 
     def __str__(self):
         return self.title or f"{self.character} — {self.id}"
 
+# Search triggers live on this table. A migration that rebuilds it on SQLite
+# (AddField, AlterField, ...) drops them; post_migrate puts them back (migration 0009).
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
     role = models.CharField(max_length=16, choices=(("user","user"),("assistant","assistant"),("system","system")))
@@ -23,6 +39,5 @@ class Message(models.Model):
 
     class Meta:
         ordering = ("-created_at",)
-
-    class Meta:
-        indexes = [models.Index(fields=["conversation", "created_at"])]
\ No newline at end of file
+        # history fetches and message pagination filter by conversation and order by time
+        indexes = [models.Index(fields=["conversation", "created_at"], name="msg_conv_created_idx")]
@@ -1,22 +1,28 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q
-from .models import Conversation, Message
+from .models import Conversation
+from .services.search_backend import MAX_PAGE_SIZE, InvalidCursor, get_search_backend
 
 class SearchView(APIView):
     permission_classes = [IsAuthenticated]
     def get(self, request):
         q = (request.query_params.get("q") or "").strip()
-        limit = int(request.query_params.get("limit", 20))
+        try:
+            limit = min(max(int(request.query_params.get("limit", 20)), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            limit = 20
+        cursor = request.query_params.get("cursor") or None
         if not q:
-            return Response({"conversations": [], "messages": []})
-        convs = (Conversation.objects
-                 .filter(owner=request.user, title__icontains=q)
-                 .order_by("-updated_at")[:limit]
-                 .values("id","title","character","updated_at"))
-        msgs = (Message.objects
-                 .filter(conversation__owner=request.user, content__icontains=q)
-                 .order_by("-created_at")[:limit]
-                 .values("id","conversation_id","role","content","created_at"))
-        return Response({"conversations": list(convs), "messages": list(msgs)})
+            return Response({"conversations": [], "messages": [], "next_cursor": None})
+        try:
+            msgs, next_cursor = get_search_backend().search_messages(request.user, q, limit=limit, cursor=cursor)
+        except InvalidCursor:
+            return Response({"detail": "invalid cursor"}, status=400)
+        # titles are short and per-owner (conv_owner_updated_idx), so LIKE stays cheap; first page only
+        convs = [] if cursor else list(
+            Conversation.objects
+            .filter(owner=request.user, title__icontains=q)
+            .order_by("-updated_at")[:limit]
+            .values("id","title","character","updated_at"))
+        return Response({"conversations": convs, "messages": msgs, "next_cursor": next_cursor})
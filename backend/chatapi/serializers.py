@@ -9,10 +9,6 @@ class MessageSerializer(serializers.ModelSerializer):
 class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Conversation
-        fields = ("id","character","title","created_at","updated_at")
-
-class ConversationDetailSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
-    class Meta:
-        model = Conversation
-        fields = ("id","character","title","created_at","updated_at","messages")
+        fields = ("id","character","title","created_at","updated_at",
+                  "message_count","last_message_at","last_message_preview","user_tokens","assistant_tokens")
+        read_only_fields = ("message_count","last_message_at","last_message_preview","user_tokens","assistant_tokens")
@@ -0,0 +1,341 @@
+"""
+Admission control for chat generation.
+
+Every POST /api/chat/stream asks for a lease before any row is created; the
+producer returns it when the reply ends. A request is admitted when:
+
+  * the user's token bucket has a token (CHAT_ADMIT_RATE per minute, bursts of
+    CHAT_ADMIT_BURST; one token per request, admitted or not), otherwise 429
+    right away with the time until the next token as Retry-After;
+  * the user has fewer than CHAT_ADMIT_USER_CONCURRENCY replies generating and
+    fewer than CHAT_ADMIT_GLOBAL_CONCURRENCY are generating overall (set this
+    to what the upstream rate limit sustains; it defaults to, and with per-process
+    state behind the sync view is capped at, CHAT_PRODUCER_WORKERS).
+
+Otherwise the request waits in a queue for up to CHAT_ADMIT_MAX_WAIT seconds.
+Freed slots go to waiting users round-robin, least recently served user
+first, so one user's backlog can't starve everyone else. A user may have at most
+CHAT_ADMIT_USER_QUEUE requests waiting and the queue holds at most
+CHAT_ADMIT_MAX_QUEUE; beyond that, or when the wait runs out, the answer is
+429 with Retry-After.
+
+All state (leases, queue, buckets) is one small dict, kept per process
+("local", the default) or in a Django cache (CHAT_ADMIT_BACKEND="cache", shared
+by all workers; updates take a short lock in the cache and waiters poll). Leases
+expire after CHAT_ADMIT_LEASE_TTL seconds in case a worker dies holding one. If
+the store fails, requests are let through rather than refused.
+"""
+
+from __future__ import annotations
+import asyncio, contextlib, logging, math, threading, time, uuid
+from collections import Counter as Tally
+from typing import Any, Callable, Dict, List, Optional
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+State = Dict[str, Any]  # {"leases": {id: [user, expires]}, "queue": [[id, user, deadline]], "served": {user: ts}, "buckets": {user: [tokens, ts]}}
+
+
+class Rejected(Exception):
+    """Not admitted; `retry_after` is in seconds, `reason` one of rate, user_queue, queue_full, timeout."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Lease:
+    __slots__ = ("id", "user")
+
+    def __init__(self, lease_id: Optional[str], user: str):
+        self.id, self.user = lease_id, user
+
+
+def _empty() -> State:
+    return {"leases": {}, "queue": [], "served": {}, "buckets": {}}
+
+
+class LocalStore:
+    """State in this process; sync waiters are woken by a Condition, async ones poll."""
+
+    def __init__(self, poll: float):
+        self.poll = poll
+        self._state = _empty()
+        self._cond = threading.Condition()
+
+    def transact(self, fn: Callable[[State], Any]) -> Any:
+        with self._cond:
+            result = fn(self._state)
+            self._cond.notify_all()
+            return result
+
+    async def atransact(self, fn: Callable[[State], Any]) -> Any:
+        return self.transact(fn)
+
+    def wait(self, timeout: float) -> None:
+        with self._cond:
+            self._cond.wait(min(timeout, 1.0))
+
+    async def await_(self, timeout: float) -> None:
+        await asyncio.sleep(min(timeout, self.poll))
+
+
+class CacheStore:
+    """State under one key of a Django cache, updated under a lock taken with cache.add."""
+
+    def __init__(self, poll: float, *, alias: str = "default", key: str = "chatadmit"):
+        self.poll = poll
+        self.alias, self.key = alias, key
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    @contextlib.contextmanager
+    def _locked(self):
+        cache, token, lock = self._cache, uuid.uuid4().hex, self.key + ":lock"
+        give_up = time.monotonic() + 10
+        while not cache.add(lock, token, timeout=5):  # expires on its own if a holder dies
+            if time.monotonic() > give_up:
+                raise TimeoutError("admission state lock")
+            time.sleep(0.005)
+        try:
+            yield cache
+        finally:
+            if cache.get(lock) == token:
+                cache.delete(lock)
+
+    def transact(self, fn: Callable[[State], Any]) -> Any:
+        with self._locked() as cache:
+            state = cache.get(self.key) or _empty()
+            result = fn(state)
+            cache.set(self.key, state, timeout=None)
+            return result
+
+    async def atransact(self, fn: Callable[[State], Any]) -> Any:
+        return await sync_to_async(self.transact)(fn)
+
+    def wait(self, timeout: float) -> None:
+        time.sleep(min(timeout, self.poll))
+
+    async def await_(self, timeout: float) -> None:
+        await asyncio.sleep(min(timeout, self.poll))
+
+
+class AdmissionController:
+    def __init__(self, store, *, rate: float = 30, burst: int = 10, user_limit: int = 3, global_limit: int = 32,
+                 max_wait: float = 10, user_queue: int = 4, max_queue: int = 256, lease_ttl: float = 600):
+        self.store = store
+        self.rate = float(rate) / 60  # tokens per second
+        self.burst = max(1, int(burst))
+        self.user_limit = max(1, int(user_limit))
+        self.global_limit = max(1, int(global_limit))
+        self.max_wait = float(max_wait)
+        self.user_queue = max(0, int(user_queue))
+        self.max_queue = max(0, int(max_queue))
+        self.lease_ttl = float(lease_ttl)
+
+    # ---------- state transitions (run inside store.transact) ----------
+
+    def _prune(self, state: State, now: float) -> None:
+        state["leases"] = {k: v for k, v in state["leases"].items() if v[1] > now}
+        state["queue"] = [w for w in state["queue"] if w[2] > now]
+        busy = {v[0] for v in state["leases"].values()} | {w[1] for w in state["queue"]}
+        state["served"] = {u: t for u, t in state["served"].items() if u in busy}
+        if self.rate > 0:  # a bucket that has refilled is the same as no bucket
+            full = self.burst / self.rate
+            state["buckets"] = {u: b for u, b in state["buckets"].items() if now - b[1] < full}
+
+    def _take_token(self, state: State, user: str, now: float) -> Optional[float]:
+        """Charge one token; returns seconds until one is available when the bucket is empty."""
+        if self.rate <= 0:
+            return None
+        tokens, ts = state["buckets"].get(user, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - ts) * self.rate)
+        if tokens < 1:
+            state["buckets"][user] = [tokens, now]
+            return (1 - tokens) / self.rate
+        state["buckets"][user] = [tokens - 1, now]
+        return None
+
+    def _fair_order(self, state: State) -> List[str]:
+        """Waiter ids that fit in the free slots now, round-robin over users, least recently served first."""
+        free = self.global_limit - len(state["leases"])
+        if free <= 0:
+            return []
+        active = Tally(v[0] for v in state["leases"].values())
+        waiting: Dict[str, List[str]] = {}
+        for waiter_id, user, _ in state["queue"]:  # FIFO within a user
+            waiting.setdefault(user, []).append(waiter_id)
+        users = sorted(waiting, key=lambda u: state["served"].get(u, 0.0))  # stable: arrival order breaks ties
+        out: List[str] = []
+        while free > 0 and users:
+            again = []
+            for user in users:
+                if free <= 0:
+                    break
+                if active[user] < self.user_limit:
+                    out.append(waiting[user].pop(0))
+                    active[user] += 1
+                    free -= 1
+                    if waiting[user]:
+                        again.append(user)
+            users = again
+        return out
+
+    def _grant(self, state: State, user: str, now: float) -> str:
+        lease_id = uuid.uuid4().hex
+        state["leases"][lease_id] = [user, now + self.lease_ttl]
+        state["served"][user] = now
+        return lease_id
+
+    def _arrive(self, user: str, waiter_id: str):
+        def fn(state: State):
+            now = time.time()
+            self._prune(state, now)
+            wait = self._take_token(state, user, now)
+            if wait is not None:
+                return Rejected("rate", wait)
+            waiter = [waiter_id, user, now + self.max_wait + 1]
+            # admitted now if a free slot would go to it with it queued, even behind waiters who can't use one
+            if waiter_id in self._fair_order(dict(state, queue=state["queue"] + [waiter])):
+                return self._grant(state, user, now)
+            if sum(1 for w in state["queue"] if w[1] == user) >= self.user_queue:
+                return Rejected("user_queue", self.max_wait)
+            if len(state["queue"]) >= self.max_queue:
+                return Rejected("queue_full", self.max_wait)
+            state["queue"].append(waiter)
+            return None
+        return fn
+
+    def _poll(self, user: str, waiter_id: str, give_up: bool):
+        def fn(state: State):
+            now = time.time()
+            self._prune(state, now)
+            if waiter_id in self._fair_order(state):
+                state["queue"] = [w for w in state["queue"] if w[0] != waiter_id]
+                return self._grant(state, user, now)
+            if give_up:
+                state["queue"] = [w for w in state["queue"] if w[0] != waiter_id]
+                return Rejected("timeout", self.max_wait)
+            return None
+        return fn
+
+    def _release(self, lease_id: str):
+        def fn(state: State):
+            state["leases"].pop(lease_id, None)
+        return fn
+
+    # ---------- API ----------
+
+    def acquire(self, user) -> Lease:
+        """Block until admitted (at most max_wait seconds); raises Rejected."""
+        user, waiter_id = str(user), uuid.uuid4().hex
+        try:
+            got = self.store.transact(self._arrive(user, waiter_id))
+            deadline = time.monotonic() + self.max_wait
+            while got is None:
+                left = deadline - time.monotonic()
+                if left > 0:
+                    self.store.wait(left)
+                got = self.store.transact(self._poll(user, waiter_id, give_up=left <= 0))
+        except Exception as e:
+            if isinstance(e, Rejected):
+                raise
+            log.warning("Admission store unavailable, letting the request through: %s", e)
+            return Lease(None, user)
+        if isinstance(got, Rejected):
+            raise got
+        return Lease(got, user)
+
+    async def aacquire(self, user) -> Lease:
+        user, waiter_id = str(user), uuid.uuid4().hex
+        try:
+            got = await self.store.atransact(self._arrive(user, waiter_id))
+            deadline = time.monotonic() + self.max_wait
+            while got is None:
+                left = deadline - time.monotonic()
+                if left > 0:
+                    await self.store.await_(left)
+                got = await self.store.atransact(self._poll(user, waiter_id, give_up=left <= 0))
+        except Exception as e:
+            if isinstance(e, Rejected):
+                raise
+            log.warning("Admission store unavailable, letting the request through: %s", e)
+            return Lease(None, user)
+        if isinstance(got, Rejected):
+            raise got
+        return Lease(got, user)
+
+    def release(self, lease: Optional[Lease]) -> None:
+        if lease is None or lease.id is None:
+            return
+        try:
+            self.store.transact(self._release(lease.id))
+        except Exception as e:
+            log.warning("Could not release admission lease %s (expires on its own): %s", lease.id, e)
+
+    async def arelease(self, lease: Optional[Lease]) -> None:
+        if lease is None or lease.id is None:
+            return
+        try:
+            await self.store.atransact(self._release(lease.id))
+        except Exception as e:
+            log.warning("Could not release admission lease %s (expires on its own): %s", lease.id, e)
+
+
+class _Open:
+    """CHAT_ADMISSION_ENABLED off: everyone is admitted."""
+
+    def acquire(self, user) -> Lease:
+        return Lease(None, str(user))
+
+    async def aacquire(self, user) -> Lease:
+        return Lease(None, str(user))
+
+    def release(self, lease) -> None:
+        pass
+
+    async def arelease(self, lease) -> None:
+        pass
+
+
+def _build_from_settings():
+    if not getattr(settings, "CHAT_ADMISSION_ENABLED", True):
+        return _Open()
+    poll = max(1, int(getattr(settings, "CHAT_ADMIT_POLL_MS", 50))) / 1000
+    global_limit = int(getattr(settings, "CHAT_ADMIT_GLOBAL_CONCURRENCY", 32))
+    if getattr(settings, "CHAT_ADMIT_BACKEND", "local") == "cache":
+        store: Any = CacheStore(poll, alias=getattr(settings, "CHAT_ADMIT_CACHE_ALIAS", "default"))
+    else:
+        store = LocalStore(poll)
+        workers = int(getattr(settings, "CHAT_PRODUCER_WORKERS", 32))
+        if not getattr(settings, "CHAT_STREAM_ASYNC", False) and global_limit > workers:
+            # a lease beyond this process's producer threads would only wait for one while counting as generating
+            log.warning("CHAT_ADMIT_GLOBAL_CONCURRENCY=%d exceeds CHAT_PRODUCER_WORKERS=%d; admitting at most %d at once",
+                        global_limit, workers, workers)
+            global_limit = workers
+    return AdmissionController(
+        store,
+        rate=getattr(settings, "CHAT_ADMIT_RATE", 30),
+        burst=getattr(settings, "CHAT_ADMIT_BURST", 10),
+        user_limit=getattr(settings, "CHAT_ADMIT_USER_CONCURRENCY", 3),
+        global_limit=global_limit,
+        max_wait=getattr(settings, "CHAT_ADMIT_MAX_WAIT", 10),
+        user_queue=getattr(settings, "CHAT_ADMIT_USER_QUEUE", 4),
+        max_queue=getattr(settings, "CHAT_ADMIT_MAX_QUEUE", 256),
+        lease_ttl=getattr(settings, "CHAT_ADMIT_LEASE_TTL", 600),
+    )
+
+
+_controller = None
+
+def get_admission():
+    global _controller
+    if _controller is None:
+        _controller = _build_from_settings()
+    return _controller
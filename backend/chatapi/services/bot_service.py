@@ -1,17 +1,21 @@
 from __future__ import annotations
-import os, logging
-from typing import Dict, Generator, Iterable, List, Optional, Tuple
-from openai import OpenAI
+import os, logging, time
+from typing import AsyncGenerator, Dict, Generator, Iterable, List, Optional, Tuple
 from django.conf import settings
+from . import metrics
+from .llm_providers import get_llm_provider
+from .response_cache import get_response_cache
+from .token_budget import MESSAGE_OVERHEAD, estimate_tokens, message_tokens, truncate_to_tokens
 
 try:
-    from chatbot.bot import build_system_prompt
+    from chatbot.bot import build_system_prompt, get_persona_assets
 except Exception:
     build_system_prompt = None  # type: ignore
+    get_persona_assets = None  # type: ignore
 
 log = logging.getLogger(__name__)
 
-# ---------- OpenAI config ----------
+# ---------- Model config (sent to whichever provider CHAT_LLM_PROVIDER selects) ----------
 OPENAI_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
 OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.3"))
 OPENAI_MAX_OUTPUT_TOKENS = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "1024"))
@@ -41,11 +45,16 @@ ASSET_MAP: Dict[str, Tuple[str, str]] = {
     "Cersei Lannister": _get_asset_paths("cersei"),
 }
 
-_client: Optional[OpenAI] = None
+def persona_label(persona: Optional[str]) -> str:
+    """Bounded metrics label for a persona: its asset stem (bronn, tyrion, ...) or "other"."""
+    key = (persona or "Bronn").strip()
+    paths = ASSET_MAP.get(key) or ASSET_MAP.get(key.lower())
+    return os.path.basename(paths[0])[: -len("_kb.jsonl")] if paths else "other"
+
 _assets_checked = False
 
 def _check_assets_once() -> None:
-    """Log presence of persona assets exactly once."""
+    """Log presence of persona assets exactly once and warm the asset cache."""
     global _assets_checked
     if _assets_checked:
         return
@@ -56,61 +65,122 @@ def _check_assets_once() -> None:
                         name, kb, kb_ok, style, style_ok)
         else:
             log.info("Persona assets OK for %s: kb=%s, style=%s", name, kb, style)
+            if get_persona_assets:
+                get_persona_assets(kb, style)
     _assets_checked = True
 
-def _client_singleton() -> OpenAI:
-    global _client
-    if _client is None:
-        _client = OpenAI()  # reads OPENAI_API_KEY
-        log.info("OpenAI ready: model=%s, temp=%s", OPENAI_MODEL, OPENAI_TEMPERATURE)
-        _check_assets_once()
-    return _client
+def _request(messages: List[Dict[str, str]]) -> Dict[str, object]:
+    _check_assets_once()
+    return dict(model=OPENAI_MODEL, messages=messages, temperature=OPENAI_TEMPERATURE, max_tokens=OPENAI_MAX_OUTPUT_TOKENS)
+
+# Stay in-character even on failure:
+FAILURE_REPLY = " … Hells. Something’s off. Try me again."
 
 # ---------- Public API used by views ----------
 
-def stream_tokens(prompt: str, *, persona: Optional[str] = None, history: Optional[Iterable[Dict[str, str]]] = None) -> Generator[str, None, None]:
-    messages = _assemble_messages(prompt, persona=(persona or "Bronn"), history=history)
-    client = _client_singleton()
+def stream_tokens(prompt: str, *, persona: Optional[str] = None, history: Optional[Iterable[Dict[str, str]]] = None, summary: str = "") -> Generator[str, None, None]:
+    messages = _assemble_messages(prompt, persona=(persona or "Bronn"), history=history, summary=summary)
+    cache = get_response_cache()
+    key = cache.key_for(OPENAI_MODEL, OPENAI_TEMPERATURE, messages)
+    trace = metrics.current()
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            trace.set(outcome="cached")
+            yield from cached
+            return
+    parts: List[str] = []
+    t0 = time.perf_counter()
+    upstream = None
     try:
-        stream = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            temperature=OPENAI_TEMPERATURE,
-            max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
-            stream=True,
-        )
-        for chunk in stream:
-            try:
-                delta = chunk.choices[0].delta.content or ""
-            except Exception:
-                delta = ""
-            if delta:
+        # provider per CHAT_LLM_PROVIDER; the OpenAI ones retry/hedge pre-stream failures (see llm_client)
+        upstream = get_llm_provider().stream(**_request(messages))
+        for delta in upstream:
+            if not parts:
+                trace.add("llm_first_token", time.perf_counter() - t0)
+            parts.append(delta)
+            yield delta
+    except Exception as e:
+        log.exception("OpenAI stream failed: %s", e)
+        trace.set(outcome="error")
+        yield FAILURE_REPLY
+        return
+    finally:
+        # closed early (cancel, no listeners left): close the HTTP stream now so no more output is billed
+        if upstream is not None:
+            upstream.close()
+    # only complete, successful replies are cached (a disconnect never gets here)
+    if key:
+        cache.set(key, parts)
+
+async def astream_tokens(prompt: str, *, persona: Optional[str] = None, history: Optional[Iterable[Dict[str, str]]] = None, summary: str = "") -> AsyncGenerator[str, None]:
+    """Async twin of stream_tokens for the ASGI streaming view."""
+    messages = _assemble_messages(prompt, persona=(persona or "Bronn"), history=history, summary=summary)
+    cache = get_response_cache()
+    key = cache.key_for(OPENAI_MODEL, OPENAI_TEMPERATURE, messages)
+    trace = metrics.current()
+    if key:
+        cached = await cache.aget(key)
+        if cached is not None:
+            trace.set(outcome="cached")
+            for delta in cached:
                 yield delta
+            return
+    parts: List[str] = []
+    t0 = time.perf_counter()
+    upstream = None
+    try:
+        upstream = get_llm_provider().astream(**_request(messages))
+        async for delta in upstream:
+            if not parts:
+                trace.add("llm_first_token", time.perf_counter() - t0)
+            parts.append(delta)
+            yield delta
     except Exception as e:
         log.exception("OpenAI stream failed: %s", e)
-        # Stay in-character even on failure:
-        yield " … Hells. Something’s off. Try me again."
-
-def complete_once(prompt: str, *, persona: Optional[str] = None, history: Optional[Iterable[Dict[str, str]]] = None) -> str:
-    messages = _assemble_messages(prompt, persona=(persona or "Bronn"), history=history)
-    client = _client_singleton()
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        temperature=OPENAI_TEMPERATURE,
-        max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
-        stream=False,
-    )
-    return (resp.choices[0].message.content or "").strip()
+        trace.set(outcome="error")
+        yield FAILURE_REPLY
+        return
+    finally:
+        if upstream is not None:
+            await upstream.aclose()
+    if key:
+        await cache.aset(key, parts)
+
+def complete_once(prompt: str, *, persona: Optional[str] = None, history: Optional[Iterable[Dict[str, str]]] = None, summary: str = "") -> str:
+    messages = _assemble_messages(prompt, persona=(persona or "Bronn"), history=history, summary=summary)
+    cache = get_response_cache()
+    key = cache.key_for(OPENAI_MODEL, OPENAI_TEMPERATURE, messages)
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return "".join(cached).strip()
+    text = get_llm_provider().complete(**_request(messages))
+    if key:
+        cache.set(key, [text])
+    return text
 
 # ---------- Message assembly ----------
 
-def _assemble_messages(prompt: str, *, persona: str, history: Optional[Iterable[Dict[str, str]]]) -> List[Dict[str, str]]:
+def _history_budget(fixed_msgs: List[Dict[str, str]], prompt: str) -> int:
+    """Tokens left for history once system messages, the new turn and the reply reserve are paid for."""
+    context = int(getattr(settings, "CHAT_MODEL_CONTEXT_TOKENS", 128000))
+    cap = int(getattr(settings, "CHAT_HISTORY_TOKEN_BUDGET", 4000))
+    fixed = sum(message_tokens(m) for m in fixed_msgs) + estimate_tokens(prompt) + MESSAGE_OVERHEAD + OPENAI_MAX_OUTPUT_TOKENS
+    return max(0, min(cap, context - fixed))
+
+def _assemble_messages(prompt: str, *, persona: str, history: Optional[Iterable[Dict[str, str]]], summary: str = "") -> List[Dict[str, str]]:
     msgs: List[Dict[str, str]] = []
     msgs.append({"role": "system", "content": _persona_system_prompt(persona, prompt)})
+    if summary:
+        # rolling summary stands in for turns older than the history window
+        msgs.append({"role": "system", "content": "# Earlier in this conversation\n" + summary})
     if history:
-        msgs.extend(_bound_history(history, max_pairs=8))
+        msgs.extend(_bound_history(history, budget_tokens=_history_budget(msgs, prompt)))
     msgs.append({"role": "user", "content": prompt})
+    trace = metrics.current()
+    if trace:
+        trace.set(prompt_tokens=sum(message_tokens(m) for m in msgs))
     return msgs
 
 def _persona_system_prompt(persona: str, latest_user_prompt: str) -> str:
@@ -119,14 +189,19 @@ def _persona_system_prompt(persona: str, latest_user_prompt: str) -> str:
     # Try exact match first, then lowercase match
     kb_path, style_path = ASSET_MAP.get(persona_key, ASSET_MAP.get(persona_key.lower(), ASSET_MAP["bronn"]))
     if build_system_prompt:
+        trace = metrics.current()
+        timings: Optional[Dict[str, float]] = {} if trace else None
         try:
-            return build_system_prompt(
+            prompt = build_system_prompt(
                 character=persona,
                 user_query=latest_user_prompt,  # may include [[OOC]]
                 kb_path=kb_path,
-                style_path=style_path,
-                k=5,
+                style_path=style_path,  # top_k / kb_token_budget come from the style's retrieval block
+                timings=timings,
             )
+            for stage, seconds in (timings or {}).items():
+                trace.add(stage, seconds)
+            return prompt
         except Exception as e:
             log.warning("build_system_prompt failed for %s (%s); falling back to strict IC.", persona, e)
     # STRICT IC fallback (never generic assistant)
@@ -136,8 +211,29 @@ def _persona_system_prompt(persona: str, latest_user_prompt: str) -> str:
         "Switch to brief narrator mode only if the user prefixes [[OOC]]."
     )
 
-def _bound_history(history: Iterable[Dict[str, str]], *, max_pairs: int = 8) -> List[Dict[str, str]]:
+# a turn cut below this many tokens carries no useful context; drop it instead
+_MIN_TRUNCATED_TOKENS = 32
+
+def _bound_history(history: Iterable[Dict[str, str]], *, budget_tokens: int) -> List[Dict[str, str]]:
+    """
+    Newest turns that fit in `budget_tokens` (oldest dropped first). The turn that
+    crosses the budget is cut to its tail when enough room is left. Entries may
+    carry a precomputed "tokens" count (Message.meta); only role/content are returned.
+    """
     hist = list(history)
     if hist and hist[0].get("role") == "system":
         hist = hist[1:]
-    return hist[-(2 * max_pairs):] if max_pairs > 0 else hist
+    kept: List[Dict[str, str]] = []
+    left = budget_tokens
+    for m in reversed(hist):
+        cost = message_tokens(m)
+        if cost <= left:
+            kept.append({"role": m["role"], "content": m["content"]})
+            left -= cost
+            continue
+        room = left - MESSAGE_OVERHEAD
+        if room >= _MIN_TRUNCATED_TOKENS:
+            kept.append({"role": m["role"], "content": truncate_to_tokens(m["content"], room)})
+        break
+    kept.reverse()
+    return kept
@@ -0,0 +1,96 @@
+"""
+Maintains Conversation.message_count / last_message_* / *_tokens.
+
+Every write goes through a single UPDATE with F() expressions, so concurrent
+writers never lose increments, and it also bumps updated_at (QuerySet.update
+skips auto_now), replacing the separate conv.save(update_fields=["updated_at"]).
+Deleting messages can't be undone by increments; refresh() recomputes the
+affected conversations from their messages instead.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, Iterable
+from django.db.models import Count, F, Max
+from django.db.models.functions import Length
+from django.utils.timezone import now
+from ..models import Conversation, Message
+from .token_budget import CHARS_PER_TOKEN
+
+PREVIEW_CHARS = 200
+
+
+def preview_of(text: str) -> str:
+    text = " ".join((text or "").split())
+    return (text[:PREVIEW_CHARS - 1] + "…") if len(text) > PREVIEW_CHARS else text
+
+
+def _tokens_of(message: Message) -> int:
+    return int((message.meta or {}).get("tokens") or 0)
+
+
+def _created_changes(message: Message) -> Dict[str, Any]:
+    changes: Dict[str, Any] = {
+        "message_count": F("message_count") + 1,
+        "last_message_at": message.created_at,
+        "updated_at": now(),
+    }
+    if message.content:
+        # an empty streaming placeholder keeps the previous preview until the reply lands
+        changes["last_message_preview"] = preview_of(message.content)
+    tokens = _tokens_of(message)
+    if tokens and message.role in ("user", "assistant"):
+        field = f"{message.role}_tokens"
+        changes[field] = F(field) + tokens
+    return changes
+
+
+def _reply_changes(message: Message) -> Dict[str, Any]:
+    changes: Dict[str, Any] = {"updated_at": now()}
+    if message.content:
+        changes["last_message_preview"] = preview_of(message.content)
+    tokens = _tokens_of(message)
+    if tokens:
+        changes["assistant_tokens"] = F("assistant_tokens") + tokens
+    return changes
+
+
+def message_created(message: Message) -> None:
+    Conversation.objects.filter(pk=message.conversation_id).update(**_created_changes(message))
+
+
+async def amessage_created(message: Message) -> None:
+    await Conversation.objects.filter(pk=message.conversation_id).aupdate(**_created_changes(message))
+
+
+def reply_finished(message: Message) -> None:
+    """A streamed assistant row was finalized: its content and token count are now known."""
+    Conversation.objects.filter(pk=message.conversation_id).update(**_reply_changes(message))
+
+
+async def areply_finished(message: Message) -> None:
+    await Conversation.objects.filter(pk=message.conversation_id).aupdate(**_reply_changes(message))
+
+
+def computed(conversation_id) -> Dict[str, Any]:
+    """The counters as they should be, from the conversation's messages."""
+    msgs = Message.objects.filter(conversation_id=conversation_id)
+    agg = msgs.aggregate(n=Count("id"), last=Max("created_at"))
+    last = msgs.exclude(content="").order_by("-created_at", "-id").values_list("content", flat=True).first()
+    tokens = {"user": 0, "assistant": 0}
+    for role, meta, n_chars in msgs.filter(role__in=tokens).values_list("role", "meta", Length("content")).iterator():
+        n = (meta or {}).get("tokens")
+        # same estimate as token_budget.estimate_tokens, without loading the content
+        tokens[role] += int(n) if n is not None else (n_chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return {
+        "message_count": agg["n"],
+        "last_message_at": agg["last"],
+        "last_message_preview": preview_of(last or ""),
+        "user_tokens": tokens["user"],
+        "assistant_tokens": tokens["assistant"],
+    }
+
+
+def refresh(conversation_ids: Iterable) -> None:
+    """Recompute after messages were deleted; updated_at (the sidebar sort key) is left alone."""
+    for pk in set(conversation_ids):
+        Conversation.objects.filter(pk=pk).update(**computed(pk))
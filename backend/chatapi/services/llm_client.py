@@ -0,0 +1,436 @@
+"""
+Shared, pooled OpenAI client with retries and hedged streaming.
+
+One LLMClientManager per process owns a sync and an async OpenAI client over
+explicitly sized httpx pools (keep-alive on), so requests reuse connections
+instead of each caller building its own client.
+
+Streaming requests:
+- fail over on *pre-stream* errors only (connect errors, 408/409/429/5xx, or no
+  first token within CHAT_LLM_FIRST_TOKEN_TIMEOUT), sleeping a full-jitter
+  exponential backoff between attempts. Once a token has been yielded the
+  reply is committed; a later failure propagates to the caller.
+- optionally hedge: if the first token hasn't arrived after the recent p95
+  time-to-first-token (CHAT_LLM_HEDGE_AFTER until enough samples exist), a
+  second identical request is fired and whichever streams first is kept; the
+  loser's HTTP stream is closed. Each attempt is pumped by its own thread.
+  Without hedging the stream is read inline on the caller's thread, and the
+  first-token timeout is enforced as the request's read timeout (so it also
+  bounds the gaps between tokens).
+
+The SDK's own retry loop is disabled (max_retries=0) so the two don't stack.
+"""
+
+from __future__ import annotations
+import asyncio, logging, queue, random, threading, time
+from collections import deque
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, Generator, List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+_DELTA, _END, _ERROR = "delta", "end", "error"
+# p95 of fewer samples than this is noise; use the configured threshold instead
+_MIN_TTFT_SAMPLES = 20
+
+
+class FirstTokenTimeout(Exception):
+    """No token arrived within first_token_timeout (treated as a retryable pre-stream failure)."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (FirstTokenTimeout, openai.APIConnectionError)):  # includes APITimeoutError
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _delta_of(chunk: Any) -> str:
+    try:
+        return chunk.choices[0].delta.content or ""
+    except Exception:
+        return ""
+
+
+class _Attempt:
+    """One streaming request, pumped on a daemon thread into the caller's queue."""
+
+    def __init__(self, open_stream: Callable[[], Any], out: "queue.Queue[Tuple[_Attempt, str, Any]]"):
+        self._open = open_stream
+        self._out = out
+        self._stream: Any = None
+        self.cancelled = False
+        threading.Thread(target=self._pump, daemon=True, name="llm-stream").start()
+
+    def _pump(self) -> None:
+        try:
+            self._stream = self._open()
+            for chunk in self._stream:
+                if self.cancelled:
+                    break
+                delta = _delta_of(chunk)
+                if delta:
+                    self._out.put((self, _DELTA, delta))
+        except Exception as e:
+            if not self.cancelled:
+                self._out.put((self, _ERROR, e))
+            return
+        finally:
+            self._close()
+        self._out.put((self, _END, None))
+
+    def _close(self) -> None:
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def cancel(self) -> None:
+        # closing the response unblocks the pump thread's read
+        self.cancelled = True
+        self._close()
+
+
+class _AsyncAttempt:
+    """Async twin of _Attempt: one streaming request pumped by a task."""
+
+    def __init__(self, open_stream: Callable[[], Any], out: "asyncio.Queue[Tuple[_AsyncAttempt, str, Any]]"):
+        self._open = open_stream
+        self._out = out
+        self.task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self) -> None:
+        stream = None
+        try:
+            stream = await self._open()
+            async for chunk in stream:
+                delta = _delta_of(chunk)
+                if delta:
+                    self._out.put_nowait((self, _DELTA, delta))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._out.put_nowait((self, _ERROR, e))
+            return
+        finally:
+            if stream is not None:
+                try:
+                    await stream.close()
+                except BaseException:
+                    pass
+        self._out.put_nowait((self, _END, None))
+
+    def cancel(self) -> None:
+        self.task.cancel()
+
+
+class LLMClientManager:
+    name = "openai"
+
+    def __init__(self, *, base_url: Optional[str] = None, api_key: Optional[str] = None,
+                 pool_size: int = 20, keepalive: int = 10, keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 5.0, read_timeout: float = 60.0, first_token_timeout: float = 20.0,
+                 max_retries: int = 2, backoff_base: float = 0.25, backoff_max: float = 4.0,
+                 hedge: bool = False, hedge_after: float = 1.5, hedge_quantile: float = 0.95):
+        self.base_url, self.api_key = base_url, api_key
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=min(keepalive, pool_size),
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=connect_timeout)
+        self.first_token_timeout = float(first_token_timeout)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base, self.backoff_max = float(backoff_base), float(backoff_max)
+        self.hedge, self.hedge_after, self.hedge_quantile = hedge, float(hedge_after), float(hedge_quantile)
+        self._ttft: Deque[float] = deque(maxlen=256)
+        self._client: Optional[OpenAI] = None
+        self._aclient: Optional[AsyncOpenAI] = None
+        self._lock = threading.Lock()
+        self.requests = self.retries = self.hedges = self.hedge_wins = self.failures = 0
+
+    # ---------- clients ----------
+
+    @property
+    def client(self) -> OpenAI:
+        with self._lock:
+            if self._client is None:
+                self._client = OpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0, timeout=self.timeout,
+                                      http_client=openai.DefaultHttpxClient(limits=self.limits, timeout=self.timeout))
+            return self._client
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        with self._lock:
+            if self._aclient is None:
+                self._aclient = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0, timeout=self.timeout,
+                                            http_client=openai.DefaultAsyncHttpxClient(limits=self.limits, timeout=self.timeout))
+            return self._aclient
+
+    def close(self) -> None:
+        with self._lock:
+            client, self._client = self._client, None
+            self._aclient = None  # bound to its event loop; let it be collected there
+        if client is not None:
+            client.close()
+
+    # ---------- policy ----------
+
+    def backoff(self, retry: int, exc: Optional[BaseException] = None) -> float:
+        """Full-jitter exponential delay before retry number `retry` (1-based); honours Retry-After up to backoff_max."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (retry - 1))))
+        response = getattr(exc, "response", None)
+        try:
+            delay = max(delay, min(self.backoff_max, float(response.headers.get("retry-after"))))
+        except Exception:
+            pass
+        return delay
+
+    def hedge_delay(self) -> float:
+        samples = sorted(self._ttft)
+        if len(samples) < _MIN_TTFT_SAMPLES:
+            return self.hedge_after
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_quantile))]
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._ttft)
+        return {"requests": self.requests, "retries": self.retries, "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins, "failures": self.failures,
+                "ttft_p50": samples[len(samples) // 2] if samples else None, "hedge_delay": self.hedge_delay()}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    # ---------- requests ----------
+
+    def stream(self, **params: Any) -> Generator[str, None, None]:
+        """Yield content deltas of a chat completion; params go to chat.completions.create."""
+        params = dict(params, stream=True)
+        self._count("requests")
+        if not self.hedge:
+            yield from self._stream_inline(params)
+            return
+        open_stream = lambda: self.client.chat.completions.create(**params)
+        out: "queue.Queue[Tuple[_Attempt, str, Any]]" = queue.Queue()
+        for retry in range(self.max_retries + 1):
+            started = time.monotonic()
+            deadline = started + self.first_token_timeout
+            hedge_at = started + self.hedge_delay() if self.hedge else None
+            live: List[_Attempt] = [_Attempt(open_stream, out)]
+            winner, kind, payload, error = None, _ERROR, None, None
+            try:
+                while winner is None and live:
+                    wake = min(deadline, hedge_at) if hedge_at else deadline
+                    try:
+                        att, kind, payload = out.get(timeout=max(0.0, wake - time.monotonic()))
+                    except queue.Empty:
+                        if hedge_at and time.monotonic() < deadline:
+                            live.append(_Attempt(open_stream, out))
+                            self._count("hedges")
+                            hedge_at = None
+                            continue
+                        error = FirstTokenTimeout(f"no token after {self.first_token_timeout:.1f}s")
+                        break
+                    if att not in live:
+                        continue
+                    if kind == _ERROR:
+                        live.remove(att)
+                        error = payload
+                    else:
+                        winner = att
+            finally:
+                for att in live:
+                    if att is not winner:
+                        att.cancel()
+
+            if winner is None:
+                if retry >= self.max_retries or not is_retryable(error):
+                    self._count("failures")
+                    raise error
+                delay = self.backoff(retry + 1, error)
+                log.warning("LLM stream attempt %d failed before first token (%s); retrying in %.2fs", retry + 1, error, delay)
+                self._count("retries")
+                time.sleep(delay)
+                continue
+
+            self._ttft.append(time.monotonic() - started)
+            if len(live) > 1 and winner is not live[0]:
+                self._count("hedge_wins")
+            try:
+                while kind == _DELTA:
+                    yield payload
+                    att, kind, payload = out.get()
+                    while att is not winner:
+                        att, kind, payload = out.get()
+                if kind == _ERROR:
+                    raise payload
+            finally:
+                winner.cancel()  # no-op once finished; closes upstream if the consumer went away
+            return
+
+    def _stream_inline(self, params: Dict[str, Any]) -> Generator[str, None, None]:
+        """stream() without hedging: one request at a time, no pump thread."""
+        t = self.timeout
+        timeout = httpx.Timeout(connect=t.connect, read=min(t.read, self.first_token_timeout), write=t.write, pool=t.pool)
+        for retry in range(self.max_retries + 1):
+            started = time.monotonic()
+            stream, first = None, ""
+            try:
+                stream = self.client.chat.completions.create(**params, timeout=timeout)
+                for chunk in stream:
+                    first = _delta_of(chunk)
+                    if first:
+                        break
+            except Exception as e:
+                if stream is not None:
+                    stream.close()
+                error = e
+                if isinstance(e, (openai.APITimeoutError, httpx.TimeoutException)):
+                    error = FirstTokenTimeout(f"no token after {self.first_token_timeout:.1f}s")
+                if retry >= self.max_retries or not is_retryable(error):
+                    self._count("failures")
+                    if error is e:
+                        raise
+                    raise error from e
+                delay = self.backoff(retry + 1, error)
+                log.warning("LLM stream attempt %d failed before first token (%s); retrying in %.2fs", retry + 1, error, delay)
+                self._count("retries")
+                time.sleep(delay)
+                continue
+
+            self._ttft.append(time.monotonic() - started)
+            try:
+                if first:
+                    yield first
+                    for chunk in stream:
+                        delta = _delta_of(chunk)
+                        if delta:
+                            yield delta
+            finally:
+                stream.close()  # closes upstream if the consumer went away
+            return
+
+    async def astream(self, **params: Any) -> AsyncGenerator[str, None]:
+        """Async twin of stream()."""
+        params = dict(params, stream=True)
+        open_stream = lambda: self.aclient.chat.completions.create(**params)
+        self._count("requests")
+        out: "asyncio.Queue[Tuple[_AsyncAttempt, str, Any]]" = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        for retry in range(self.max_retries + 1):
+            started = loop.time()
+            deadline = started + self.first_token_timeout
+            hedge_at = started + self.hedge_delay() if self.hedge else None
+            live: List[_AsyncAttempt] = [_AsyncAttempt(open_stream, out)]
+            winner, kind, payload, error = None, _ERROR, None, None
+            try:
+                while winner is None and live:
+                    wake = min(deadline, hedge_at) if hedge_at else deadline
+                    try:
+                        att, kind, payload = await asyncio.wait_for(out.get(), timeout=max(0.0, wake - loop.time()))
+                    except asyncio.TimeoutError:
+                        if hedge_at and loop.time() < deadline:
+                            live.append(_AsyncAttempt(open_stream, out))
+                            self._count("hedges")
+                            hedge_at = None
+                            continue
+                        error = FirstTokenTimeout(f"no token after {self.first_token_timeout:.1f}s")
+                        break
+                    if att not in live:
+                        continue
+                    if kind == _ERROR:
+                        live.remove(att)
+                        error = payload
+                    else:
+                        winner = att
+            finally:
+                for att in live:
+                    if att is not winner:
+                        att.cancel()
+
+            if winner is None:
+                if retry >= self.max_retries or not is_retryable(error):
+                    self._count("failures")
+                    raise error
+                delay = self.backoff(retry + 1, error)
+                log.warning("LLM stream attempt %d failed before first token (%s); retrying in %.2fs", retry + 1, error, delay)
+                self._count("retries")
+                await asyncio.sleep(delay)
+                continue
+
+            self._ttft.append(loop.time() - started)
+            if len(live) > 1 and winner is not live[0]:
+                self._count("hedge_wins")
+            try:
+                while kind == _DELTA:
+                    yield payload
+                    att, kind, payload = await out.get()
+                    while att is not winner:
+                        att, kind, payload = await out.get()
+                if kind == _ERROR:
+                    raise payload
+            finally:
+                winner.cancel()
+            return
+
+    def complete(self, **params: Any) -> str:
+        """Non-streaming chat completion with the same retry policy; returns the reply text."""
+        params = dict(params, stream=False)
+        self._count("requests")
+        for retry in range(self.max_retries + 1):
+            try:
+                resp = self.client.chat.completions.create(**params)
+                return (resp.choices[0].message.content or "").strip()
+            except Exception as e:
+                if retry >= self.max_retries or not is_retryable(e):
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                time.sleep(self.backoff(retry + 1, e))
+        raise AssertionError("unreachable")
+
+
+_manager: Optional[LLMClientManager] = None
+_manager_lock = threading.Lock()
+
+
+def _build_from_settings(**overrides: Any) -> LLMClientManager:
+    return LLMClientManager(
+        **overrides,
+        pool_size=int(getattr(settings, "CHAT_LLM_POOL_SIZE", 20)),
+        keepalive=int(getattr(settings, "CHAT_LLM_KEEPALIVE", 10)),
+        keepalive_expiry=float(getattr(settings, "CHAT_LLM_KEEPALIVE_EXPIRY", 30.0)),
+        connect_timeout=float(getattr(settings, "CHAT_LLM_CONNECT_TIMEOUT", 5.0)),
+        read_timeout=float(getattr(settings, "CHAT_LLM_READ_TIMEOUT", 60.0)),
+        first_token_timeout=float(getattr(settings, "CHAT_LLM_FIRST_TOKEN_TIMEOUT", 20.0)),
+        max_retries=int(getattr(settings, "CHAT_LLM_MAX_RETRIES", 2)),
+        backoff_base=float(getattr(settings, "CHAT_LLM_BACKOFF_BASE", 0.25)),
+        backoff_max=float(getattr(settings, "CHAT_LLM_BACKOFF_MAX", 4.0)),
+        hedge=bool(getattr(settings, "CHAT_LLM_HEDGE", False)),
+        hedge_after=float(getattr(settings, "CHAT_LLM_HEDGE_AFTER", 1.5)),
+        hedge_quantile=float(getattr(settings, "CHAT_LLM_HEDGE_QUANTILE", 0.95)),
+    )
+
+
+def get_llm_client() -> LLMClientManager:
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = _build_from_settings()
+                log.info("LLM client ready: pool=%s, hedge=%s", _manager.limits.max_connections, _manager.hedge)
+    return _manager
+
+
+def reset_llm_client() -> None:
+    """Drop the process-wide manager (tests / settings changes)."""
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close()
+        _manager = None
@@ -0,0 +1,191 @@
+"""
+LLM provider backends behind bot_service.stream_tokens / astream_tokens / complete_once.
+
+A provider takes chat.completions.create keyword arguments (model, messages,
+temperature, max_tokens) and exposes stream / astream / complete / stats.
+CHAT_LLM_PROVIDER selects one:
+
+- "openai": the pooled LLMClientManager (OPENAI_API_KEY, OPENAI_BASE_URL)
+- "openai-compatible": the same client pointed at CHAT_LLM_BASE_URL (local vLLM,
+  llama.cpp server, or `manage.py fake_llm_server`)
+- "fake": FakeProvider, deterministic tokens generated in-process, no network
+- a dotted path to a callable returning a provider, for anything else
+"""
+
+from __future__ import annotations
+import asyncio, hashlib, json, math, random, threading, time
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Protocol, Tuple
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .llm_client import get_llm_client, LLMClientManager, _build_from_settings as _client_from_settings
+
+
+class LLMProvider(Protocol):
+    name: str
+
+    def stream(self, **params: Any) -> Generator[str, None, None]: ...
+
+    def astream(self, **params: Any) -> AsyncGenerator[str, None]: ...
+
+    def complete(self, **params: Any) -> str: ...
+
+    def stats(self) -> Dict[str, Any]: ...
+
+
+class Distribution:
+    """
+    A non-negative random quantity from a short spec:
+    "250" / "fixed:250", "uniform:100,400", "normal:250,50" (mean, stddev),
+    "lognormal:250,0.5" (median, sigma), "exp:250" (mean).
+    """
+
+    _KINDS = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+
+    def __init__(self, spec: Any):
+        self.spec = str(spec).strip()
+        kind, _, args = self.spec.rpartition(":")
+        kind = kind or "fixed"
+        try:
+            self.args = [float(a) for a in args.split(",")]
+        except ValueError:
+            raise ValueError(f"bad distribution spec {self.spec!r}")
+        if self._KINDS.get(kind) != len(self.args):
+            raise ValueError(f"bad distribution spec {self.spec!r}")
+        self.kind = kind
+
+    def sample(self, rng: random.Random) -> float:
+        a = self.args
+        if self.kind == "fixed":
+            v = a[0]
+        elif self.kind == "uniform":
+            v = rng.uniform(a[0], a[1])
+        elif self.kind == "normal":
+            v = rng.gauss(a[0], a[1])
+        elif self.kind == "lognormal":
+            v = rng.lognormvariate(math.log(max(a[0], 1e-9)), a[1])
+        else:
+            v = rng.expovariate(1.0 / a[0]) if a[0] > 0 else 0.0
+        return max(0.0, v)
+
+    def __repr__(self) -> str:
+        return f"Distribution({self.spec!r})"
+
+
+_VOCAB = ("gold coin sellsword blade steel road river castle wine lord lady debt pay fight "
+          "horse night watch keep walls oath price risk neck smile trouble luck blood").split()
+
+
+class FakeProvider:
+    """
+    Deterministic stand-in for an LLM: the reply length, first-token latency and
+    words are drawn from an RNG seeded by (seed, request), so the same request
+    always streams the same tokens on the same schedule. Tokens are paced at
+    `tokens_per_sec` (0 = as fast as possible). Replies are capped by max_tokens.
+    """
+
+    name = "fake"
+
+    def __init__(self, *, tokens: Any = "200", tokens_per_sec: float = 50.0, ttft_ms: Any = "300", seed: int = 0):
+        self.tokens = tokens if isinstance(tokens, Distribution) else Distribution(tokens)
+        self.ttft_ms = ttft_ms if isinstance(ttft_ms, Distribution) else Distribution(ttft_ms)
+        self.tokens_per_sec = float(tokens_per_sec)
+        self.seed = int(seed)
+        self._lock = threading.Lock()
+        self.requests = self.tokens_sent = 0
+
+    def plan(self, **params: Any) -> Tuple[float, List[str]]:
+        """(seconds before the first token, token list) for a request."""
+        raw = json.dumps([self.seed, params.get("model"), params.get("messages")], sort_keys=True, ensure_ascii=False)
+        rng = random.Random(hashlib.sha256(raw.encode("utf-8")).digest())
+        n = max(1, int(round(self.tokens.sample(rng))))
+        if params.get("max_tokens"):
+            n = min(n, int(params["max_tokens"]))
+        words = [rng.choice(_VOCAB) + " " for _ in range(n)]
+        words[0] = words[0].capitalize()
+        words[-1] = words[-1].rstrip() + "."
+        return self.ttft_ms.sample(rng) / 1000.0, words
+
+    def _offsets(self, ttft: float, n: int) -> List[float]:
+        # scheduled from the request start so sleep overshoot doesn't accumulate
+        gap = 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+        return [ttft + i * gap for i in range(n)]
+
+    def _count(self, n: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.tokens_sent += n
+
+    def stream(self, **params: Any) -> Generator[str, None, None]:
+        ttft, words = self.plan(**params)
+        self._count(len(words))
+        start = time.monotonic()
+        for offset, word in zip(self._offsets(ttft, len(words)), words):
+            wait = start + offset - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            yield word
+
+    async def astream(self, **params: Any) -> AsyncGenerator[str, None]:
+        ttft, words = self.plan(**params)
+        self._count(len(words))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for offset, word in zip(self._offsets(ttft, len(words)), words):
+            wait = start + offset - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield word
+
+    def complete(self, **params: Any) -> str:
+        return "".join(self.stream(**params)).strip()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "tokens": self.tokens_sent, "tokens_per_sec": self.tokens_per_sec,
+                "tokens_spec": self.tokens.spec, "ttft_ms_spec": self.ttft_ms.spec}
+
+
+def fake_provider_from_settings(**overrides: Any) -> FakeProvider:
+    kw: Dict[str, Any] = dict(
+        tokens=getattr(settings, "CHAT_FAKE_LLM_TOKENS", "200"),
+        tokens_per_sec=float(getattr(settings, "CHAT_FAKE_LLM_TOKENS_PER_SEC", 50.0)),
+        ttft_ms=getattr(settings, "CHAT_FAKE_LLM_TTFT_MS", "300"),
+        seed=int(getattr(settings, "CHAT_FAKE_LLM_SEED", 0)),
+    )
+    kw.update({k: v for k, v in overrides.items() if v is not None})
+    return FakeProvider(**kw)
+
+
+def _openai_compatible() -> LLMClientManager:
+    base_url = getattr(settings, "CHAT_LLM_BASE_URL", "")
+    if not base_url:
+        raise ValueError("CHAT_LLM_PROVIDER=openai-compatible needs CHAT_LLM_BASE_URL")
+    # local servers usually ignore the key, but the SDK insists on one
+    return _client_from_settings(base_url=base_url, api_key=getattr(settings, "CHAT_LLM_API_KEY", "") or "unused")
+
+
+_PROVIDERS = {
+    "openai": get_llm_client,
+    "openai-compatible": _openai_compatible,
+    "fake": fake_provider_from_settings,
+}
+
+_provider: Optional[LLMProvider] = None
+_provider_lock = threading.Lock()
+
+
+def get_llm_provider() -> LLMProvider:
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                name = getattr(settings, "CHAT_LLM_PROVIDER", "openai")
+                factory = _PROVIDERS.get(name) or import_string(name)
+                _provider = factory()
+    return _provider
+
+
+def set_llm_provider(provider: Optional[LLMProvider]) -> None:
+    """Swap the process-wide provider (benchmarks / tests); None re-reads settings on next use."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
@@ -0,0 +1,109 @@
+"""
+Local OpenAI-compatible HTTP server backed by a provider (normally FakeProvider).
+
+Serves POST /v1/chat/completions (streaming and not) and GET /v1/models, so the
+real pooled client path (CHAT_LLM_PROVIDER=openai-compatible) can be exercised
+end-to-end without network or spend. Run it with `manage.py fake_llm_server`.
+A provider can make a request fail with an HTTP status by raising StubHTTPError
+from complete() or stream() (before returning the deltas).
+"""
+
+from __future__ import annotations
+import json, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+
+class StubHTTPError(Exception):
+    """Answer the request with this status and an OpenAI-style error body."""
+
+    def __init__(self, status: int, message: str = "stub failure"):
+        super().__init__(message)
+        self.status = status
+
+
+def _chunk(model: str, delta: Dict[str, Any], finish_reason: Any = None) -> bytes:
+    payload = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+               "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real upstream
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            return self._send_json(404, {"error": {"message": "not found"}})
+        self._send_json(200, {"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "local"}]})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._send_json(404, {"error": {"message": "not found"}})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"message": "invalid JSON"}})
+        provider = self.server.provider
+        model = body.get("model") or "fake"
+        params = {k: body.get(k) for k in ("model", "messages", "temperature", "max_tokens")}
+        try:
+            text = provider.complete(**params) if not body.get("stream") else None
+            deltas = provider.stream(**params) if body.get("stream") else None
+        except StubHTTPError as e:
+            return self._send_json(e.status, {"error": {"message": str(e)}})
+        if not body.get("stream"):
+            return self._send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            })
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self._write_chunk(_chunk(model, {"role": "assistant", "content": ""}))
+            for delta in deltas:
+                self._write_chunk(_chunk(model, {"content": delta}))
+            self._write_chunk(_chunk(model, {}, "stop") + b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except OSError:
+            self.close_connection = True  # client hung up (e.g. a cancelled hedge)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up mid-stream on purpose (timeouts, losing hedges, closed generators)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_stub_server(provider: Any, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Bound (not yet serving) server; port 0 picks a free one (see server.server_port)."""
+    server = _Server((host, port), _Handler)
+    server.provider = provider
+    return server
+
+
+def start_stub_server(provider: Any, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """make_stub_server plus a daemon serving thread; call .shutdown() when done."""
+    server = make_stub_server(provider, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True, name="llm-stub").start()
+    return server
@@ -0,0 +1,83 @@
+from __future__ import annotations
+import time
+from typing import List, Optional
+from django.conf import settings
+from . import metrics
+from .token_budget import with_token_count
+
+
+class BufferedMessageWriter:
+    """
+    Save-as-you-go persistence for a streaming assistant Message.
+
+    Deltas are collected in a list and written to the row only when
+    `flush_ms` has elapsed or `flush_chars` characters are pending; callers
+    must call `finalize()` on completion, disconnect and error so nothing is lost.
+    Writes are timed into `trace` as the "save" stage.
+    """
+
+    def __init__(self, message, *, flush_ms: Optional[int] = None, flush_chars: Optional[int] = None,
+                 trace=metrics.NOOP):
+        self.message = message
+        self.trace = trace
+        self.flush_ms = int(getattr(settings, "CHAT_STREAM_FLUSH_MS", 250) if flush_ms is None else flush_ms)
+        self.flush_chars = int(getattr(settings, "CHAT_STREAM_FLUSH_CHARS", 512) if flush_chars is None else flush_chars)
+        self._parts: List[str] = [message.content] if message.content else []
+        self._pending = 0
+        self._last = time.monotonic()
+        self.writes = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def due(self) -> bool:
+        return self._pending >= self.flush_chars or (time.monotonic() - self._last) * 1000 >= self.flush_ms
+
+    def add(self, delta: str, *, autoflush: bool = True) -> bool:
+        """Buffer a delta; returns True when a flush is due (performed here unless autoflush=False)."""
+        if not delta:
+            return False
+        self._parts.append(delta)
+        self._pending += len(delta)
+        if not self.due():
+            return False
+        if autoflush:
+            self.flush()
+        return True
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        self.message.content = self.text
+        with self.trace.span("save"):
+            self.message.save(update_fields=["content"])
+        self._flushed()
+
+    async def aflush(self) -> None:
+        if not self._pending:
+            return
+        self.message.content = self.text
+        with self.trace.span("save"):
+            await self.message.asave(update_fields=["content"])
+        self._flushed()
+
+    def finalize(self) -> None:
+        """Last write: remaining deltas plus the reply's token count in meta (computed once)."""
+        self.message.content = self.text
+        self.message.meta = with_token_count(self.message.content, self.message.meta)
+        with self.trace.span("save"):
+            self.message.save(update_fields=["content", "meta"])
+        self._flushed()
+
+    async def afinalize(self) -> None:
+        self.message.content = self.text
+        self.message.meta = with_token_count(self.message.content, self.message.meta)
+        with self.trace.span("save"):
+            await self.message.asave(update_fields=["content", "meta"])
+        self._flushed()
+
+    def _flushed(self) -> None:
+        self._pending = 0
+        self._last = time.monotonic()
+        self.writes += 1
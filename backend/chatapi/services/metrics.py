@@ -0,0 +1,335 @@
+"""
+Per-reply timing spans and Prometheus-style metrics for the chat path.
+
+A streaming view opens a ReplyTrace (start_reply) once the caller is
+authenticated, labels it with the conversation's persona, records stage spans into it (auth, conversation, admission, insert, history, assets,
+retrieval, render, llm_first_token, save) and calls finish() when the stream
+ends, which folds everything into histograms labelled by persona. DB time and
+query count per reply come from an execute wrapper that charges queries to the
+trace active in the current context (sync_to_async carries it into the ORM
+thread).
+
+With CHAT_METRICS_ENABLED off (the default) start_reply returns NOOP, whose
+methods do nothing and whose span() is a shared nullcontext, and no DB wrapper
+is installed.
+
+render() emits the Prometheus text format (served on /metrics). Metrics are
+per process; with several workers, scrape each one or aggregate upstream.
+"""
+
+from __future__ import annotations
+import bisect, contextlib, threading, time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def enabled() -> bool:
+    return bool(getattr(settings, "CHAT_METRICS_ENABLED", False))
+
+
+def _fmt(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v))
+
+
+def _le(bound: float) -> str:
+    return 'le="%s"' % _fmt(bound)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ("persona",)):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # labels -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for labels, s in series:
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, s):
+                cumulative += n
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, _le(bound))} {_fmt(cumulative)}")
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, _le(float('inf')))} {_fmt(s[-2])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {_fmt(s[-2])}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_fmt(s[-1])}")
+        return out
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ("persona",)):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        out.extend(f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in series)
+        return out
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Time spent per stage of a chat reply.", LATENCY_BUCKETS, ("stage", "persona"))
+TTFT_SECONDS = Histogram("chat_time_to_first_token_seconds", "Request start to first token sent to the client.", LATENCY_BUCKETS)
+STREAM_SECONDS = Histogram("chat_stream_duration_seconds", "Request start to end of the reply stream.", LATENCY_BUCKETS)
+TOKENS_STREAMED = Histogram("chat_stream_tokens", "Token deltas streamed per reply.", TOKEN_BUCKETS)
+PROMPT_TOKENS = Histogram("chat_prompt_tokens", "Estimated tokens sent upstream per reply (system, summary, history, prompt).", TOKEN_BUCKETS)
+DB_SECONDS = Histogram("chat_db_seconds", "Database time per reply.", LATENCY_BUCKETS)
+DB_QUERIES = Histogram("chat_db_queries", "Database queries per reply.", COUNT_BUCKETS)
+REPLIES = Counter("chat_replies_total", "Chat replies by outcome (ok, cached, error, cancelled).", ("persona", "outcome"))
+CANCELLED = Counter("chat_cancelled_replies_total", "Replies stopped early: client (cancel endpoint) or disconnect (no viewers left).", ("persona", "reason"))
+TOKENS_SAVED = Counter("chat_cancelled_tokens_saved_total",
+                       "Estimated output tokens not generated thanks to cancellation: the persona's mean completed "
+                       "reply length minus what was streamed before the cancel.", ("persona", "reason"))
+RESPONSE_CACHE = Counter("chat_response_cache_total",
+                         "Reply cache lookups by result (hit, miss, bypassed) and stores (store); "
+                         "hit rate = hit / (hit + miss).", ("result",))
+ADMISSION_REJECTED = Counter("chat_admission_rejected_total",
+                             "Chat requests answered 429 by admission control (rate, user_queue, queue_full, timeout).", ("reason",))
+REGISTRY = [STAGE_SECONDS, TTFT_SECONDS, STREAM_SECONDS, TOKENS_STREAMED, PROMPT_TOKENS, DB_SECONDS, DB_QUERIES, REPLIES,
+            CANCELLED, TOKENS_SAVED, RESPONSE_CACHE, ADMISSION_REJECTED]
+
+# persona -> [completed replies, tokens]: the baseline for TOKENS_SAVED
+_completed: Dict[str, List[float]] = {}
+_completed_lock = threading.Lock()
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def reset() -> None:
+    for metric in REGISTRY:
+        metric.clear()
+    with _completed_lock:
+        _completed.clear()
+
+
+def _tokens_saved(persona: str, tokens: int) -> Optional[float]:
+    with _completed_lock:
+        n, total = _completed.get(persona, (0, 0.0))
+    return max(0.0, total / n - tokens) if n else None
+
+
+# ---------- per-reply trace ----------
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _NoopTrace:
+    """Stand-in when metrics are off: every hook is a cheap no-op."""
+    __slots__ = ()
+    outcome = "ok"
+
+    def __bool__(self) -> bool:
+        return False
+
+    def span(self, stage: str):
+        return _NULL_SPAN
+
+    def add(self, stage: str, seconds: float) -> None:
+        pass
+
+    def first_token(self) -> None:
+        pass
+
+    def set(self, **kw) -> None:
+        pass
+
+    def finish(self, tokens: int = 0) -> None:
+        pass
+
+    def discard(self) -> None:
+        pass
+
+
+NOOP = _NoopTrace()
+_current: ContextVar[Optional["ReplyTrace"]] = ContextVar("chat_reply_trace", default=None)
+
+
+class ReplyTrace:
+    __slots__ = ("persona", "started", "spans", "ttft", "prompt_tokens", "outcome", "cancelled", "db_seconds", "queries",
+                 "done")
+
+    def __init__(self, persona: str, started: Optional[float] = None):
+        self.persona = persona
+        self.started = time.perf_counter() if started is None else started
+        self.spans: Dict[str, float] = {}
+        self.ttft: Optional[float] = None
+        self.prompt_tokens = 0
+        self.outcome = "ok"
+        self.cancelled: Optional[str] = None  # reason, when the reply was stopped early
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.done = False
+
+    def __bool__(self) -> bool:
+        return True
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def set(self, **kw) -> None:
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    def discard(self) -> None:
+        """Drop a trace without recording it (request rejected before a reply started)."""
+        self.done = True
+        if _current.get() is self:
+            _current.set(None)
+
+    def finish(self, tokens: int = 0) -> None:
+        if self.done:
+            return
+        self.discard()
+        p = self.persona
+        for stage, seconds in self.spans.items():
+            STAGE_SECONDS.observe(seconds, stage, p)
+        if self.ttft is not None:
+            TTFT_SECONDS.observe(self.ttft, p)
+        STREAM_SECONDS.observe(time.perf_counter() - self.started, p)
+        TOKENS_STREAMED.observe(tokens, p)
+        if self.prompt_tokens:
+            PROMPT_TOKENS.observe(self.prompt_tokens, p)
+        DB_SECONDS.observe(self.db_seconds, p)
+        DB_QUERIES.observe(self.queries, p)
+        if self.cancelled:
+            REPLIES.inc(p, "cancelled")
+            CANCELLED.inc(p, self.cancelled)
+            saved = _tokens_saved(p, tokens)
+            if saved is not None:
+                TOKENS_SAVED.inc(p, self.cancelled, amount=saved)
+            return
+        REPLIES.inc(p, self.outcome)
+        if self.outcome in ("ok", "cached"):
+            with _completed_lock:
+                c = _completed.setdefault(p, [0, 0.0])
+                c[0] += 1
+                c[1] += tokens
+
+
+def start_reply(persona: str = "unknown", started: Optional[float] = None):
+    """Trace for one reply (NOOP when metrics are off); activate() it to charge DB time to it."""
+    if not enabled():
+        return NOOP
+    _install_db_wrapper()
+    from django.db import connection
+    _instrument(connection=connection)  # this thread's connection may predate the signal hookup
+    return ReplyTrace(persona, started)
+
+
+def activate(trace):
+    """
+    Make `trace` current in this context for DB accounting; returns the token for
+    deactivate(). Request threads are reused, so a view must deactivate before it
+    returns (the producer keeps the trace current in its own copy of the context).
+    """
+    return _current.set(trace) if trace else None
+
+
+def deactivate(token) -> None:
+    if token is not None:
+        _current.reset(token)
+
+
+def current():
+    return _current.get() or NOOP
+
+
+def response_cache(result: str) -> None:
+    if enabled():
+        RESPONSE_CACHE.inc(result)
+
+
+def admission_rejected(reason: str) -> None:
+    if enabled():
+        ADMISSION_REJECTED.inc(reason)
+
+
+# ---------- DB accounting ----------
+
+def _db_wrapper(execute, sql, params, many, context):
+    trace = _current.get()
+    if trace is None or trace.done:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.db_seconds += time.perf_counter() - t0
+        trace.queries += 1
+
+
+def _instrument(sender=None, connection=None, **kwargs):
+    # connection_created fires again when a closed wrapper reconnects; don't stack
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _install_db_wrapper() -> None:
+    global _installed
+    if _installed:
+        return
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    with _install_lock:
+        if _installed:
+            return
+        connection_created.connect(_instrument)
+        for conn in connections.all(initialized_only=True):
+            _instrument(connection=conn)
+        _installed = True
@@ -0,0 +1,226 @@
+"""
+Background generation for chat replies.
+
+The stream view creates the assistant placeholder and hands the reply to
+`start` (thread pool, sync) or `astart` (asyncio task, ASGI). The producer
+streams tokens from the LLM, saves them to the Message as they arrive and
+publishes coalesced frames to the reply's channel (replay.py). The HTTP
+response is only a subscriber to that channel, like any other tab watching the
+same reply through GET /api/chat/<message_id>/stream. A browser going away no
+longer stops or loses the generation.
+
+Sync producers run on a pool of CHAT_PRODUCER_WORKERS threads, so that many
+replies generate at once per process and the rest wait for a free thread.
+Async producers are tasks on the server's event loop and hold no thread.
+
+A reply stops early, closing the upstream request so no more output is
+billed, when `cancel` is called for it (POST /api/chat/<message_id>/cancel,
+from any process sharing the channel) or when it has had no viewers for
+CHAT_DISCONNECT_GRACE seconds (negative: always finish). Stopped replies are
+saved as far as they got with meta.cancelled. Sync producers notice at the
+next token; async ones cancelled in-process stop at once.
+
+A reply holds the admission lease it was started with (admission.py) until it
+has been saved, so stopping a reply also frees its user's slot.
+"""
+
+from __future__ import annotations
+import asyncio, contextvars, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+from django.conf import settings
+from django.db import close_old_connections
+from . import admission, conversation_stats, metrics, replay, sse
+from .bot_service import astream_tokens, stream_tokens
+from .message_writer import BufferedMessageWriter
+from .summarizer import schedule_summary
+
+log = logging.getLogger(__name__)
+
+
+class Reply:
+    """Everything a producer needs; built by the view before the response starts."""
+    __slots__ = ("conversation", "message", "prompt", "history", "trace", "lease")
+
+    def __init__(self, conversation, message, prompt: str, history: List[Dict[str, Any]], trace=metrics.NOOP,
+                 lease: Optional[admission.Lease] = None):
+        self.conversation = conversation
+        self.message = message
+        self.prompt = prompt
+        self.history = history
+        self.trace = trace
+        self.lease = lease
+
+
+class _Job:
+    """A reply being generated in this process."""
+    __slots__ = ("reason", "next_check", "task", "loop")
+
+    def __init__(self, task: Optional[asyncio.Task] = None):
+        self.reason: Optional[str] = None
+        self.next_check = 0.0
+        self.task = task
+        self.loop = task.get_loop() if task is not None else None
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+_jobs: Dict[int, _Job] = {}
+_tasks: Set[asyncio.Task] = set()  # strong refs: the loop only keeps weak ones
+_CHECK_EVERY = 0.25  # seconds between reads of the channel's signals
+
+
+def cancel(message_id: int) -> None:
+    """Stop a running reply; a no-op once it has finished."""
+    job = _jobs.get(message_id)
+    if job is not None:
+        job.reason = job.reason or "client"
+        if job.task is not None:
+            job.loop.call_soon_threadsafe(_cancel_task, message_id, job)
+    replay.get_replay_buffer().request_cancel(message_id)  # the producer may be another process
+
+
+def _cancel_task(message_id: int, job: _Job) -> None:
+    # on the loop: only while still generating, never once the task is saving the reply
+    if _jobs.get(message_id) is job:
+        job.task.cancel()
+
+
+def _due(job: _Job) -> bool:
+    """Time to read the channel's signals again (at most every _CHECK_EVERY)."""
+    now = time.monotonic()
+    if now < job.next_check:
+        return False
+    job.next_check = now + _CHECK_EVERY
+    return True
+
+
+def _decide(job: _Job, signals: Tuple[bool, Optional[float]]) -> Optional[str]:
+    cancelled, orphaned = signals
+    grace = float(getattr(settings, "CHAT_DISCONNECT_GRACE", 10))
+    if cancelled:
+        job.reason = "client"
+    elif orphaned is not None and grace >= 0 and time.time() - orphaned >= grace:
+        job.reason = "disconnect"
+    return job.reason
+
+
+def _mark_cancelled(message, trace, reason: str) -> None:
+    message.meta = dict(message.meta or {}, cancelled=True)
+    trace.set(cancelled=reason)
+
+
+def start(reply: Reply) -> None:
+    """Open the reply's channel and generate it on the producer pool."""
+    global _executor
+    replay.get_replay_buffer().open(reply.message.id)
+    _jobs[reply.message.id] = _Job()
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(getattr(settings, "CHAT_PRODUCER_WORKERS", 32)),
+                                           thread_name_prefix="chat-producer")
+    # copy the context so the reply trace stays current (DB accounting) on the pool thread
+    _executor.submit(contextvars.copy_context().run, _produce, reply)
+
+
+async def astart(reply: Reply) -> None:
+    """Open the reply's channel and generate it as a task on the running loop."""
+    await replay.get_replay_buffer().aopen(reply.message.id)
+    task = asyncio.create_task(_aproduce(reply))
+    _jobs[reply.message.id] = _Job(task)  # before the task first runs
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _produce(reply: Reply) -> None:
+    buffer, trace, message = replay.get_replay_buffer(), reply.trace, reply.message
+    conv = reply.conversation
+    writer = BufferedMessageWriter(message, trace=trace)
+    count = 0
+    status = replay.INTERRUPTED
+
+    def deltas():
+        nonlocal count
+        for tok in stream_tokens(reply.prompt, persona=conv.character or "Bronn", history=reply.history, summary=conv.summary):
+            if not count:
+                trace.first_token()
+            count += 1
+            yield tok
+
+    job = _jobs.get(message.id) or _Job()
+    frames = sse.coalesce(deltas())
+    try:
+        for chunk in frames:
+            writer.add(chunk)
+            buffer.publish(message.id, chunk)
+            if job.reason or (_due(job) and _decide(job, buffer.signals(message.id))):
+                break
+        else:
+            status = replay.COMPLETE
+    except Exception as e:
+        log.exception("Generating reply %s failed: %s", message.id, e)
+    finally:
+        _jobs.pop(message.id, None)
+        frames.close()  # on an early stop this closes the upstream request
+        if job.reason and status != replay.COMPLETE:
+            status = replay.CANCELLED
+            _mark_cancelled(message, trace, job.reason)
+        try:
+            writer.finalize()
+            conversation_stats.reply_finished(message)
+        except Exception as e:
+            log.exception("Saving reply %s failed: %s", message.id, e)
+        trace.finish(tokens=count)
+        schedule_summary(conv.id)
+        admission.get_admission().release(reply.lease)
+        # last: once subscribers see the end, the row is final and the reply fully accounted for
+        buffer.close(message.id, status)
+        close_old_connections()
+
+
+async def _aproduce(reply: Reply) -> None:
+    buffer, trace, message = replay.get_replay_buffer(), reply.trace, reply.message
+    conv = reply.conversation
+    writer = BufferedMessageWriter(message, trace=trace)
+    count = 0
+    status = replay.INTERRUPTED
+
+    async def deltas():
+        nonlocal count
+        async for tok in astream_tokens(reply.prompt, persona=conv.character or "Bronn", history=reply.history, summary=conv.summary):
+            if not count:
+                trace.first_token()
+            count += 1
+            yield tok
+
+    job = _jobs.get(message.id) or _Job()
+    frames = sse.acoalesce(deltas())
+    try:
+        async for chunk in frames:
+            if writer.add(chunk, autoflush=False):
+                await writer.aflush()
+            await buffer.apublish(message.id, chunk)
+            if job.reason or (_due(job) and _decide(job, await buffer.asignals(message.id))):
+                break
+        else:
+            status = replay.COMPLETE
+    except asyncio.CancelledError:
+        if not job.reason:  # not ours (server shutting down): still save what we have below
+            raise
+    except Exception as e:
+        log.exception("Generating reply %s failed: %s", message.id, e)
+    finally:
+        _jobs.pop(message.id, None)  # first: no task.cancel() may land while we save
+        await frames.aclose()
+        if job.reason and status != replay.COMPLETE:
+            status = replay.CANCELLED
+            _mark_cancelled(message, trace, job.reason)
+        try:
+            await writer.afinalize()
+            await conversation_stats.areply_finished(message)
+        except Exception as e:
+            log.exception("Saving reply %s failed: %s", message.id, e)
+        trace.finish(tokens=count)
+        schedule_summary(conv.id)
+        await admission.get_admission().arelease(reply.lease)
+        await buffer.aclose(message.id, status)
@@ -0,0 +1,401 @@
+"""
+Per-reply channels: short-lived replay buffers that viewers follow.
+
+Every token frame carries `id: <end offset>`: how many characters of the reply
+have been sent up to and including that frame. The reply's producer
+(producer.py) publishes each frame here; every HTTP stream of the reply is a
+subscriber. GET /api/chat/<message_id>/stream with Last-Event-ID (header, or
+?last_event_id= where the client can't set headers) replays the frames after
+that offset, then follows the generation until it ends, instead of the client
+re-POSTing and paying for a second one.
+
+Backends (CHAT_REPLAY_BACKEND):
+    local  in-process ring of the last CHAT_REPLAY_MAX_FRAMES frames per reply;
+           followers are woken on each frame. Only the process running the
+           generation can resume it (the default; fine for a single worker).
+    cache  Django cache alias CHAT_REPLAY_CACHE_ALIAS, shared by every worker;
+           followers poll every CHAT_REPLAY_POLL_MS.
+    or a dotted path to a ReplayBuffer subclass (e.g. a Redis pub/sub broker),
+    constructed with ttl= and poll_ms=.
+
+A buffer expires CHAT_REPLAY_TTL seconds after its last frame. When the frames
+a client needs are gone, `Unavailable` is raised and the caller falls back to
+the Message row.
+
+The channel also carries control signals back to the producer: viewers
+`join`/`leave` (the last one leaving marks the reply orphaned) and
+`request_cancel` (POST /api/chat/<message_id>/cancel); the producer reads both
+with `signals`.
+"""
+
+from __future__ import annotations
+import asyncio, importlib, itertools, threading, time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+COMPLETE, INTERRUPTED, CANCELLED = "complete", "interrupted", "cancelled"
+
+Frame = Tuple[int, str]  # (end offset, text)
+
+
+class Unavailable(LookupError):
+    """The frames needed to resume this reply are not (or no longer) buffered."""
+
+
+class Snapshot(NamedTuple):
+    frames: List[Frame]
+    cursor: int             # sequence number of the next frame; pass back to read only newer ones
+    status: Optional[str]   # None while the reply is still being generated
+
+
+def _after(frames: List[Frame], start: int, after: int) -> List[Frame]:
+    """Frames (or the tail of the frame) past offset `after`; `start` is where frames[0] begins."""
+    out = []
+    for end, text in frames:
+        if end > after:
+            out.append((end, text[max(0, after - start):]))
+        start = end
+    return out
+
+
+class ReplayBuffer:
+    """
+    Backend-independent follow loop; subclasses store frames and implement
+    `_read`. The base class buffers nothing, so every follow is Unavailable.
+    """
+
+    def __init__(self, *, ttl: int = 300, poll_ms: int = 50):
+        self.ttl = int(ttl)
+        self.poll = max(1, int(poll_ms)) / 1000
+
+    def open(self, message_id: int) -> None:
+        pass
+
+    def publish(self, message_id: int, text: str) -> None:
+        pass
+
+    def close(self, message_id: int, status: str = COMPLETE) -> None:
+        pass
+
+    async def aopen(self, message_id: int) -> None:
+        await sync_to_async(self.open)(message_id)
+
+    async def apublish(self, message_id: int, text: str) -> None:
+        await sync_to_async(self.publish)(message_id, text)
+
+    async def aclose(self, message_id: int, status: str = COMPLETE) -> None:
+        await sync_to_async(self.close)(message_id, status)
+
+    def join(self, message_id: int) -> None:
+        pass
+
+    def leave(self, message_id: int) -> None:
+        pass
+
+    def request_cancel(self, message_id: int) -> None:
+        pass
+
+    def signals(self, message_id: int) -> Tuple[bool, Optional[float]]:
+        """(cancel requested, time.time() the last viewer left or None while someone is watching)."""
+        return False, None
+
+    async def ajoin(self, message_id: int) -> None:
+        await sync_to_async(self.join)(message_id)
+
+    async def aleave(self, message_id: int) -> None:
+        await sync_to_async(self.leave)(message_id)
+
+    async def asignals(self, message_id: int) -> Tuple[bool, Optional[float]]:
+        return await sync_to_async(self.signals)(message_id)
+
+    def _read(self, message_id: int, after: int, cursor: Optional[int]) -> Optional[Snapshot]:
+        """Frames past offset `after` (cursor None) or from sequence `cursor` on; None when not buffered."""
+        return None
+
+    async def _aread(self, message_id: int, after: int, cursor: Optional[int]) -> Optional[Snapshot]:
+        return await sync_to_async(self._read)(message_id, after, cursor)
+
+    def _wait(self, message_id: int, cursor: int) -> None:
+        time.sleep(self.poll)
+
+    async def _await(self, message_id: int, cursor: int) -> None:
+        await asyncio.sleep(self.poll)
+
+    def follow(self, message_id: int, after: int = 0) -> Iterator[Snapshot]:
+        """
+        Yield what was sent after offset `after`, then each new batch of frames
+        until a snapshot with a status (the reply ended). Raises Unavailable if
+        the frames are not buffered, or the buffer goes quiet for `ttl` seconds
+        without being closed (the generating process died).
+        """
+        snap = self._read(message_id, after, None)
+        idle = time.monotonic()
+        while True:
+            if snap is None:
+                raise Unavailable(message_id)
+            if snap.frames or snap.status:
+                yield snap
+                if snap.status:
+                    return
+                idle = time.monotonic()
+            elif time.monotonic() - idle > self.ttl:
+                raise Unavailable(message_id)
+            self._wait(message_id, snap.cursor)
+            snap = self._read(message_id, after, snap.cursor)
+
+    async def afollow(self, message_id: int, after: int = 0) -> AsyncIterator[Snapshot]:
+        snap = await self._aread(message_id, after, None)
+        idle = time.monotonic()
+        while True:
+            if snap is None:
+                raise Unavailable(message_id)
+            if snap.frames or snap.status:
+                yield snap
+                if snap.status:
+                    return
+                idle = time.monotonic()
+            elif time.monotonic() - idle > self.ttl:
+                raise Unavailable(message_id)
+            await self._await(message_id, snap.cursor)
+            snap = await self._aread(message_id, after, snap.cursor)
+
+
+class _Ring:
+    __slots__ = ("frames", "first", "start", "end", "status", "touched", "waiters", "viewers", "orphaned", "cancel")
+
+    def __init__(self, max_frames: int):
+        self.frames: Deque[Frame] = deque()
+        self.first = 0       # sequence number of frames[0]
+        self.start = 0       # offset frames[0] begins at (> 0 once the ring has wrapped)
+        self.end = 0
+        self.status: Optional[str] = None
+        self.touched = time.monotonic()
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self.viewers = 0
+        self.orphaned: Optional[float] = None
+        self.cancel = False
+
+
+class LocalReplayBuffer(ReplayBuffer):
+    """Per-process ring buffers; sync followers wait on a Condition, async ones on an Event."""
+
+    def __init__(self, *, max_frames: int = 4096, **kw):
+        super().__init__(**kw)
+        self.max_frames = max(1, int(max_frames))
+        self._rings: Dict[int, _Ring] = {}
+        self._cond = threading.Condition()
+
+    def open(self, message_id: int) -> None:
+        with self._cond:
+            self._purge()
+            self._rings[message_id] = _Ring(self.max_frames)
+
+    def publish(self, message_id: int, text: str) -> None:
+        if not text:
+            return
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is None:
+                ring = self._rings[message_id] = _Ring(self.max_frames)
+            ring.end += len(text)
+            ring.frames.append((ring.end, text))
+            if len(ring.frames) > self.max_frames:
+                ring.start = ring.frames.popleft()[0]
+                ring.first += 1
+            self._wake(ring)
+
+    def close(self, message_id: int, status: str = COMPLETE) -> None:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is not None:
+                ring.status = status
+                self._wake(ring)
+
+    async def aopen(self, message_id: int) -> None:
+        self.open(message_id)
+
+    async def apublish(self, message_id: int, text: str) -> None:
+        self.publish(message_id, text)
+
+    async def aclose(self, message_id: int, status: str = COMPLETE) -> None:
+        self.close(message_id, status)
+
+    def join(self, message_id: int) -> None:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is not None:
+                ring.viewers += 1
+                ring.orphaned = None
+
+    def leave(self, message_id: int) -> None:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is not None:
+                ring.viewers -= 1
+                if ring.viewers <= 0:
+                    ring.orphaned = time.time()
+
+    def request_cancel(self, message_id: int) -> None:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is not None:
+                ring.cancel = True
+
+    def signals(self, message_id: int) -> Tuple[bool, Optional[float]]:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            return (False, None) if ring is None else (ring.cancel, ring.orphaned)
+
+    async def ajoin(self, message_id: int) -> None:
+        self.join(message_id)
+
+    async def aleave(self, message_id: int) -> None:
+        self.leave(message_id)
+
+    async def asignals(self, message_id: int) -> Tuple[bool, Optional[float]]:
+        return self.signals(message_id)
+
+    def _wake(self, ring: _Ring) -> None:
+        ring.touched = time.monotonic()
+        self._cond.notify_all()
+        for loop, event in ring.waiters:
+            loop.call_soon_threadsafe(event.set)
+        ring.waiters.clear()
+
+    def _purge(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        for message_id in [k for k, r in self._rings.items() if r.touched < cutoff]:
+            del self._rings[message_id]
+
+    def _pending(self, ring: Optional[_Ring], cursor: int) -> bool:
+        return ring is not None and ring.status is None and ring.first + len(ring.frames) <= cursor
+
+    def _read(self, message_id: int, after: int, cursor: Optional[int]) -> Optional[Snapshot]:
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if ring is None:
+                return None
+            nxt = ring.first + len(ring.frames)
+            if cursor is None:
+                if after < ring.start:  # the frames it missed have rotated out
+                    return None
+                return Snapshot(_after(list(ring.frames), ring.start, after), nxt, ring.status)
+            if cursor < ring.first:  # follower fell more than max_frames behind
+                return None
+            return Snapshot(list(itertools.islice(ring.frames, cursor - ring.first, None)), nxt, ring.status)
+
+    async def _aread(self, message_id: int, after: int, cursor: Optional[int]) -> Optional[Snapshot]:
+        return self._read(message_id, after, cursor)
+
+    def _wait(self, message_id: int, cursor: int) -> None:
+        with self._cond:
+            if self._pending(self._rings.get(message_id), cursor):
+                self._cond.wait(1.0)
+
+    async def _await(self, message_id: int, cursor: int) -> None:
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._cond:
+            ring = self._rings.get(message_id)
+            if not self._pending(ring, cursor):
+                return
+            ring.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), 1.0)
+        except asyncio.TimeoutError:
+            with self._cond:
+                if waiter in ring.waiters:
+                    ring.waiters.remove(waiter)
+
+
+class CacheReplayBuffer(ReplayBuffer):
+    """
+    Frames in a Django cache: `chatreplay:<id>` holds (next seq, end, status),
+    `chatreplay:<id>:<seq>` each (end, text). The frame is written before the
+    state that points at it, so readers never see a hole unless the cache evicted it.
+    Signals: `chatreplay:<id>:viewers` (incr/decr), `:orphaned` and `:cancel`.
+    """
+
+    def __init__(self, *, alias: str = "default", **kw):
+        super().__init__(**kw)
+        self.alias = alias
+        self._state: Dict[int, Tuple[int, int]] = {}  # replies generated by this process: id -> (next seq, end)
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def open(self, message_id: int) -> None:
+        self._state[message_id] = (0, 0)
+        self._cache.set(f"chatreplay:{message_id}", (0, 0, None), timeout=self.ttl)
+
+    def publish(self, message_id: int, text: str) -> None:
+        if not text:
+            return
+        seq, end = self._state.get(message_id, (0, 0))
+        end += len(text)
+        self._cache.set(f"chatreplay:{message_id}:{seq}", (end, text), timeout=self.ttl)
+        self._cache.set(f"chatreplay:{message_id}", (seq + 1, end, None), timeout=self.ttl)
+        self._state[message_id] = (seq + 1, end)
+
+    def close(self, message_id: int, status: str = COMPLETE) -> None:
+        seq, end = self._state.pop(message_id, (0, 0))
+        self._cache.set(f"chatreplay:{message_id}", (seq, end, status), timeout=self.ttl)
+
+    def join(self, message_id: int) -> None:
+        key = f"chatreplay:{message_id}:viewers"
+        self._cache.add(key, 0, timeout=self.ttl)
+        self._cache.incr(key)
+        self._cache.delete(f"chatreplay:{message_id}:orphaned")
+
+    def leave(self, message_id: int) -> None:
+        try:
+            left = self._cache.decr(f"chatreplay:{message_id}:viewers")
+        except ValueError:  # expired
+            left = 0
+        if left <= 0:
+            self._cache.set(f"chatreplay:{message_id}:orphaned", time.time(), timeout=self.ttl)
+
+    def request_cancel(self, message_id: int) -> None:
+        self._cache.set(f"chatreplay:{message_id}:cancel", True, timeout=self.ttl)
+
+    def signals(self, message_id: int) -> Tuple[bool, Optional[float]]:
+        found = self._cache.get_many([f"chatreplay:{message_id}:cancel", f"chatreplay:{message_id}:orphaned"])
+        return bool(found.get(f"chatreplay:{message_id}:cancel")), found.get(f"chatreplay:{message_id}:orphaned")
+
+    def _read(self, message_id: int, after: int, cursor: Optional[int]) -> Optional[Snapshot]:
+        state = self._cache.get(f"chatreplay:{message_id}")
+        if state is None:
+            return None
+        nxt, _, status = state
+        keys = [f"chatreplay:{message_id}:{i}" for i in range(cursor or 0, nxt)]
+        found = self._cache.get_many(keys) if keys else {}
+        if len(found) != len(keys):
+            return None
+        frames = [tuple(found[k]) for k in keys]
+        if cursor is None:
+            frames = _after(frames, 0, after)
+        return Snapshot(frames, nxt, status)
+
+
+def _build_from_settings() -> ReplayBuffer:
+    name = getattr(settings, "CHAT_REPLAY_BACKEND", "local")
+    kw = {"ttl": getattr(settings, "CHAT_REPLAY_TTL", 300), "poll_ms": getattr(settings, "CHAT_REPLAY_POLL_MS", 50)}
+    if name == "cache":
+        return CacheReplayBuffer(alias=getattr(settings, "CHAT_REPLAY_CACHE_ALIAS", "default"), **kw)
+    if "." in name:
+        module, _, attr = name.rpartition(".")
+        return getattr(importlib.import_module(module), attr)(**kw)
+    return LocalReplayBuffer(max_frames=getattr(settings, "CHAT_REPLAY_MAX_FRAMES", 4096), **kw)
+
+
+_buffer: Optional[ReplayBuffer] = None
+
+def get_replay_buffer() -> ReplayBuffer:
+    global _buffer
+    if _buffer is None:
+        _buffer = _build_from_settings()
+    return _buffer
@@ -0,0 +1,158 @@
+"""
+Exact-match cache for LLM replies.
+
+Keyed by sha256(model, temperature, assembled messages). Values are the list of
+deltas as streamed, so a hit can be replayed through the same SSE `token` events.
+Sampling at high temperature is meant to vary, so those requests bypass the cache.
+Lookups and stores are counted in stats() and, with metrics on, in
+chat_response_cache_total on /metrics.
+"""
+
+from __future__ import annotations
+import hashlib, json, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from . import metrics
+
+
+def cache_key(model: str, temperature: float, messages: List[Dict[str, str]]) -> str:
+    raw = json.dumps([model, round(float(temperature), 4), messages], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return "chatreply:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU with per-entry TTL."""
+
+    def __init__(self, *, max_entries: int = 1024):
+        self.max_entries = max(1, int(max_entries))
+        self._items: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: List[str], ttl: int) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class DjangoCacheBackend:
+    """Shares entries across workers through a configured Django cache alias (eviction is the cache's job)."""
+
+    def __init__(self, *, alias: str = "default"):
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key: str) -> Optional[List[str]]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: List[str], ttl: int) -> None:
+        self._cache.set(key, value, timeout=ttl)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class ResponseCache:
+    def __init__(self, backend, *, ttl: int = 3600, max_temperature: float = 0.5, enabled: bool = True):
+        self.backend = backend
+        self.ttl = int(ttl)
+        self.max_temperature = float(max_temperature)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.bypassed = self.stores = 0
+
+    def key_for(self, model: str, temperature: float, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Cache key, or None when this request must not use the cache."""
+        if not self.enabled:
+            return None
+        if float(temperature) > self.max_temperature:
+            self._count("bypassed")
+            return None
+        return cache_key(model, temperature, messages)
+
+    def get(self, key: str) -> Optional[List[str]]:
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            value = None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, deltas: List[str]) -> None:
+        if not deltas:
+            return
+        try:
+            self.backend.set(key, list(deltas), self.ttl)
+            self._count("stores")
+        except Exception:
+            pass
+
+    async def aget(self, key: str) -> Optional[List[str]]:
+        if isinstance(self.backend, MemoryBackend):
+            return self.get(key)
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key: str, deltas: List[str]) -> None:
+        if isinstance(self.backend, MemoryBackend):
+            return self.set(key, deltas)
+        await sync_to_async(self.set)(key, deltas)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            looked_up = self.hits + self.misses
+            return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses,
+                    "bypassed": self.bypassed, "stores": self.stores,
+                    "hit_rate": (self.hits / looked_up) if looked_up else 0.0}
+
+    _RESULTS = {"hits": "hit", "misses": "miss", "bypassed": "bypassed", "stores": "store"}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+        metrics.response_cache(self._RESULTS[name])
+
+
+def _build_from_settings() -> ResponseCache:
+    backend_name = getattr(settings, "CHAT_CACHE_BACKEND", "memory")
+    if backend_name == "django":
+        backend: Any = DjangoCacheBackend(alias=getattr(settings, "CHAT_CACHE_ALIAS", "default"))
+    else:
+        backend = MemoryBackend(max_entries=getattr(settings, "CHAT_CACHE_MAX_ENTRIES", 1024))
+    return ResponseCache(
+        backend,
+        ttl=getattr(settings, "CHAT_CACHE_TTL", 3600),
+        max_temperature=getattr(settings, "CHAT_CACHE_MAX_TEMPERATURE", 0.5),
+        enabled=getattr(settings, "CHAT_CACHE_ENABLED", False),
+    )
+
+
+_cache: Optional[ResponseCache] = None
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = _build_from_settings()
+    return _cache
@@ -0,0 +1,181 @@
+"""
+Full-text search over a user's messages.
+
+Backends:
+- "sqlite": FTS5 table `chatapi_message_fts` over chatapi_message_search, the
+  finished messages with their owner, kept in sync by triggers (migration 0009);
+  ranked by bm25. The owner is an indexed column, so only the requesting user's
+  hits are ranked. Replies are indexed once finished.
+- "postgres": GIN index on to_tsvector('english', content); ranked by ts_rank_cd.
+  Like "sqlite", only finished messages (a token count in meta) are matched.
+- "icontains": the old LIKE '%q%' scan, newest first; used when nothing better exists.
+
+All return the content plus a highlighted snippet and paginate with an opaque
+keyset cursor (rank, id) instead of OFFSET.
+"""
+
+from __future__ import annotations
+import base64, json, re, uuid
+from datetime import timezone as dt_timezone
+from typing import Any, Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from ..models import Message
+
+MAX_PAGE_SIZE = 50
+SNIPPET_TOKENS = 12
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+Rows = List[Dict[str, Any]]
+
+
+def encode_cursor(rank: Any, pk: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([rank, pk]).encode()).decode()
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[Any, int]]:
+    if not cursor:
+        return None
+    try:
+        rank, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return rank, int(pk)
+    except Exception:
+        raise InvalidCursor("invalid cursor")
+
+
+def _page(rows: Rows, limit: int, rank_key: str) -> Tuple[Rows, Optional[str]]:
+    # one extra row was fetched to know whether another page exists
+    more = len(rows) > limit
+    rows = rows[:limit]
+    ranks = [r.pop(rank_key) for r in rows]
+    return rows, (encode_cursor(ranks[-1], rows[-1]["id"]) if more else None)
+
+
+# the owner column only filters; it must not affect relevance
+_BM25 = "bm25(chatapi_message_fts, 1.0, 0.0)"
+
+
+class SqliteFtsBackend:
+    name = "sqlite"
+
+    @staticmethod
+    def _match_expr(q: str, owner_id) -> str:
+        # quote every term so user input can't inject FTS5 syntax; last term is a prefix match
+        words = _WORD_RE.findall(q)
+        if not words:
+            return ""
+        terms = ['"%s"' % w.replace('"', '""') for w in words]
+        terms[-1] += "*"
+        return 'owner : "u%s" AND content : (%s)' % (owner_id, " ".join(terms))
+
+    def search_messages(self, user, q: str, *, limit: int, cursor: Optional[str] = None) -> Tuple[Rows, Optional[str]]:
+        match = self._match_expr(q, user.pk)
+        if not match:
+            return [], None
+        after = decode_cursor(cursor)
+        sql = [
+            "SELECT m.id, m.conversation_id, m.role, m.created_at, m.content,",
+            f" snippet(chatapi_message_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,",
+            f" {_BM25} AS _rank",
+            " FROM chatapi_message_fts",
+            " JOIN chatapi_message m ON m.id = chatapi_message_fts.rowid",
+            " WHERE chatapi_message_fts MATCH %s",
+        ]
+        params: List[Any] = [match]
+        if after:
+            # bm25: lower is better
+            sql.append(f" AND ({_BM25} > %s OR ({_BM25} = %s AND m.id > %s))")
+            params += [after[0], after[0], after[1]]
+        sql.append(" ORDER BY _rank, m.id LIMIT %s")
+        params.append(limit + 1)
+        return _page(_fetch(sql, params), limit, "_rank")
+
+
+class PostgresFtsBackend:
+    name = "postgres"
+
+    def search_messages(self, user, q: str, *, limit: int, cursor: Optional[str] = None) -> Tuple[Rows, Optional[str]]:
+        if not _WORD_RE.search(q):
+            return [], None
+        after = decode_cursor(cursor)
+        # the to_tsvector expression must match msg_content_tsv_idx exactly to use it
+        sql = [
+            "WITH hits AS (",
+            " SELECT m.id, m.conversation_id, m.role, m.created_at, m.content,",
+            " ts_rank_cd(to_tsvector('english', m.content), query)::float8 AS _rank, query",
+            " FROM chatapi_message m",
+            " JOIN chatapi_conversation c ON c.id = m.conversation_id,",
+            " websearch_to_tsquery('english', %s) query",
+            " WHERE to_tsvector('english', m.content) @@ query AND c.owner_id = %s AND m.meta ? 'tokens'",
+            ")",
+            "SELECT id, conversation_id, role, created_at, content,",
+            f" ts_headline('english', content, query, 'StartSel=[,StopSel=],MaxWords={SNIPPET_TOKENS * 2},MinWords={SNIPPET_TOKENS}') AS snippet,",
+            " _rank FROM hits",
+        ]
+        params: List[Any] = [q, user.pk]
+        if after:
+            # ts_rank_cd: higher is better
+            sql.append(" WHERE (_rank < %s OR (_rank = %s AND id > %s))")
+            params += [after[0], after[0], after[1]]
+        sql.append(" ORDER BY _rank DESC, id LIMIT %s")
+        params.append(limit + 1)
+        return _page(_fetch(sql, params), limit, "_rank")
+
+
+class IcontainsBackend:
+    name = "icontains"
+
+    def search_messages(self, user, q: str, *, limit: int, cursor: Optional[str] = None) -> Tuple[Rows, Optional[str]]:
+        after = decode_cursor(cursor)
+        qs = Message.objects.filter(conversation__owner=user, content__icontains=q)
+        if after:
+            qs = qs.filter(id__lt=after[1])
+        rows = list(qs.order_by("-id").values("id", "conversation_id", "role", "created_at", "content")[:limit + 1])
+        for r in rows:
+            r["snippet"] = _icontains_snippet(r["content"], q)
+            r["_rank"] = 0
+        return _page(rows, limit, "_rank")
+
+
+def _icontains_snippet(text: str, q: str, width: int = 60) -> str:
+    i = text.lower().find(q.lower())
+    if i < 0:
+        return text[: 2 * width]
+    start, end = max(0, i - width), min(len(text), i + len(q) + width)
+    return ("…" if start else "") + text[start:i] + "[" + text[i:i + len(q)] + "]" + text[i + len(q):end] + ("…" if end < len(text) else "")
+
+
+def _fetch(sql: List[str], params: List[Any]) -> Rows:
+    with connection.cursor() as cur:
+        cur.execute("".join(sql), params)
+        cols = [c[0] for c in cur.description]
+        return [_as_orm_types(dict(zip(cols, row))) for row in cur.fetchall()]
+
+
+def _as_orm_types(row: Dict[str, Any]) -> Dict[str, Any]:
+    # raw cursors skip model field conversion (SQLite hands back hex UUIDs and naive timestamps)
+    if not isinstance(row["conversation_id"], uuid.UUID):
+        row["conversation_id"] = uuid.UUID(str(row["conversation_id"]))
+    ts = row["created_at"]
+    if isinstance(ts, str):
+        ts = parse_datetime(ts)
+    if settings.USE_TZ and ts is not None and timezone.is_naive(ts):
+        ts = timezone.make_aware(ts, dt_timezone.utc)
+    row["created_at"] = ts
+    return row
+
+
+_BACKENDS = {b.name: b for b in (SqliteFtsBackend, PostgresFtsBackend, IcontainsBackend)}
+
+
+def get_search_backend():
+    name = getattr(settings, "CHAT_SEARCH_BACKEND", "auto")
+    if name == "auto":
+        name = {"sqlite": "sqlite", "postgresql": "postgres"}.get(connection.vendor, "icontains")
+    return _BACKENDS[name]()
@@ -0,0 +1,130 @@
+"""
+Server-sent event framing and delta coalescing for the chat stream.
+
+Upstream deltas are a few characters each; sending one frame per delta means
+thousands of tiny writes (and proxy flushes, since X-Accel-Buffering is off)
+per reply. `coalesce`/`acoalesce` merge deltas into one frame per
+CHAT_STREAM_COALESCE_MS window (or sooner once CHAT_STREAM_COALESCE_CHARS are
+pending). The first delta is always sent on its own, so time-to-first-token is
+unchanged. Clients see the same `token` events, just with longer deltas.
+
+Frame formats:
+    standard  event: token / data: {"delta": "..."}   (the original contract)
+    compact   data:"..."                              (unnamed event, JSON string; opt-in per request)
+Both carry `id: <offset>` so a dropped client can resume with Last-Event-ID.
+"""
+
+from __future__ import annotations
+import asyncio, contextlib, json, time
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, Tuple
+from django.conf import settings
+
+STANDARD, COMPACT = "standard", "compact"
+FORMATS = (STANDARD, COMPACT)
+
+
+def event(data: dict, name: str) -> bytes:
+    return (f"event: {name}\n" f"data: {json.dumps(data, ensure_ascii=False)}\n\n").encode("utf-8")
+
+
+def token_frame(delta: str, fmt: str = STANDARD, event_id: Optional[int] = None) -> bytes:
+    """`event_id` (the reply's character offset after this delta) becomes the frame's `id:`, see replay.py."""
+    prefix = b"" if event_id is None else b"id: %d\n" % event_id
+    if fmt == COMPACT:
+        return prefix + b"data:" + json.dumps(delta, ensure_ascii=False).encode("utf-8") + b"\n\n"
+    return prefix + event({"delta": delta}, "token")
+
+
+def _limits(window_ms: Optional[float], max_chars: Optional[int]) -> Tuple[float, int]:
+    window = float(getattr(settings, "CHAT_STREAM_COALESCE_MS", 25) if window_ms is None else window_ms) / 1000
+    limit = int(getattr(settings, "CHAT_STREAM_COALESCE_CHARS", 2048) if max_chars is None else max_chars)
+    return window, limit
+
+
+def coalesce(deltas: Iterable[str], *, window_ms: Optional[float] = None,
+             max_chars: Optional[int] = None) -> Iterator[str]:
+    """
+    Merge deltas that arrive within `window_ms` of the last frame (0 disables).
+    Decided on arrival, so a delta can wait for the next one after the window;
+    acoalesce flushes on the deadline itself.
+    """
+    window, limit = _limits(window_ms, max_chars)
+    it = iter(deltas)
+    try:
+        if window <= 0:
+            yield from it
+            return
+        parts, pending, last = [], 0, None
+        for delta in it:
+            if not delta:
+                continue
+            now = time.monotonic()
+            if last is None:
+                last = now
+                yield delta
+                continue
+            parts.append(delta)
+            pending += len(delta)
+            if pending >= limit or now - last >= window:
+                yield "".join(parts)
+                parts, pending, last = [], 0, now
+        if parts:
+            yield "".join(parts)
+    finally:
+        # closed early: close upstream too rather than leaving it to the garbage collector
+        close = getattr(it, "close", None)
+        if close is not None:
+            close()
+
+
+async def acoalesce(deltas: AsyncIterable[str], *, window_ms: Optional[float] = None,
+                    max_chars: Optional[int] = None) -> AsyncIterator[str]:
+    """Async coalesce: a frame goes out `window_ms` after its first delta even if upstream stalls."""
+    window, limit = _limits(window_ms, max_chars)
+    it = deltas.__aiter__()
+    nxt: Optional[asyncio.Future] = None
+    try:
+        if window <= 0:
+            async for delta in it:
+                yield delta
+            return
+        loop = asyncio.get_running_loop()
+        parts, pending, deadline, first = [], 0, 0.0, True
+        while True:
+            if nxt is None:
+                nxt = asyncio.ensure_future(it.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if parts else None
+            done, _ = await asyncio.wait((nxt,), timeout=timeout)
+            if not done:  # window elapsed, upstream still thinking
+                yield "".join(parts)
+                parts, pending = [], 0
+                continue
+            fut, nxt = nxt, None
+            try:
+                delta = fut.result()
+            except StopAsyncIteration:
+                break
+            if not delta:
+                continue
+            if first:
+                first = False
+                yield delta
+                continue
+            if not parts:
+                deadline = loop.time() + window
+            parts.append(delta)
+            pending += len(delta)
+            if pending >= limit:
+                yield "".join(parts)
+                parts, pending = [], 0
+        if parts:
+            yield "".join(parts)
+    finally:
+        # consumer went away (disconnect) or upstream finished: don't leave the read running
+        if nxt is not None:
+            nxt.cancel()
+            with contextlib.suppress(BaseException):
+                await nxt
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
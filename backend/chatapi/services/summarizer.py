@@ -0,0 +1,123 @@
+"""
+Rolling conversation summaries.
+
+Once the not-yet-summarized part of a conversation exceeds
+CHAT_SUMMARY_TRIGGER_TOKENS, everything but the newest CHAT_SUMMARY_KEEP_TOKENS
+is folded (together with the previous summary) into Conversation.summary, and
+Conversation.summary_until_id moves past the folded rows. The streaming views
+then send the summary in place of those turns. The watermark never passes a
+reply that is still streaming (no token count in meta yet), so its final text
+is summarized once it lands.
+
+Runs on a single background thread after the reply has been streamed.
+"""
+
+from __future__ import annotations
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+from django.conf import settings
+from django.db import close_old_connections
+from ..models import Conversation, Message
+from .token_budget import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+# messages -> reply text; swapped for a stub in tests
+Completer = Callable[[List[Dict[str, str]]], str]
+
+_SUMMARY_INSTRUCTIONS = (
+    "You maintain the running memory of a roleplay chat between a user and {character}. "
+    "Merge the previous summary with the new turns into one updated summary. "
+    "Keep names, facts the user shared, promises, decisions and open threads; drop small talk. "
+    "Write in third person, plain prose, at most {words} words."
+)
+
+
+def _default_complete(messages: List[Dict[str, str]]) -> str:
+    from .bot_service import OPENAI_MODEL
+    from .llm_providers import get_llm_provider
+    return get_llm_provider().complete(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=0.2,
+        max_tokens=int(getattr(settings, "CHAT_SUMMARY_MAX_TOKENS", 400)),
+    )
+
+
+def _tokens(m: Message) -> int:
+    n = (m.meta or {}).get("tokens")
+    return int(n) if n is not None else estimate_tokens(m.content)
+
+
+def summarize_conversation(conversation_id, *, complete: Optional[Completer] = None) -> bool:
+    """Fold old turns into the conversation summary if it is over threshold. Returns True if updated."""
+    trigger = int(getattr(settings, "CHAT_SUMMARY_TRIGGER_TOKENS", 6000))
+    keep = int(getattr(settings, "CHAT_SUMMARY_KEEP_TOKENS", 2000))
+    conv = Conversation.objects.only("id", "character", "summary", "summary_until_id").get(pk=conversation_id)
+
+    rows = conv.messages.only("id", "role", "content", "meta", "conversation_id").order_by("id")
+    if conv.summary_until_id:
+        rows = rows.filter(id__gt=conv.summary_until_id)
+    rows = list(rows)
+    if sum(_tokens(m) for m in rows) <= trigger:
+        return False
+
+    # newest `keep` tokens stay verbatim; everything older gets folded
+    kept = 0
+    cut = len(rows)
+    while cut > 0 and kept + _tokens(rows[cut - 1]) <= keep:
+        cut -= 1
+        kept += _tokens(rows[cut])
+    # ...but nothing from the oldest reply still being generated onwards
+    streaming = next((i for i, m in enumerate(rows) if "tokens" not in (m.meta or {})), cut)
+    cut = min(cut, streaming)
+    old = [m for m in rows[:cut] if m.content]
+    if not old:
+        return False
+
+    transcript = "\n".join(f"{m.role}: {m.content}" for m in old)
+    words = int(getattr(settings, "CHAT_SUMMARY_MAX_TOKENS", 400)) * 3 // 4
+    prompt = [
+        {"role": "system", "content": _SUMMARY_INSTRUCTIONS.format(character=conv.character or "the character", words=words)},
+        {"role": "user", "content": f"Previous summary:\n{conv.summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+    summary = (complete or _default_complete)(prompt).strip()
+    if not summary:
+        return False
+    # only apply if nobody else moved the watermark meanwhile
+    updated = (Conversation.objects
+               .filter(pk=conv.pk, summary_until_id=conv.summary_until_id)
+               .update(summary=summary, summary_until_id=rows[cut - 1].id))
+    return bool(updated)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_pending: Set[str] = set()
+_lock = threading.Lock()
+
+
+def _run(conversation_id: str) -> None:
+    try:
+        summarize_conversation(conversation_id)
+    except Exception as e:
+        log.warning("Summarizing conversation %s failed: %s", conversation_id, e)
+    finally:
+        with _lock:
+            _pending.discard(conversation_id)
+        close_old_connections()
+
+
+def schedule_summary(conversation_id) -> None:
+    """Queue a summary pass off the request path; repeated calls for a busy conversation are dropped."""
+    global _executor
+    if not getattr(settings, "CHAT_SUMMARY_ENABLED", False):
+        return
+    key = str(conversation_id)
+    with _lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+    _executor.submit(_run, key)
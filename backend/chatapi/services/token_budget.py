@@ -0,0 +1,37 @@
+from __future__ import annotations
+from typing import Any, Dict, Optional
+
+# Cheap length estimate (~4 chars/token for English chat text). It is only used
+# for budgeting, so it trades exactness for not needing a tokenizer at runtime.
+CHARS_PER_TOKEN = 4
+# role + framing tokens the chat format adds to every message
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def with_token_count(text: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Message.meta with the content's token estimate recorded under "tokens"."""
+    out = dict(meta or {})
+    out["tokens"] = estimate_tokens(text)
+    return out
+
+
+def message_tokens(msg: Dict[str, Any]) -> int:
+    """Tokens a history entry costs; uses the count cached at write time when present."""
+    n = msg.get("tokens")
+    if n is None:
+        n = estimate_tokens(msg.get("content", ""))
+    return int(n) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep the tail of `text` (the most recent part of a turn) within `max_tokens`."""
+    max_chars = max(0, max_tokens) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return "…" + text[len(text) - max_chars + 1:]
@@ -1,65 +1,309 @@
-import json
-from django.http import StreamingHttpResponse, JsonResponse
+import json, time
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.http import StreamingHttpResponse, JsonResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
 from django.utils.timezone import now
 from django.shortcuts import get_object_or_404
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from .models import Conversation, Message
-from .services.bot_service import stream_tokens
+from .services.bot_service import persona_label
+from .services import admission, conversation_stats, metrics, producer, replay, sse
+from .services.token_budget import with_token_count
 
-def _evt(data: dict, event: str) -> bytes:
-    return (f"event: {event}\n" f"data: {json.dumps(data, ensure_ascii=False)}\n\n").encode("utf-8")
+_evt = sse.event
 
-@csrf_exempt
-def chat_stream_view(request):
+def _authenticate(request):
     # Manual JWT auth
-    user = None
     try:
         user, _ = JWTAuthentication().authenticate(request)
+        return user
+    except Exception:
+        return None
+
+def _parse_body(request) -> dict:
+    try:
+        return json.loads(request.body.decode("utf-8") or "{}")
     except Exception:
-        pass
+        return {}
+
+def _history_qs(conv, assistant):
+    # Newest rows first; bot_service trims them to the token budget. Token counts
+    # were cached in meta at write time, so nothing is re-estimated here.
+    # Rows already folded into conv.summary are left out. conversation_id stays loaded:
+    # the related manager reads it off every row, and deferring it costs a query per row.
+    limit = int(getattr(settings, "CHAT_HISTORY_MAX_MESSAGES", 50))
+    qs = conv.messages.exclude(id=assistant.id)
+    if conv.summary_until_id:
+        qs = qs.filter(id__gt=conv.summary_until_id)
+    return qs.only("role", "content", "meta", "conversation_id").order_by("-created_at")[:limit]
+
+def _last_event_id(request) -> int:
+    raw = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id") or "0"
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return 0
+
+def _is_final(message) -> bool:
+    # finalize() stores the token count in meta; the placeholder has none until the reply ends
+    return "tokens" in (message.meta or {})
+
+def _saved_tail(message, after: int):
+    # Fallback when the channel can't serve a viewer: whatever the row holds past `after`.
+    # A row that isn't final is still being generated somewhere this process can't follow.
+    frames = [(len(message.content), message.content[after:])] if len(message.content) > after else []
+    if not _is_final(message):
+        return frames, "pending"
+    return frames, (replay.CANCELLED if message.meta.get("cancelled") else "saved")
+
+def _subscribe(message_id, after: int, fmt: str, **start):
+    # One viewer of a reply: the frames past `after` from its channel, live until the producer closes it.
+    # Disconnecting only ends this generator; the producer stops once no viewer is left for
+    # CHAT_DISCONNECT_GRACE seconds.
+    buffer = replay.get_replay_buffer()
+    buffer.join(message_id)
+    status = None
+    try:
+        yield _evt({"message_id": message_id, "ts": now().isoformat(), **start}, "start")
+        try:
+            for snap in buffer.follow(message_id, after):
+                for end, text in snap.frames:
+                    after = end
+                    yield sse.token_frame(text, fmt, end)
+                status = snap.status
+        except replay.Unavailable:
+            frames, status = _saved_tail(Message.objects.only("content", "meta").get(pk=message_id), after)
+            for end, text in frames:
+                yield sse.token_frame(text, fmt, end)
+    finally:
+        buffer.leave(message_id)  # GeneratorExit here is the client disconnecting
+    yield _evt({"ts": now().isoformat(), "status": status}, "end")
+
+async def _asubscribe(message_id, after: int, fmt: str, **start):
+    buffer = replay.get_replay_buffer()
+    await buffer.ajoin(message_id)
+    status = None
+    try:
+        yield _evt({"message_id": message_id, "ts": now().isoformat(), **start}, "start")
+        try:
+            async for snap in buffer.afollow(message_id, after):
+                for end, text in snap.frames:
+                    after = end
+                    yield sse.token_frame(text, fmt, end)
+                status = snap.status
+        except replay.Unavailable:
+            frames, status = _saved_tail(await Message.objects.only("content", "meta").aget(pk=message_id), after)
+            for end, text in frames:
+                yield sse.token_frame(text, fmt, end)
+    finally:
+        await buffer.aleave(message_id)  # ASGI disconnect cancels this generator
+    yield _evt({"ts": now().isoformat(), "status": status}, "end")
+
+def _stream_format(body: dict) -> str:
+    # opt-in per request so existing clients keep getting `event: token` frames
+    fmt = body.get("stream_format") or sse.STANDARD
+    return fmt if fmt in sse.FORMATS else sse.STANDARD
+
+def _history_row(m) -> dict:
+    return {"role": m.role, "content": m.content, "tokens": (m.meta or {}).get("tokens")}
+
+def _too_many(rejected: admission.Rejected) -> JsonResponse:
+    metrics.admission_rejected(rejected.reason)
+    resp = JsonResponse({"detail": "Too many requests", "reason": rejected.reason, "retry_after": rejected.retry_after},
+                        status=429)
+    resp["Retry-After"] = str(rejected.retry_after)
+    return resp
+
+def _sse_response(events) -> StreamingHttpResponse:
+    resp = StreamingHttpResponse(events, content_type="text/event-stream")
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"
+    return resp
+
+@csrf_exempt
+def chat_stream_view(request):
+    t0 = time.perf_counter()
+    user = _authenticate(request)
     if not user:
         return JsonResponse({"detail": "Unauthorized"}, status=401)
+    t_auth = time.perf_counter() - t0
 
     if request.method != "POST":
         return JsonResponse({"detail": "Method not allowed"}, status=405)
 
+    body = _parse_body(request)
+    conversation_id = body.get("conversation_id")
+    prompt = body.get("prompt", "") or ""
+    create_user_message = bool(body.get("create_user_message", True))
+    fmt = _stream_format(body)
+    if not conversation_id:
+        return JsonResponse({"detail": "conversation_id required"}, status=400)
+
+    trace = metrics.start_reply(started=t0)
+    token = metrics.activate(trace)
     try:
-        body = json.loads(request.body.decode("utf-8") or "{}")
-    except Exception:
-        body = {}
+        trace.add("auth", t_auth)
+        try:
+            with trace.span("conversation"):
+                conv = get_object_or_404(Conversation, pk=conversation_id, owner=user)
+        except Http404:
+            trace.discard()
+            raise
+        trace.set(persona=persona_label(conv.character))
+
+        # Before any row exists: a rejected request leaves nothing behind
+        gate = admission.get_admission()
+        try:
+            with trace.span("admission"):
+                lease = gate.acquire(user.id)
+        except admission.Rejected as e:
+            trace.discard()
+            return _too_many(e)
+
+        try:
+            with trace.span("insert"):
+                # Persist user's message now (if not already created via /messages/create)
+                if create_user_message and prompt:
+                    msg = Message.objects.create(conversation=conv, role="user", content=prompt,
+                                                 meta=with_token_count(prompt))
+                    conversation_stats.message_created(msg)
 
+                # Create assistant placeholder row (save-as-you-go)
+                assistant = Message.objects.create(conversation=conv, role="assistant", content="")
+                conversation_stats.message_created(assistant)
+
+            # Recent history (exclude the new empty assistant)
+            with trace.span("history"):
+                history = [_history_row(m) for m in reversed(list(_history_qs(conv, assistant)))]
+
+            producer.start(producer.Reply(conv, assistant, prompt, history, trace, lease))
+        except BaseException:
+            gate.release(lease)  # from here on the producer releases it
+            raise
+        return _sse_response(_subscribe(assistant.id, 0, fmt))
+    finally:
+        metrics.deactivate(token)  # the producer has its own copy of the context
+
+@csrf_exempt
+async def chat_stream_async_view(request):
+    """
+    ASGI variant of chat_stream_view: async ORM + AsyncOpenAI, so an in-flight
+    reply holds no worker thread. Same request body and start/token/end events.
+    """
+    t0 = time.perf_counter()
+    user = await sync_to_async(_authenticate)(request)
+    if not user:
+        return JsonResponse({"detail": "Unauthorized"}, status=401)
+    t_auth = time.perf_counter() - t0
+
+    if request.method != "POST":
+        return JsonResponse({"detail": "Method not allowed"}, status=405)
+
+    body = _parse_body(request)
     conversation_id = body.get("conversation_id")
     prompt = body.get("prompt", "") or ""
     create_user_message = bool(body.get("create_user_message", True))
+    fmt = _stream_format(body)
     if not conversation_id:
         return JsonResponse({"detail": "conversation_id required"}, status=400)
 
-    conv = get_object_or_404(Conversation, pk=conversation_id, owner=user)
+    trace = metrics.start_reply(started=t0)
+    token = metrics.activate(trace)
+    try:
+        trace.add("auth", t_auth)
+        try:
+            with trace.span("conversation"):
+                conv = await Conversation.objects.aget(pk=conversation_id, owner=user)
+        except (Conversation.DoesNotExist, ValidationError):
+            trace.discard()
+            raise Http404("No Conversation matches the given query.")
+        trace.set(persona=persona_label(conv.character))
 
-    # Persist user's message now (if not already created via /messages/create)
-    if create_user_message and prompt:
-        Message.objects.create(conversation=conv, role="user", content=prompt)
-        conv.save(update_fields=["updated_at"])
+        gate = admission.get_admission()
+        try:
+            with trace.span("admission"):
+                lease = await gate.aacquire(user.id)
+        except admission.Rejected as e:
+            trace.discard()
+            return _too_many(e)
 
-    # Create assistant placeholder row (save-as-you-go)
-    assistant = Message.objects.create(conversation=conv, role="assistant", content="")
-    conv.save(update_fields=["updated_at"])
+        try:
+            with trace.span("insert"):
+                if create_user_message and prompt:
+                    msg = await Message.objects.acreate(conversation=conv, role="user", content=prompt,
+                                                        meta=with_token_count(prompt))
+                    await conversation_stats.amessage_created(msg)
 
-    # Short history (exclude the new empty assistant)
-    history_qs = conv.messages.exclude(id=assistant.id).order_by("-created_at")[:12]
-    history = [{"role": m.role, "content": m.content} for m in reversed(list(history_qs))]
+                assistant = await Message.objects.acreate(conversation=conv, role="assistant", content="")
+                await conversation_stats.amessage_created(assistant)
 
-    def stream():
-        yield _evt({"message_id": assistant.id, "ts": now().isoformat()}, "start")
-        persona = conv.character or "Bronn"
-        for tok in stream_tokens(prompt, persona=persona, history=history):
-            assistant.content += tok
-            assistant.save(update_fields=["content"])
-            yield _evt({"delta": tok}, "token")
-        yield _evt({"ts": now().isoformat()}, "end")
+            with trace.span("history"):
+                history = [_history_row(m) async for m in _history_qs(conv, assistant)]
+            history.reverse()
 
-    resp = StreamingHttpResponse(stream(), content_type="text/event-stream")
-    resp["Cache-Control"] = "no-cache"
-    resp["X-Accel-Buffering"] = "no"
-    return resp
+            await producer.astart(producer.Reply(conv, assistant, prompt, history, trace, lease))
+        except BaseException:
+            await gate.arelease(lease)
+            raise
+        return _sse_response(_asubscribe(assistant.id, 0, fmt))
+    finally:
+        metrics.deactivate(token)  # the producer has its own copy of the context
+
+@csrf_exempt
+def chat_resume_view(request, message_id):
+    """
+    Watch an assistant reply: replays the token frames after Last-Event-ID
+    (all of them without one, e.g. from a second tab), then follows the
+    generation until it ends. The end event's `status` is "complete",
+    "cancelled" or "interrupted" (from the reply's channel), "saved" (channel
+    gone, the row is final) or "pending" (channel gone, reply still being
+    written elsewhere; retry later).
+    """
+    user = _authenticate(request)
+    if not user:
+        return JsonResponse({"detail": "Unauthorized"}, status=401)
+    if request.method != "GET":
+        return JsonResponse({"detail": "Method not allowed"}, status=405)
+
+    message = get_object_or_404(Message, pk=message_id, role="assistant", conversation__owner=user)
+    after = _last_event_id(request)
+    fmt = _stream_format(request.GET)
+    return _sse_response(_subscribe(message.id, after, fmt, resumed_from=after))
+
+@csrf_exempt
+async def chat_resume_async_view(request, message_id):
+    """ASGI variant of chat_resume_view."""
+    user = await sync_to_async(_authenticate)(request)
+    if not user:
+        return JsonResponse({"detail": "Unauthorized"}, status=401)
+    if request.method != "GET":
+        return JsonResponse({"detail": "Method not allowed"}, status=405)
+
+    try:
+        message = await Message.objects.aget(pk=message_id, role="assistant", conversation__owner=user)
+    except Message.DoesNotExist:
+        raise Http404("No Message matches the given query.")
+    after = _last_event_id(request)
+    fmt = _stream_format(request.GET)
+    return _sse_response(_asubscribe(message.id, after, fmt, resumed_from=after))
+
+@csrf_exempt
+def chat_cancel_view(request, message_id):
+    """
+    Stop a reply that is still being generated (the "stop" button). The
+    upstream request is closed and the reply is saved as far as it got, with
+    meta.cancelled; viewers get an `end` event with status "cancelled".
+    """
+    user = _authenticate(request)
+    if not user:
+        return JsonResponse({"detail": "Unauthorized"}, status=401)
+    if request.method != "POST":
+        return JsonResponse({"detail": "Method not allowed"}, status=405)
+
+    message = get_object_or_404(Message.objects.only("id", "meta"), pk=message_id, role="assistant", conversation__owner=user)
+    if _is_final(message):
+        return JsonResponse({"detail": "Reply already finished", "cancelled": bool(message.meta.get("cancelled"))}, status=409)
+    producer.cancel(message.id)
+    return JsonResponse({"message_id": message.id, "cancelled": True}, status=202)
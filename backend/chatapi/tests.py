@@ -1,3 +1,1237 @@
-from django.test import TestCase
+import asyncio, importlib.util, io, json, os, random, shutil, sys, tempfile, threading, time
+from importlib import import_module
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import Http404
+from django.test.utils import CaptureQueriesContext
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import Conversation, Message
+from .services import admission, bot_service, conversation_stats, metrics, replay, response_cache, search_backend, sse
+from .services.bot_service import _assemble_messages
+from .services import llm_client
+from .services.llm_client import FirstTokenTimeout, LLMClientManager
+from .services.llm_providers import Distribution, FakeProvider, set_llm_provider
+from .services.llm_stub_server import StubHTTPError, start_stub_server
+from .services.message_writer import BufferedMessageWriter
+from .services.summarizer import summarize_conversation
+from .services.token_budget import with_token_count
+from .stream_views import (
+    _history_qs, _history_row, chat_cancel_view, chat_resume_view, chat_stream_async_view, chat_stream_view,
+)
+
+
+@override_settings(CHAT_SUMMARY_TRIGGER_TOKENS=100, CHAT_SUMMARY_KEEP_TOKENS=40)
+class RollingSummaryTests(TestCase):
+    def setUp(self):
+        owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=owner, character="Bronn")
+        self.calls = []
+
+    def _stub(self, messages):
+        self.calls.append(messages)
+        return "Bronn agreed to guard the user for ten dragons."
+
+    def _add(self, role, text):
+        return Message.objects.create(conversation=self.conv, role=role, content=text, meta=with_token_count(text))
+
+    def test_below_threshold_is_left_alone(self):
+        self._add("user", "a" * 80)
+        self.assertFalse(summarize_conversation(self.conv.pk, complete=self._stub))
+        self.assertEqual(self.calls, [])
+
+    def test_folds_old_turns_and_keeps_recent_ones(self):
+        old = [self._add("user", "a" * 200), self._add("assistant", "b" * 200)]
+        self._add("user", "c" * 80)
+        self.assertTrue(summarize_conversation(self.conv.pk, complete=self._stub))
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.summary, "Bronn agreed to guard the user for ten dragons.")
+        self.assertEqual(self.conv.summary_until_id, old[-1].id)
+        transcript = self.calls[0][-1]["content"]
+        self.assertIn("b" * 200, transcript)
+        self.assertNotIn("c" * 80, transcript)
+
+    def test_watermark_stops_before_a_reply_still_streaming(self):
+        first = self._add("user", "a" * 200)
+        streaming = Message.objects.create(conversation=self.conv, role="assistant", content="b" * 200)  # no token count yet
+        self._add("user", "c" * 200)
+        self._add("user", "d" * 80)
+        self.assertTrue(summarize_conversation(self.conv.pk, complete=self._stub))
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.summary_until_id, first.id)
+        self.assertNotIn("b" * 200, self.calls[0][-1]["content"])
+        self.assertLess(self.conv.summary_until_id, streaming.id)
+
+    def test_summary_is_injected_before_history(self):
+        msgs = _assemble_messages("hi", persona="Bronn", history=[{"role": "user", "content": "hey"}],
+                                  summary="They met at an inn.")
+        self.assertEqual([m["role"] for m in msgs], ["system", "system", "user", "user"])
+        self.assertIn("They met at an inn.", msgs[1]["content"])
+
+
+class HistoryBudgetTests(SimpleTestCase):
+    @staticmethod
+    def _turns(n, chars=40):
+        return [{"role": ("user", "assistant")[i % 2], "content": f"{i:02d}" + "x" * (chars - 2)} for i in range(n)]
+
+    def test_keeps_newest_turns_within_budget(self):
+        turns = self._turns(10)  # 10 tokens + 4 overhead each
+        kept = bot_service._bound_history(turns, budget_tokens=3 * 14 + 13)
+        self.assertEqual(kept, turns[-3:])
+        self.assertEqual(bot_service._bound_history(turns, budget_tokens=0), [])
+        self.assertEqual(bot_service._bound_history([{"role": "system", "content": "old prompt"}] + turns[-1:],
+                                                    budget_tokens=1000), turns[-1:])
+
+    def test_crossing_turn_is_cut_to_its_tail(self):
+        turns = [{"role": "user", "content": "a" * 100 + "b" * 300}] + self._turns(1)
+        kept = bot_service._bound_history(turns, budget_tokens=14 + 44)
+        self.assertEqual(kept[1], turns[1])
+        self.assertEqual(kept[0]["content"], "…" + "b" * 159)  # 40 tokens = 160 chars
+        self.assertEqual(len(bot_service._bound_history(turns, budget_tokens=14 + 30)), 1)  # too little left to keep a cut
+
+    def test_precomputed_token_counts_are_used(self):
+        turns = self._turns(2)
+        self.assertEqual(len(bot_service._bound_history(turns, budget_tokens=14 + 20)), 2)
+        turns[0]["tokens"] = 1000  # e.g. Message.meta says so
+        kept = bot_service._bound_history(turns, budget_tokens=14 + 20)
+        self.assertEqual(kept, [{"role": turns[1]["role"], "content": turns[1]["content"]}])
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked against SQLite")
+class HotQueryPlanTests(TestCase):
+    """The chat hot paths must be served by the composite indexes, not FK scans + temp sorts."""
+
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn")
+        Message.objects.create(conversation=self.conv, role="user", content="hi")
+
+    def assertUsesIndex(self, qs, index_name):
+        plan = qs.explain()
+        self.assertIn(index_name, plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_stream_history_fetch(self):
+        qs = self.conv.messages.exclude(id=0).order_by("-created_at")[:50]
+        self.assertUsesIndex(qs, "msg_conv_created_idx")
+
+    def test_stream_history_is_one_query(self):
+        for i in range(5):
+            Message.objects.create(conversation=self.conv, role="assistant", content=f"reply {i}")
+        assistant = Message.objects.create(conversation=self.conv, role="assistant", content="")
+        with self.assertNumQueries(1):
+            rows = [_history_row(m) for m in _history_qs(self.conv, assistant)]
+        self.assertEqual(len(rows), 6)
+
+    def test_message_pagination(self):
+        self.assertUsesIndex(self.conv.messages.all().order_by("created_at"), "msg_conv_created_idx")
+        self.assertUsesIndex(self.conv.messages.all().order_by("-created_at"), "msg_conv_created_idx")
+
+    def test_detail_messages_default_ordering(self):
+        self.assertUsesIndex(self.conv.messages.all(), "msg_conv_created_idx")
+
+    def test_conversation_list(self):
+        qs = Conversation.objects.filter(owner=self.owner).order_by("-updated_at")
+        self.assertUsesIndex(qs, "conv_owner_updated_idx")
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        owner = get_user_model().objects.create_user(username="u", password="pw")
+        conv = Conversation.objects.create(owner=owner, character="Bronn")
+        self.message = Message.objects.create(conversation=conv, role="assistant", content="")
+
+    def test_flushes_in_batches_and_finalizes_token_count(self):
+        writer = BufferedMessageWriter(self.message, flush_ms=60_000, flush_chars=10)
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(10):
+                writer.add("abcd")
+            self.assertEqual(writer.writes, 3)  # after 12, 24 and 36 chars
+            self.assertEqual(len(queries), 3)
+            self.assertEqual(Message.objects.get(pk=self.message.pk).content, "abcd" * 9)
+            writer.finalize()
+        self.assertEqual([q["sql"].split()[0] for q in queries], ["UPDATE"] * 3 + ["SELECT", "UPDATE"])
+        saved = Message.objects.get(pk=self.message.pk)
+        self.assertEqual(saved.content, "abcd" * 10)
+        self.assertEqual(saved.meta, {"tokens": 10})
+
+    def test_time_window_flushes_small_deltas(self):
+        writer = BufferedMessageWriter(self.message, flush_ms=0, flush_chars=10**6)
+        writer.add("a")
+        writer.add("")  # empty deltas never write
+        self.assertEqual(writer.writes, 1)
+        self.assertEqual(Message.objects.get(pk=self.message.pk).content, "a")
+
+
+@skipUnless(connection.vendor == "sqlite", "the FTS5 index only exists on SQLite")
+@override_settings(CHAT_SEARCH_BACKEND="sqlite")
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(self.owner).access_token)}
+
+    def _say(self, content, conv=None, role="user"):
+        return Message.objects.create(conversation=conv or self.conv, role=role, content=content,
+                                      meta=with_token_count(content))
+
+    def _search(self, q, **params):
+        resp = self.client.get("/api/search", {"q": q, **params}, headers=self.auth)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()
+
+    def _hits(self, q):
+        return [m["id"] for m in self._search(q)["messages"]]
+
+    def _message_triggers(self):
+        with connection.cursor() as cur:
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'chatapi_message'")
+            return sorted(r[0] for r in cur.fetchall())
+
+    def test_triggers_survive_all_migrations(self):
+        self.assertEqual(self._message_triggers(),
+                         ["chatapi_message_search_ad", "chatapi_message_search_ai", "chatapi_message_search_au"])
+
+    def test_dropped_triggers_are_restored_and_the_index_resynced(self):
+        # what a migration that rebuilds chatapi_message does to them
+        with connection.cursor() as cur:
+            cur.execute("DROP TRIGGER chatapi_message_search_ai")
+        missed = self._say("a lannister pays his debts")
+        self.assertEqual(self._hits("debts"), [])
+        search = import_module("chatapi.migrations.0009_message_search_rows")
+        self.assertTrue(search.ensure_triggers(connection))
+        self.assertFalse(search.ensure_triggers(connection))
+        self.assertEqual(len(self._message_triggers()), 3)
+        self.assertEqual(self._hits("debts"), [missed.id])
+        self.assertEqual(self._hits("lannister"), [missed.id])
+
+    def test_rebuilding_the_index_keeps_owners_apart(self):
+        stranger = get_user_model().objects.create_user(username="s", password="pw")
+        self._say("dragon glass", conv=Conversation.objects.create(owner=stranger, character="Bronn"))
+        mine = self._say("dragon bones")
+        with connection.cursor() as cur:
+            cur.execute("INSERT INTO chatapi_message_fts(chatapi_message_fts) VALUES ('rebuild')")
+            cur.execute("INSERT INTO chatapi_message_fts(chatapi_message_fts, rank) VALUES ('integrity-check', 1)")
+        self.assertEqual(self._hits("dragon"), [mine.id])
+
+    def test_index_follows_insert_update_and_delete(self):
+        m = self._say("the price of gold")
+        hit = self._search("gold")["messages"]
+        self.assertEqual([h["id"] for h in hit], [m.id])
+        self.assertEqual(hit[0]["content"], "the price of gold")
+        self.assertIn("[gold]", hit[0]["snippet"])
+        m.content, m.meta = "a debt of steel", with_token_count("a debt of steel")
+        m.save()
+        self.assertEqual(self._hits("gold"), [])
+        self.assertEqual(self._hits("steel"), [m.id])
+        m.delete()
+        self.assertEqual(self._hits("steel"), [])
+
+    def test_streaming_reply_is_indexed_once_finalized(self):
+        reply = Message.objects.create(conversation=self.conv, role="assistant", content="")
+        writer = BufferedMessageWriter(reply, flush_ms=60_000, flush_chars=1)
+        for word in ("wildfire ", "on ", "blackwater"):
+            writer.add(word)
+        self.assertEqual(writer.writes, 3)
+        self.assertEqual(self._hits("wildfire"), [])
+        writer.finalize()
+        self.assertEqual(self._hits("wildfire"), [reply.id])
+        self.assertEqual(self._hits("blackwater"), [reply.id])
+
+    def test_other_owners_messages_are_not_found(self):
+        stranger = get_user_model().objects.create_user(username="s", password="pw")
+        self._say("dragon glass", conv=Conversation.objects.create(owner=stranger, character="Bronn"))
+        mine = self._say("dragon bones")
+        self.assertEqual(self._hits("dragon"), [mine.id])
+
+    def test_cursor_pages_through_every_hit_once(self):
+        ids = {self._say(f"coin number {i}").id for i in range(7)}
+        seen, cursor, pages = [], None, 0
+        while True:
+            body = self._search("coin", limit=3, **({"cursor": cursor} if cursor else {}))
+            seen += [m["id"] for m in body["messages"]]
+            pages += 1
+            cursor = body["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(set(seen), ids)
+        resp = self.client.get("/api/search", {"q": "coin", "cursor": "not-a-cursor"}, headers=self.auth)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_only_a_bad_cursor_is_a_client_error(self):
+        with mock.patch.object(search_backend.SqliteFtsBackend, "search_messages", side_effect=ValueError("bug")):
+            with self.assertRaises(ValueError):
+                self.client.get("/api/search", {"q": "coin"}, headers=self.auth)
+
+    def test_malformed_queries_are_treated_as_words(self):
+        near = self._say("NEAR the wall")
+        exclude = self._say("x marks the spot")
+        self.assertEqual(self._search('"')["messages"], [])
+        self.assertEqual(self._hits("NEAR("), [near.id])
+        self.assertEqual(self._hits("-x"), [exclude.id])
+        self.assertEqual(self._hits('wall" OR "spot'), [])  # every word must match, OR is just a word
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(self.owner).access_token)}
+        self.messages = [Message.objects.create(conversation=self.conv, role="user", content=f"m{i}") for i in range(7)]
+        # every timestamp tied, so only the id tie-breaker orders them
+        Message.objects.filter(conversation=self.conv).update(created_at=self.messages[0].created_at)
+        self.ids = [m.id for m in self.messages]
+
+    def _get(self, url, **params):
+        resp = self.client.get(url, params, headers=self.auth)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()
+
+    def _walk(self, url, **params):
+        body, ids = self._get(url, **params), []
+        while True:
+            ids += [r["id"] for r in body["results"]]
+            if not body["next"]:
+                return ids
+            body = self._get(body["next"])
+
+    def test_messages_pages_are_stable_when_timestamps_tie(self):
+        url = f"/api/conversations/{self.conv.id}/messages"
+        self.assertEqual(self._walk(url, page_size=3), self.ids)
+        self.assertEqual(self._walk(url, page_size=3, order="desc"), self.ids[::-1])
+        self.assertEqual(self._walk(url, page_size=2, order="asc"), self.ids)
+
+    def test_after_returns_only_newer_messages(self):
+        url = f"/api/conversations/{self.conv.id}/messages"
+        self.assertEqual(self._walk(url, after=self.ids[2], page_size=2), self.ids[3:])  # tied with the anchor, higher id
+        self.assertEqual(self._get(url, after=self.ids[-1])["results"], [])
+        self.assertEqual(self._walk(url, after=self.ids[2], order="desc", page_size=2), self.ids[3:])
+        other = Conversation.objects.create(owner=self.owner, character="Bronn")
+        stranger = Message.objects.create(conversation=other, role="user", content="elsewhere")
+        for bad in ("abc", "-1", str(stranger.id), "999999"):
+            self.assertEqual(self.client.get(url, {"after": bad}, headers=self.auth).status_code, 404, bad)
+
+    def test_conversation_pages_are_stable_when_timestamps_tie(self):
+        convs = [self.conv] + [Conversation.objects.create(owner=self.owner, character="Bronn") for _ in range(4)]
+        Conversation.objects.filter(owner=self.owner).update(updated_at=self.conv.updated_at)
+        expected = sorted((str(c.id) for c in convs), reverse=True)  # newest first, then id descending
+        self.assertEqual(self._walk("/api/conversations", page_size=2), expected)
+
+
+class ConversationDetailTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn", title="t")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(self.owner).access_token)}
+        self.ids = [Message.objects.create(conversation=self.conv, role="user", content=f"m{i}").id for i in range(5)]
+        self.url = f"/api/conversations/{self.conv.id}"
+
+    def _detail(self, **params):
+        resp = self.client.get(self.url, params, headers=self.auth)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()
+
+    def test_metadata_only_by_default(self):
+        body = self._detail()
+        self.assertNotIn("messages", body)
+        self.assertEqual(body["title"], "t")
+
+    def test_tail_returns_latest_messages_oldest_first(self):
+        body = self._detail(tail=3)
+        self.assertEqual([m["id"] for m in body["messages"]], self.ids[2:])
+        self.assertEqual(set(body["messages"][0]), {"id", "role", "content", "meta", "created_at"})
+        self.assertEqual([m["id"] for m in self._detail(tail=50)["messages"]], self.ids)
+
+    def test_tail_bounds(self):
+        for tail in ("0", "-3", "abc", "2.5", ""):
+            self.assertNotIn("messages", self._detail(tail=tail), tail)
+        with mock.patch("chatapi.views.MAX_DETAIL_TAIL", 2):
+            self.assertEqual([m["id"] for m in self._detail(tail=10**6)["messages"]], self.ids[3:])
+
+    def test_tail_is_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._detail(tail=5)
+        tail = [q for q in queries if "chatapi_message" in q["sql"]]
+        self.assertEqual(len(tail), 1)
+
+    def test_other_owner_gets_404(self):
+        stranger = get_user_model().objects.create_user(username="s", password="pw")
+        auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(stranger).access_token)}
+        self.assertEqual(self.client.get(self.url, {"tail": 5}, headers=auth).status_code, 404)
+
+
+class ConversationStatsTests(TestCase):
+    FIELDS = ("message_count", "last_message_at", "last_message_preview", "user_tokens", "assistant_tokens")
+
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(self.owner).access_token)}
+
+    def _stats(self):
+        conv = Conversation.objects.get(pk=self.conv.pk)
+        return {f: getattr(conv, f) for f in self.FIELDS}
+
+    def _post(self, content):
+        resp = self.client.post(f"/api/conversations/{self.conv.id}/messages/create", {"content": content}, headers=self.auth)
+        self.assertEqual(resp.status_code, 201, resp.content)
+        return Message.objects.get(pk=resp.json()["id"])
+
+    def test_create_and_admin_delete_keep_counters_exact(self):
+        first, second = self._post("a" * 40), self._post("the  second\nmessage")
+        stats = self._stats()
+        self.assertEqual(stats, {"message_count": 2, "last_message_at": second.created_at,
+                                 "last_message_preview": "the second message", "user_tokens": 10 + 5,
+                                 "assistant_tokens": 0})
+        self.assertEqual(stats, conversation_stats.computed(self.conv.pk))
+
+        from django.contrib import admin
+        from .admin import MessageAdmin
+        MessageAdmin(Message, admin.site).delete_model(None, second)
+        self.assertEqual(self._stats(), {"message_count": 1, "last_message_at": first.created_at,
+                                         "last_message_preview": "a" * 40, "user_tokens": 10, "assistant_tokens": 0})
+        MessageAdmin(Message, admin.site).delete_queryset(None, Message.objects.filter(pk=first.pk))
+        self.assertEqual(self._stats(), {"message_count": 0, "last_message_at": None, "last_message_preview": "",
+                                         "user_tokens": 0, "assistant_tokens": 0})
+
+    def test_repair_command_fixes_drift(self):
+        self._post("hello there")
+        want = self._stats()
+        other = Conversation.objects.create(owner=self.owner, character="Bronn")
+        Conversation.objects.filter(pk=self.conv.pk).update(message_count=9, last_message_preview="stale", user_tokens=0)
+
+        out = io.StringIO()
+        call_command("repair_conversation_stats", "--dry-run", stdout=out)
+        self.assertIn("checked 2 conversations, would fix 1", out.getvalue())
+        self.assertEqual(self._stats()["message_count"], 9)
+
+        updated_at = Conversation.objects.get(pk=self.conv.pk).updated_at
+        out = io.StringIO()
+        call_command("repair_conversation_stats", str(self.conv.pk), str(other.pk), stdout=out)
+        self.assertIn("checked 2 conversations, fixed 1", out.getvalue())
+        self.assertEqual(self._stats(), want)
+        self.assertEqual(Conversation.objects.get(pk=self.conv.pk).updated_at, updated_at)
+
+
+class _ScriptedProvider:
+    """For the stub server: each request pops the next scripted (status, delay_before_first_token)."""
+
+    WORDS = ["Gold ", "first. ", "Talk ", "later."]
+
+    def __init__(self):
+        self.script, self.hits, self.lock = [], 0, threading.Lock()
+
+    def _next(self):
+        with self.lock:
+            status, delay = self.script.pop(0) if self.script else (200, 0.0)
+            self.hits += 1
+        if status != 200:
+            raise StubHTTPError(status, "scripted failure")
+        return delay
+
+    def stream(self, **params):
+        delay = self._next()
+
+        def deltas():
+            time.sleep(delay)
+            yield from self.WORDS
+        return deltas()
+
+    def complete(self, **params):
+        time.sleep(self._next())
+        return "".join(self.WORDS)
+
+
+class LLMClientManagerTests(SimpleTestCase):
+    def setUp(self):
+        self.provider = _ScriptedProvider()
+        self.server = start_stub_server(self.provider)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _manager(self, **kw):
+        kw.setdefault("backoff_base", 0.01)
+        m = LLMClientManager(base_url=f"http://127.0.0.1:{self.server.server_port}/v1", api_key="test", **kw)
+        self.addCleanup(m.close)
+        m.client  # built lazily; build it now so it doesn't eat into the timings below
+        return m
+
+    def _stream(self, m):
+        return "".join(m.stream(model="fake", messages=[{"role": "user", "content": "hi"}]))
+
+    def test_retries_pre_stream_failures(self):
+        self.provider.script = [(503, 0), (429, 0)]
+        m = self._manager(max_retries=2)
+        with self.assertLogs("chatapi.services.llm_client", "WARNING"):
+            self.assertEqual(self._stream(m), "Gold first. Talk later.")
+        self.assertEqual((self.provider.hits, m.retries), (3, 2))
+
+    def test_client_errors_are_not_retried(self):
+        self.provider.script = [(400, 0)]
+        m = self._manager(max_retries=3)
+        with self.assertRaises(Exception):
+            self._stream(m)
+        self.assertEqual(self.provider.hits, 1)
+
+    def test_first_token_timeout(self):
+        self.provider.script = [(200, 0.5), (200, 0.5)]
+        m = self._manager(max_retries=1, first_token_timeout=0.1)
+        with self.assertRaises(FirstTokenTimeout), self.assertLogs("chatapi.services.llm_client", "WARNING"):
+            self._stream(m)
+        self.assertEqual(self.provider.hits, 2)
+
+    def test_without_hedging_the_stream_is_read_inline(self):
+        m = self._manager()
+        with mock.patch.object(llm_client, "_Attempt", side_effect=AssertionError("pump thread started")):
+            self.assertEqual(self._stream(m), "Gold first. Talk later.")
+        self.assertEqual(self.provider.hits, 1)
+
+    def test_hedged_request_keeps_faster_stream(self):
+        self.provider.script = [(200, 1.0), (200, 0.0)]
+        m = self._manager(hedge=True, hedge_after=0.1)
+        started = time.monotonic()
+        self.assertEqual(self._stream(m), "Gold first. Talk later.")
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual((m.hedges, m.hedge_wins), (1, 1))
+
+    def test_async_stream_and_complete(self):
+        self.provider.script = [(502, 0)]
+        m = self._manager()
+
+        async def collect():
+            return "".join([d async for d in m.astream(model="fake", messages=[{"role": "user", "content": "hi"}])])
+
+        with self.assertLogs("chatapi.services.llm_client", "WARNING"):
+            self.assertEqual(asyncio.run(collect()), "Gold first. Talk later.")
+        self.provider.script = [(500, 0)]
+        self.assertEqual(m.complete(model="fake", messages=[{"role": "user", "content": "hi"}]), "Gold first. Talk later.")
+        self.assertEqual(m.retries, 2)
+
+
+class FakeProviderTests(SimpleTestCase):
+    params = {"model": "fake", "messages": [{"role": "user", "content": "gold?"}], "max_tokens": 1000}
+
+    def test_distribution_specs(self):
+        import random
+        rng = random.Random(1)
+        self.assertEqual(Distribution("250").sample(rng), 250.0)
+        self.assertTrue(100 <= Distribution("uniform:100,400").sample(rng) <= 400)
+        with self.assertRaises(ValueError):
+            Distribution("uniform:5")
+
+    def test_replies_are_deterministic_and_paced(self):
+        p = FakeProvider(tokens="uniform:20,40", tokens_per_sec=500, ttft_ms="lognormal:20,0.5", seed=7)
+        ttft, words = p.plan(**self.params)
+        started = time.monotonic()
+        streamed = list(p.stream(**self.params))
+        elapsed = time.monotonic() - started
+        self.assertEqual(streamed, words)
+        self.assertEqual(p.plan(**self.params), (ttft, words))
+        self.assertTrue(20 <= len(words) <= 40)
+        self.assertGreaterEqual(elapsed, ttft + (len(words) - 1) / 500)
+        other = dict(self.params, messages=[{"role": "user", "content": "steel?"}])
+        self.assertNotEqual(p.plan(**other)[1], words)
+        self.assertEqual(len(FakeProvider(tokens="50", ttft_ms="0").plan(**dict(self.params, max_tokens=10))[1]), 10)
+
+    def test_stub_server_speaks_openai(self):
+        p = FakeProvider(tokens="30", tokens_per_sec=0, ttft_ms="0")
+        server = start_stub_server(p)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        m = LLMClientManager(base_url=f"http://127.0.0.1:{server.server_port}/v1", api_key="unused")
+        self.addCleanup(m.close)
+        expected = "".join(p.plan(**self.params)[1])
+        self.assertEqual("".join(m.stream(**self.params)), expected)
+        self.assertEqual(m.complete(**self.params), expected.strip())
+
+
+@override_settings(CHAT_METRICS_ENABLED=True, CHAT_METRICS_TOKEN="", CHAT_SUMMARY_ENABLED=False, CHAT_CACHE_ENABLED=False,
+                   CHAT_STREAM_COALESCE_MS=0)
+class ReplyMetricsTests(TransactionTestCase):  # replies are generated on a producer thread
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        set_llm_provider(FakeProvider(tokens="12", tokens_per_sec=0, ttft_ms="0"))
+        self.addCleanup(set_llm_provider, None)
+        admission._controller = None
+        self.addCleanup(setattr, admission, "_controller", None)
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Tyrion Lannister")
+
+    def _request(self, conversation_id=None):
+        token = str(RefreshToken.for_user(self.owner).access_token)
+        body = {"conversation_id": str(conversation_id or self.conv.id), "prompt": "wine?"}
+        return RequestFactory().post("/api/chat/stream", json.dumps(body), content_type="application/json",
+                                     headers={"Authorization": "Bearer " + token})
+
+    def _stream(self):
+        resp = chat_stream_view(self._request())
+        body = b"".join(resp.streaming_content)
+        resp.close()
+        return body
+
+    def test_reply_is_traced_per_persona(self):
+        self.assertEqual(self._stream().count(b"event: token"), 12)
+        text = self.client.get("/metrics").content.decode()
+        for stage in ("auth", "conversation", "insert", "history", "llm_first_token", "save"):
+            self.assertIn(f'chat_stage_seconds_count{{stage="{stage}",persona="tyrion"}} 1.0', text)
+        self.assertIn('chat_stream_tokens_sum{persona="tyrion"} 12.0', text)
+        self.assertIn('chat_time_to_first_token_seconds_count{persona="tyrion"} 1.0', text)
+        self.assertIn('chat_replies_total{persona="tyrion",outcome="ok"} 1.0', text)
+        self.assertRegex(text, r'chat_db_queries_sum\{persona="tyrion"\} [1-9]')
+
+    def test_trace_is_not_left_current_on_the_request_thread(self):
+        # request threads are reused: a later request's queries must not be charged to this reply
+        resp = chat_stream_view(self._request())
+        self.assertIs(metrics.current(), metrics.NOOP)
+        b"".join(resp.streaming_content)
+        resp.close()
+        with self.assertRaises(Http404):
+            chat_stream_view(self._request(conversation_id="00000000-0000-0000-0000-000000000000"))
+        self.assertIs(metrics.current(), metrics.NOOP)
+
+    def test_disabled_records_nothing(self):
+        with override_settings(CHAT_METRICS_ENABLED=False):
+            self._stream()
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+        self.assertNotIn("persona=", metrics.render())
+
+    def test_scrape_token(self):
+        with override_settings(CHAT_METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code, 200)
+
+
+class SSECoalesceTests(SimpleTestCase):
+    @staticmethod
+    def _paced(gaps):
+        for i, gap in enumerate(gaps):
+            time.sleep(gap)
+            yield f"t{i} "
+
+    def test_merges_within_window_and_never_delays_first_token(self):
+        frames = list(sse.coalesce(self._paced([0.05] + [0.0] * 9), window_ms=1000, max_chars=1000))
+        self.assertEqual(frames, ["t0 ", "".join(f"t{i} " for i in range(1, 10))])
+        frames = list(sse.coalesce(self._paced([0.0] * 10), window_ms=1000, max_chars=6))
+        self.assertEqual(frames[0], "t0 ")
+        self.assertTrue(all(len(f) <= 6 for f in frames))
+        self.assertEqual("".join(frames), "".join(f"t{i} " for i in range(10)))
+        self.assertEqual(len(list(sse.coalesce(self._paced([0.0] * 5), window_ms=0))), 5)
+
+    def test_async_flushes_on_deadline_when_upstream_stalls(self):
+        async def upstream():
+            for delta, gap in (("a", 0), ("b", 0), ("c", 0), ("d", 0.3)):
+                await asyncio.sleep(gap)
+                yield delta
+
+        async def run():
+            out, t0 = [], time.monotonic()
+            async for frame in sse.acoalesce(upstream(), window_ms=50, max_chars=1000):
+                out.append((frame, time.monotonic() - t0))
+            return out
+
+        frames = asyncio.run(run())
+        self.assertEqual([f for f, _ in frames], ["a", "bc", "d"])
+        self.assertLess(frames[1][1], 0.2)  # "bc" didn't wait for the stalled "d"
+
+    def test_closing_early_closes_upstream_with_and_without_a_window(self):
+        for window_ms in (0, 50):
+            closed = []
+
+            def upstream():
+                try:
+                    yield from ("a", "b", "c")
+                finally:
+                    closed.append("sync")
+
+            async def aupstream():
+                try:
+                    for delta in ("a", "b", "c"):
+                        yield delta
+                finally:
+                    closed.append("async")
+
+            async def first_frame():
+                frames = sse.acoalesce(aupstream(), window_ms=window_ms)
+                frame = await frames.__anext__()
+                await frames.aclose()
+                return frame, list(closed)  # before asyncio.run finalizes leftover generators
+
+            frames = sse.coalesce(upstream(), window_ms=window_ms)
+            self.assertEqual(next(frames), "a")
+            frames.close()
+            self.assertEqual(asyncio.run(first_frame()), ("a", ["sync", "async"]), window_ms)
+
+    def test_compact_frame_is_a_json_string(self):
+        frame = sse.token_frame('say "hi"\n', sse.COMPACT)
+        self.assertEqual(json.loads(frame.decode()[len("data:"):].strip()), 'say "hi"\n')
+        self.assertTrue(sse.token_frame("x").startswith(b"event: token\n"))
+
+
+class _ClosingProvider:
+    """Wraps a provider to record how many deltas it produced and whether its stream was closed early."""
+
+    def __init__(self, provider):
+        self.provider, self.sent, self.closed = provider, 0, False
+
+    def stream(self, **params):
+        try:
+            for delta in self.provider.stream(**params):
+                self.sent += 1
+                yield delta
+        except GeneratorExit:
+            self.closed = True
+            raise
+
+
+class _RefusingProvider:
+    def stream(self, **params):
+        raise ConnectionError("upstream refused the request")
+
+
+@override_settings(CHAT_CACHE_ENABLED=True, CHAT_CACHE_BACKEND="memory", CHAT_CACHE_TTL=60, CHAT_METRICS_ENABLED=True)
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        response_cache._cache = None
+        self.addCleanup(setattr, response_cache, "_cache", None)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.provider = _ClosingProvider(FakeProvider(tokens="5", tokens_per_sec=0, ttft_ms="0"))
+        set_llm_provider(self.provider)
+        self.addCleanup(set_llm_provider, None)
+
+    def _reply(self, prompt="hi", persona="Bronn", history=()):
+        return "".join(bot_service.stream_tokens(prompt, persona=persona, history=list(history)))
+
+    def test_hit_replays_without_going_upstream(self):
+        first = self._reply()
+        self.assertEqual(self.provider.sent, 5)
+        self.assertEqual(self._reply(), first)
+        self.assertEqual(self.provider.sent, 5)
+        stats = response_cache.get_response_cache().stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["stores"], stats["hit_rate"]), (1, 1, 1, 0.5))
+        text = metrics.render()
+        self.assertIn('chat_response_cache_total{result="hit"} 1.0', text)
+        self.assertIn('chat_response_cache_total{result="miss"} 1.0', text)
+
+    def test_key_covers_persona_history_and_prompt(self):
+        self._reply()
+        self._reply(persona="Tyrion")
+        self._reply(history=[{"role": "user", "content": "earlier"}])
+        self._reply(prompt="hello")
+        self.assertEqual(self.provider.sent, 20)
+        self.assertEqual(response_cache.get_response_cache().stats()["hits"], 0)
+
+    def test_entries_expire_after_ttl(self):
+        for now, sent in ((1000.0, 5), (1059.0, 5), (1061.0, 10)):
+            with mock.patch.object(response_cache.time, "monotonic", return_value=now):
+                self._reply()
+            self.assertEqual(self.provider.sent, sent)
+
+    def test_failure_to_open_the_stream_is_not_cached(self):
+        set_llm_provider(_RefusingProvider())
+        with self.assertLogs("chatapi.services.bot_service", "ERROR"):
+            self.assertEqual(self._reply(), bot_service.FAILURE_REPLY)
+        set_llm_provider(self.provider)
+        self._reply()
+        self.assertEqual(self.provider.sent, 5)
+
+
+@override_settings(CHAT_STREAM_COALESCE_MS=0, CHAT_SUMMARY_ENABLED=False)
+class ResumableStreamTests(TransactionTestCase):
+    def setUp(self):
+        set_llm_provider(FakeProvider(tokens="8", tokens_per_sec=0, ttft_ms="0"))
+        self.addCleanup(set_llm_provider, None)
+        replay._buffer = None
+        self.addCleanup(setattr, replay, "_buffer", None)
+        admission._controller = None
+        self.addCleanup(setattr, admission, "_controller", None)
+        self.owner = get_user_model().objects.create_user(username="u", password="pw")
+        self.conv = Conversation.objects.create(owner=self.owner, character="Bronn")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(self.owner).access_token)}
+
+    @staticmethod
+    def _events(resp):
+        body = b"".join(resp.streaming_content).decode()
+        resp.close()
+        return ResumableStreamTests._parse(body)
+
+    @staticmethod
+    def _parse(body):
+        events = []
+        for block in filter(None, body.split("\n\n")):
+            fields = dict(line.split(": ", 1) for line in block.split("\n"))
+            events.append((fields.get("event"), fields.get("id"), json.loads(fields["data"])))
+        return events
+
+    def _resume(self, message_id, last_id):
+        request = RequestFactory().get(f"/api/chat/{message_id}/stream", headers={**self.auth, "Last-Event-ID": str(last_id)})
+        return self._events(chat_resume_view(request, message_id=message_id))
+
+    def test_token_ids_are_offsets_and_resume_replays_the_rest(self):
+        request = RequestFactory().post("/api/chat/stream", json.dumps({"conversation_id": str(self.conv.id), "prompt": "hi"}),
+                                        content_type="application/json", headers=self.auth)
+        events = self._events(chat_stream_view(request))
+        message_id = events[0][2]["message_id"]
+        tokens = [(int(i), d["delta"]) for name, i, d in events if name == "token"]
+        text = "".join(d for _, d in tokens)
+        self.assertEqual([i for i, _ in tokens], [len("".join(d for _, d in tokens[:n + 1])) for n in range(len(tokens))])
+
+        resumed = self._resume(message_id, tokens[2][0])
+        self.assertEqual(resumed[0][2]["resumed_from"], tokens[2][0])
+        self.assertEqual("".join(d["delta"] for name, _, d in resumed if name == "token"), text[tokens[2][0]:])
+        self.assertEqual(resumed[-1][2]["status"], replay.COMPLETE)
+
+        replay._buffer = replay.ReplayBuffer()  # buffer gone: served from the saved row
+        resumed = self._resume(message_id, 3)
+        self.assertEqual([d["delta"] for name, _, d in resumed if name == "token"], [text[3:]])
+        self.assertEqual(resumed[-1][2]["status"], "saved")
+        stranger = get_user_model().objects.create_user(username="v", password="pw")
+        self.auth = {"Authorization": "Bearer " + str(RefreshToken.for_user(stranger).access_token)}
+        with self.assertRaises(Http404):
+            self._resume(message_id, 0)
+
+    def test_async_view_streams_and_saves_the_reply(self):
+        async def run():
+            request = AsyncRequestFactory().post("/api/chat/stream", json.dumps({"conversation_id": str(self.conv.id), "prompt": "hi"}),
+                                                 content_type="application/json", headers=self.auth)
+            resp = await chat_stream_async_view(request)
+            return b"".join([chunk async for chunk in resp.streaming_content]).decode()
+
+        events = self._parse(asyncio.run(run()))
+        self.assertEqual([name for name, _, _ in events], ["start"] + ["token"] * 8 + ["end"])
+        self.assertEqual(events[-1][2]["status"], replay.COMPLETE)
+        text = "".join(d["delta"] for name, _, d in events if name == "token")
+        saved = Message.objects.get(pk=events[0][2]["message_id"])
+        self.assertEqual(saved.content, text)
+        self.assertEqual(saved.meta["tokens"], with_token_count(text)["tokens"])
+        self.assertEqual(Message.objects.filter(conversation=self.conv, role="user", content="hi").count(), 1)
+
+    def test_stream_keeps_conversation_stats_in_sync(self):
+        request = RequestFactory().post("/api/chat/stream", json.dumps({"conversation_id": str(self.conv.id), "prompt": "hi"}),
+                                        content_type="application/json", headers=self.auth)
+        events = self._events(chat_stream_view(request))
+        reply = Message.objects.get(pk=events[0][2]["message_id"])
+        conv = Conversation.objects.get(pk=self.conv.pk)
+        self.assertEqual((conv.message_count, conv.last_message_at, conv.last_message_preview),
+                         (2, reply.created_at, conversation_stats.preview_of(reply.content)))
+        self.assertEqual((conv.user_tokens, conv.assistant_tokens), (1, reply.meta["tokens"]))
+        self.assertEqual(conversation_stats.computed(conv.pk),
+                         {f: getattr(conv, f) for f in conversation_stats.computed(conv.pk)})
+
+    def test_reply_outlives_its_stream_and_fans_out(self):
+        set_llm_provider(FakeProvider(tokens="20", tokens_per_sec=200, ttft_ms="0"))
+        request = RequestFactory().post("/api/chat/stream", json.dumps({"conversation_id": str(self.conv.id), "prompt": "hi"}),
+                                        content_type="application/json", headers=self.auth)
+        resp = chat_stream_view(request)
+        chunks = iter(resp.streaming_content)
+        message_id = json.loads(next(chunks).decode().split("data: ", 1)[1])["message_id"]
+        next(chunks)
+        resp.close()  # browser went away after the first token
+
+        watcher = self._resume(message_id, 0)  # e.g. a second tab, from the start
+        self.assertEqual(watcher[-1][2]["status"], replay.COMPLETE)
+        text = "".join(d["delta"] for name, _, d in watcher if name == "token")
+        self.assertEqual(len(text.split()), 20)
+        saved = Message.objects.get(pk=message_id)
+        self.assertEqual(saved.content, text)
+        self.assertEqual(saved.meta["tokens"], with_token_count(text)["tokens"])
+
+    def _start(self, tokens):
+        provider = _ClosingProvider(FakeProvider(tokens=str(tokens), tokens_per_sec=200, ttft_ms="0"))
+        set_llm_provider(provider)
+        request = RequestFactory().post("/api/chat/stream", json.dumps({"conversation_id": str(self.conv.id), "prompt": "hi"}),
+                                        content_type="application/json", headers=self.auth)
+        resp = chat_stream_view(request)
+        chunks = iter(resp.streaming_content)
+        message_id = json.loads(next(chunks).decode().split("data: ", 1)[1])["message_id"]
+        next(chunks)
+        return provider, resp, chunks, message_id
+
+    def test_cancel_stops_upstream_and_saves_partial_reply(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        with override_settings(CHAT_METRICS_ENABLED=True):
+            self._resume(self._start(10)[3], 0)  # one complete reply: the baseline for tokens saved
+            provider, resp, chunks, message_id = self._start(200)
+            cancel = lambda: chat_cancel_view(RequestFactory().post(f"/api/chat/{message_id}/cancel", headers=self.auth),
+                                              message_id=message_id)
+            self.assertEqual(cancel().status_code, 202)
+            rest = b"".join(chunks).decode()
+            resp.close()
+        self.assertIn('"status": "cancelled"', rest)
+        self.assertTrue(provider.closed)
+        self.assertLess(provider.sent, 200)
+        saved = Message.objects.get(pk=message_id)
+        self.assertTrue(saved.meta["cancelled"])
+        self.assertLess(len(saved.content.split()), 200)
+        self.assertEqual(cancel().status_code, 409)
+        text = metrics.render()
+        self.assertIn('chat_cancelled_replies_total{persona="bronn",reason="client"} 1.0', text)
+        self.assertRegex(text, r'chat_cancelled_tokens_saved_total\{persona="bronn",reason="client"\} [1-9]')
+
+    @override_settings(CHAT_DISCONNECT_GRACE=0)
+    def test_reply_without_viewers_is_stopped(self):
+        provider, resp, chunks, message_id = self._start(200)
+        resp.close()  # tab closed, nobody resumes
+        for _ in range(100):
+            meta = Message.objects.get(pk=message_id).meta or {}
+            if "tokens" in meta:
+                break
+            time.sleep(0.05)
+        self.assertTrue(meta.get("cancelled"))
+        self.assertLess(provider.sent, 200)
+        self.assertEqual(self._resume(message_id, 0)[-1][2]["status"], replay.CANCELLED)
+
+    def test_follow_tails_a_running_reply(self):
+        for buffer in (replay.LocalReplayBuffer(max_frames=4, poll_ms=5), replay.CacheReplayBuffer(poll_ms=5)):
+            buffer.open(7)
+            buffer.publish(7, "ab")
+            buffer.publish(7, "cd")
+
+            def produce():
+                for part in ("ef", "gh", "ij"):
+                    time.sleep(0.02)
+                    buffer.publish(7, part)
+                buffer.close(7, replay.INTERRUPTED)
+
+            threading.Thread(target=produce).start()
+            snaps = list(buffer.follow(7, after=3))
+            self.assertEqual([f for s in snaps for f in s.frames], [(4, "d"), (6, "ef"), (8, "gh"), (10, "ij")])
+            self.assertEqual(snaps[-1].status, replay.INTERRUPTED)
+        ring = replay.LocalReplayBuffer(max_frames=1)
+        ring.publish(7, "ab")
+        ring.publish(7, "cd")
+        with self.assertRaises(replay.Unavailable):  # "ab" rotated out of the one-frame ring
+            list(ring.follow(7, after=1))
+
+
+class AdmissionTests(TransactionTestCase):
+    def setUp(self):
+        admission._controller = None
+        self.addCleanup(setattr, admission, "_controller", None)
+
+    @staticmethod
+    def _stores():
+        from django.core.cache import cache
+        cache.delete("chatadmit-test")
+        return admission.LocalStore(0.005), admission.CacheStore(0.005, key="chatadmit-test")
+
+    def test_token_bucket(self):
+        gate = admission.AdmissionController(admission.LocalStore(0.005), rate=60, burst=2)
+        gate.release(gate.acquire("a"))
+        gate.release(gate.acquire("a"))
+        with self.assertRaises(admission.Rejected) as err:
+            gate.acquire("a")
+        self.assertEqual((err.exception.reason, err.exception.retry_after), ("rate", 1))
+        gate.release(gate.acquire("b"))  # buckets are per user
+
+    def test_freed_slots_go_round_robin_across_users(self):
+        for store in self._stores():
+            gate = admission.AdmissionController(store, rate=0, user_limit=1, global_limit=1, max_wait=5)
+            held, order, threads = gate.acquire("a"), [], []
+
+            def wait(user):
+                lease = gate.acquire(user)
+                order.append(user)
+                time.sleep(0.01)
+                gate.release(lease)
+
+            for user in ("a", "a", "b"):  # a's backlog arrived first
+                threads.append(threading.Thread(target=wait, args=(user,)))
+                threads[-1].start()
+                while store.transact(lambda state: len(state["queue"])) < len(threads):
+                    time.sleep(0.005)
+            gate.release(held)
+            for t in threads:
+                t.join()
+            self.assertEqual(order, ["b", "a", "a"])
+
+    def test_arrival_is_admitted_past_waiters_that_cannot_use_a_slot(self):
+        for store in self._stores():
+            gate = admission.AdmissionController(store, rate=0, user_limit=1, global_limit=2)
+            held = gate.acquire("a")
+            self.assertIsNone(store.transact(gate._arrive("a", "a-waiter")))  # over a's own limit: queued
+            lease = store.transact(gate._arrive("b", "b-waiter"))  # the free slot is b's, no queueing behind a
+            self.assertIsInstance(lease, str)
+            self.assertEqual(store.transact(lambda state: [w[0] for w in state["queue"]]), ["a-waiter"])
+            self.assertIsNone(store.transact(gate._arrive("c", "c-waiter")))  # no slot left
+            gate.release(admission.Lease(lease, "b"))
+            gate.release(held)
+
+    @override_settings(CHAT_ADMIT_BACKEND="local", CHAT_ADMIT_GLOBAL_CONCURRENCY=64, CHAT_PRODUCER_WORKERS=8,
+                       CHAT_STREAM_ASYNC=False)
+    def test_global_limit_is_capped_at_the_producer_pool(self):
+        with self.assertLogs("chatapi.services.admission", "WARNING"):
+            self.assertEqual(admission.get_admission().global_limit, 8)
+        admission._controller = None
+        with self.settings(CHAT_STREAM_ASYNC=True):
+            self.assertEqual(admission.get_admission().global_limit, 64)
+        admission._controller = None
+        with self.settings(CHAT_ADMIT_BACKEND="cache"):  # shared by every worker process
+            self.assertEqual(admission.get_admission().global_limit, 64)
+
+    def test_overflow_and_timeout_are_rejected(self):
+        for store in self._stores():
+            gate = admission.AdmissionController(store, rate=0, user_limit=1, max_wait=0.1, user_queue=0)
+            held = gate.acquire("a")
+            with self.assertRaises(admission.Rejected) as err:
+                gate.acquire("a")
+            self.assertEqual(err.exception.reason, "user_queue")
+            gate.user_queue = 1
+            started = time.monotonic()
+            with self.assertRaises(admission.Rejected) as err:
+                gate.acquire("a")
+            self.assertEqual(err.exception.reason, "timeout")
+            self.assertGreaterEqual(time.monotonic() - started, 0.1)
+            gate.release(gate.acquire("b"))  # other users are unaffected
+            gate.release(held)
+            gate.release(gate.acquire("a"))
+
+    @override_settings(CHAT_ADMIT_BURST=1, CHAT_SUMMARY_ENABLED=False, CHAT_STREAM_COALESCE_MS=0)
+    def test_view_answers_429_before_creating_rows(self):
+        set_llm_provider(FakeProvider(tokens="4", tokens_per_sec=0, ttft_ms="0"))
+        self.addCleanup(set_llm_provider, None)
+        owner = get_user_model().objects.create_user(username="u", password="pw")
+        conv = Conversation.objects.create(owner=owner, character="Bronn")
+        request = lambda: RequestFactory().post(
+            "/api/chat/stream", json.dumps({"conversation_id": str(conv.id), "prompt": "hi"}), content_type="application/json",
+            headers={"Authorization": "Bearer " + str(RefreshToken.for_user(owner).access_token)})
+        resp = chat_stream_view(request())
+        self.assertIn(b"event: end", b"".join(resp.streaming_content))
+        resp.close()
+        rows = Message.objects.count()
+        resp = chat_stream_view(request())
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp["Retry-After"], "2")  # 30/min: the next token is 2 s away
+        self.assertEqual(json.loads(resp.content)["reason"], "rate")
+        self.assertEqual(Message.objects.count(), rows)
+
+
+class CompilePersonasTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        chatbot = os.path.join(settings.BASE_DIR.parent, "chatbot")
+        for name in ("bronn_kb.jsonl", "bronn_style.yml"):
+            shutil.copy(os.path.join(chatbot, name), self.dir)
+        self.kb = os.path.join(self.dir, "bronn_kb.jsonl")
+        self.style = os.path.join(self.dir, "bronn_style.yml")
+        self.cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache)
+        patcher = mock.patch.dict(os.environ, {"PERSONA_CACHE_DIR": self.cache})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _compile(self):
+        out, err = io.StringIO(), io.StringIO()
+        call_command("compile_personas", dir=self.dir, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_compiled_kb_matches_jsonl(self):
+        out, _ = self._compile()
+        from chatbot import bot  # importable once the command has put the repo root on sys.path
+        artifact = bot.kbpack.artifact_path(self.kb)
+        self.assertIn(artifact, out)
+        self.assertTrue(artifact.startswith(self.cache + os.sep) and os.path.exists(artifact))
+        self.assertEqual(sorted(os.listdir(self.dir)), ["bronn_kb.jsonl", "bronn_style.yml"])
+        self.addCleanup(bot.ASSETS.clear)
+        bot.ASSETS.clear()
+        assets = bot.get_persona_assets(self.kb, self.style)
+        self.assertIsInstance(assets.index, bot.CompiledIndex)
+        plain = bot.RetrievalIndex(bot._load_kb(self.kb), assets.style)
+        for q in ("tell me about the Blackwater", "who are you?", "gold and the trial by combat"):
+            self.assertEqual([e["id"] for e in assets.index.top_k(q, 5)], [e["id"] for e in plain.top_k(q, 5)])
+        with open(self.kb, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": "BRONN-NEW", "summary": "A new entry", "tags": ["quillmaker"]}) + "\n")
+        # the artifact is now stale: falls back to the JSONL (and sees the new row)
+        with self.assertLogs("chatbot.kbpack", "WARNING"):
+            assets = bot.get_persona_assets(self.kb, self.style)
+        self.assertNotIsInstance(assets.index, bot.CompiledIndex)
+        self.assertEqual(assets.index.top("quillmaker")["id"], "BRONN-NEW")
+
+    def test_semantic_mode_without_numpy_is_reported(self):
+        bot = _chatbot()
+        style = os.path.join(self.dir, "semantic_style.yml")
+        with open(style, "w", encoding="utf-8") as f:
+            f.write("retrieval:\n  mode: semantic\n")
+        with mock.patch.object(bot.embeddings, "np", None):
+            self.assertEqual(bot.validate_style(style), ["retrieval.mode semantic needs numpy, which is not installed"])
+        self.assertEqual(bot.validate_style(style), [])
+
+    def test_shipped_personas_validate(self):
+        out, err = io.StringIO(), io.StringIO()
+        call_command("compile_personas", check=True, stdout=out, stderr=err)
+        self.assertEqual(err.getvalue(), "")
+        self.assertIn("arya:", out.getvalue())
+        from chatbot import bot
+        self.addCleanup(bot.ASSETS.clear)
+        prompt = bot.build_system_prompt("Arya Stark", "Needle", kb_path=os.path.join(settings.BASE_DIR.parent, "chatbot", "arya_kb.jsonl"),
+                                         style_path=os.path.join(settings.BASE_DIR.parent, "chatbot", "arya_style.yml"))
+        self.assertTrue(prompt.startswith("Roleplay as Arya Stark"))  # a plain-string system: is the IC template
+
+    def test_validation_errors_are_reported(self):
+        with open(self.kb, "a", encoding="utf-8") as f:
+            f.write('{"id": "BRONN-0001", "summary": "dup"}\n{not json\n{"id": "X", "tags": "gold"}\n')
+        with self.assertRaises(CommandError):
+            self._compile()
+        from chatbot import bot
+        report = bot.compile_persona(self.kb, self.style, write=False)
+        self.assertEqual(len(report["errors"]), 4)
+        self.assertTrue(any("duplicate id 'BRONN-0001'" in e for e in report["errors"]))
+        self.assertTrue(any("invalid JSON" in e for e in report["errors"]))
+        self.assertFalse(os.path.exists(bot.kbpack.artifact_path(self.kb)))
+
+
+def _chatbot():
+    """chatbot.bot, with the repo root on sys.path as the management commands arrange."""
+    root = str(settings.BASE_DIR.parent)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    from chatbot import bot
+    return bot
+
+
+def _linear_top(bot, query, kb, style):
+    """The per-entry scan retrieval used before the inverted index, as the reference ranking."""
+    toks = bot._tokenize(query)
+    tag_w, alias_w, sum_w, tie = bot._ranking(style)
+    best, best_s = None, 0
+    for e in kb:
+        s = sum(tag_w for tag in e["tags"] for tok in bot._tokenize(tag) if tok in toks)
+        s += sum(alias_w for alias in e["aliases"] for tok in bot._tokenize(alias) if tok in toks)
+        s += sum(sum_w for tok in bot._tokenize(e["summary"])[:15] if tok in toks)
+        if s > best_s or (s == best_s and s > 0 and bot._tie_key(e, tie) > bot._tie_key(best, tie)):
+            best, best_s = e, s
+    return best
+
+
+class PersonaAssetTests(SimpleTestCase):
+    def setUp(self):
+        self.bot = _chatbot()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        chatbot = os.path.join(settings.BASE_DIR.parent, "chatbot")
+        for persona in ("bronn", "tyrion", "arya"):
+            for suffix in ("_kb.jsonl", "_style.yml"):
+                shutil.copy(os.path.join(chatbot, persona + suffix), self.dir)
+        self.cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache)
+        patcher = mock.patch.dict(os.environ, {"PERSONA_CACHE_DIR": self.cache})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _paths(self, persona):
+        return os.path.join(self.dir, persona + "_kb.jsonl"), os.path.join(self.dir, persona + "_style.yml")
+
+    def test_registry_reloads_changed_files_and_evicts_lru(self):
+        registry = self.bot.AssetRegistry(max_personas=2)
+        bronn = registry.get(*self._paths("bronn"))
+        self.assertIs(registry.get(*self._paths("bronn")), bronn)
+
+        kb = self._paths("bronn")[0]
+        with open(kb, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": "BRONN-NEW", "summary": "A new entry", "tags": ["quillmaker"]}) + "\n")
+        mtime = os.stat(kb).st_mtime_ns + 10**9
+        os.utime(kb, ns=(mtime, mtime))
+        reloaded = registry.get(*self._paths("bronn"))
+        self.assertIsNot(reloaded, bronn)
+        self.assertEqual(len(reloaded.kb), len(bronn.kb) + 1)
+        self.assertEqual(reloaded.index.top("quillmaker")["id"], "BRONN-NEW")
+
+        registry.get(*self._paths("tyrion"))
+        registry.get(*self._paths("bronn"))  # now most recently used
+        registry.get(*self._paths("arya"))   # evicts tyrion
+        self.assertIs(registry.get(*self._paths("bronn")), reloaded)
+        self.assertEqual(registry.stats(), {"size": 2, "hits": 3, "misses": 3, "reloads": 1, "evictions": 1})
+        registry.get(*self._paths("tyrion"))
+        self.assertEqual(registry.stats()["misses"], 4)
+
+    def test_compiled_prompt_is_reused_and_only_knowledge_varies(self):
+        kb, style = self._paths("bronn")
+        self.addCleanup(self.bot.ASSETS.clear)
+        assets = self.bot.get_persona_assets(kb, style)
+        build = lambda query: self.bot.build_system_prompt("Bronn", query, kb_path=kb, style_path=style)
+        blackwater, gold, ooc = build("tell me about the Blackwater"), build("gold"), build("[[OOC]] gold")
+        ic = assets.prompt("Bronn", False)
+        self.assertIs(assets.prompt("Bronn", False), ic)
+        for prompt in (blackwater, gold):
+            self.assertTrue(prompt.startswith(ic.prefix + "\n\n# Knowledge\n"))
+            self.assertTrue(prompt.endswith(ic.suffix.strip()))
+        self.assertNotEqual(blackwater, gold)
+        self.assertTrue(ooc.startswith(assets.prompt("Bronn", True).prefix))
+        self.assertNotEqual(assets.prompt("Bronn", True).prefix, ic.prefix)
+        fresh = self.bot._compile_prompt("Bronn", assets.style, False)
+        self.assertEqual((fresh.prefix, fresh.suffix), (ic.prefix, ic.suffix))
+
+    def test_index_matches_linear_scan(self):
+        rng = random.Random(7)
+        for persona in ("bronn", "tyrion", "arya"):
+            assets = self.bot.AssetRegistry().get(*self._paths(persona))
+            vocab = sorted({tok for e in assets.kb for tok in self.bot._tokenize(" ".join(e["tags"] + [e["summary"]]))})
+            for _ in range(200):
+                query = " ".join(rng.sample(vocab, rng.randint(1, 6)) + ["the", "zzz"])
+                expected = _linear_top(self.bot, query, assets.kb, assets.style)
+                self.assertEqual(assets.index.top(query), expected, query)
+
+    def test_top_k_is_the_full_sort_prefix_with_tie_breakers(self):
+        style = {"retrieval": {"tie_breakers": ["higher weight", "book+show over single-canon"]}}
+        rng = random.Random(3)
+        kb = [self.bot.kbpack.normalize_entry({
+            "id": f"E{i}", "summary": "gold" if i % 3 else "gold and steel", "tags": rng.sample(["sword", "wine", "gold"], 2),
+            "weight": rng.choice([0, 1]), "canon": rng.choice([["book"], ["book", "show"]])}) for i in range(40)]
+        index = self.bot.RetrievalIndex(kb, style)
+        tie = style["retrieval"]["tie_breakers"]
+        for query in ("gold", "gold steel", "sword wine", "wine"):
+            scores = index.scores(query)
+            full = sorted(scores, key=lambda pos: (-scores[pos], tuple(-v for v in self.bot._tie_key(kb[pos], tie)), pos))
+            for k in (1, 3, 10, 50):
+                self.assertEqual([e["id"] for e in index.top_k(query, k)], [kb[pos]["id"] for pos in full[:k]])
+        self.assertEqual(index.top_k("gold", 0), [])
+
+    def test_kb_lines_fill_the_token_budget_best_first(self):
+        hits = [{"summary": "x" * 40, "ic_reply": "y" * 40}, {"summary": "z" * 40, "ic_reply": "never seeded"},
+                {"summary": "w" * 40}]
+        lines = self.bot._kb_lines(hits, False, budget=40)  # 27 tokens for the first hit, 13 per later one
+        self.assertEqual(lines, ["- [[KB]] " + "x" * 40, "- [[IC seed]] " + "y" * 40, "- [[KB]] " + "z" * 40])
+        self.assertEqual(len(self.bot._kb_lines(hits, False, budget=1000)), 4)
+        self.assertEqual(len(self.bot._kb_lines(hits, False, budget=0)), 2)  # the best hit is always kept
+
+    @skipUnless(importlib.util.find_spec("numpy"), "semantic retrieval needs numpy")
+    def test_vectors_are_cached_outside_the_kb_directory_and_reused(self):
+        embeddings = self.bot.embeddings
+        kb_path = self._paths("bronn")[0]
+        kb = self.bot.AssetRegistry().get(*self._paths("bronn")).kb
+        before = sorted(os.listdir(self.dir))
+        built = embeddings.VectorIndex.load_or_build(kb, kb_path, embeddings.HashingEmbedder())
+        npy, meta = embeddings.vector_paths(kb_path)
+        self.assertTrue(npy.startswith(self.cache + os.sep) and os.path.exists(npy) and os.path.exists(meta))
+        self.assertEqual(sorted(os.listdir(self.dir)), before)
+
+        loaded = embeddings.VectorIndex.load_or_build(kb, kb_path, embeddings.HashingEmbedder())
+        self.assertIsInstance(loaded.matrix, embeddings.np.memmap)
+        self.assertTrue(embeddings.np.array_equal(loaded.matrix, built.matrix))
+        changed = embeddings.VectorIndex.load_or_build(kb[1:], kb_path, embeddings.HashingEmbedder())
+        self.assertEqual(changed.matrix.shape[0], len(kb) - 1)
+        self.assertNotEqual(embeddings.vector_paths(os.path.join(self.cache, "bronn_kb.jsonl"))[0], npy)
+
+    @skipUnless(importlib.util.find_spec("numpy"), "semantic retrieval needs numpy")
+    def test_semantic_top_k_keeps_every_tie_at_the_cutoff(self):
+        np = self.bot.embeddings.np
+        style = {"retrieval": {"tie_breakers": ["higher weight"]}}
+        # 30 entries tied at the top score; only the last few win on weight
+        kb = [self.bot.kbpack.normalize_entry({"id": f"E{i}", "summary": "x", "weight": int(i >= 26)}) for i in range(40)]
+        sims = np.array([0.9] * 30 + [0.5] * 10, dtype=np.float32)
+        vectors = mock.Mock(similarities=mock.Mock(return_value=sims))
+        retriever = self.bot.SemanticRetriever(self.bot.RetrievalIndex(kb, style), vectors, hybrid=False)
+        full = sorted(range(40), key=lambda pos: (-sims[pos], -kb[pos]["weight"], pos))
+        for k in (1, 3, 4, 5, 30, 31, 40, 50):
+            self.assertEqual([e["id"] for e in retriever.top_k("q", k)], [kb[pos]["id"] for pos in full[:k]], k)
 
-# Create your tests here.
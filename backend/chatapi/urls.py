@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
 from .auth_views import RegisterView, LoginView, MeView, GoogleAuthView
@@ -6,7 +7,9 @@ from .views import (
     ConversationMessagesView, CreateUserMessageView,
     ConversationBulkDeleteView,
 )
-from .stream_views import chat_stream_view
+from .stream_views import (
+    chat_stream_view, chat_stream_async_view, chat_resume_view, chat_resume_async_view, chat_cancel_view,
+)
 from .search_views import SearchView
 
 urlpatterns = [
@@ -24,8 +27,10 @@ urlpatterns = [
     path("conversations/<uuid:pk>/messages/create", CreateUserMessageView.as_view()),
     path("conversations/bulk-delete",            ConversationBulkDeleteView.as_view()),
 
-    # Streaming
-    path("chat/stream", chat_stream_view),
+    # Streaming (async view only makes sense when served over ASGI)
+    path("chat/stream", chat_stream_async_view if settings.CHAT_STREAM_ASYNC else chat_stream_view),
+    path("chat/<int:message_id>/stream", chat_resume_async_view if settings.CHAT_STREAM_ASYNC else chat_resume_view),
+    path("chat/<int:message_id>/cancel", chat_cancel_view),
 
     # Search
     path("search", SearchView.as_view()),
@@ -1,17 +1,38 @@
 from rest_framework import generics, permissions, pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from .models import Conversation, Message
-from .serializers import ConversationSerializer, ConversationDetailSerializer, MessageSerializer
+from .serializers import ConversationSerializer, MessageSerializer
+from .services import conversation_stats
+from .services.token_budget import with_token_count
 
-class StdPagination(pagination.PageNumberPagination):
+# Keyset pagination: no COUNT(*) and no OFFSET scans, so every page costs the same
+# however deep it is. Ties on the timestamp are broken by id.
+class ConversationCursorPagination(pagination.CursorPagination):
     page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("-updated_at", "-id")
+
+class MessageCursorPagination(pagination.CursorPagination):
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    ordering = ("created_at", "id")
+
+    def get_ordering(self, request, queryset, view):
+        # ?after= is for catching up, so it always reads oldest first
+        if request.query_params.get("order", "asc") == "desc" and not request.query_params.get("after"):
+            return ("-created_at", "-id")
+        return self.ordering
 
 class ConversationListCreateView(generics.ListCreateAPIView):
     serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = StdPagination
+    pagination_class = ConversationCursorPagination
 
     def get_queryset(self):
         return Conversation.objects.filter(owner=self.request.user).order_by("-updated_at")
@@ -22,21 +43,52 @@ class ConversationListCreateView(generics.ListCreateAPIView):
         conv = serializer.save(owner=self.request.user, character=character)
         return conv
 
+MAX_DETAIL_TAIL = 100
+_TAIL_FIELDS = ("id","role","content","meta","created_at")
+
 class ConversationDetailView(generics.RetrieveUpdateDestroyAPIView):
-    serializer_class = ConversationDetailSerializer
+    """
+    Metadata only. GET ?tail=N (≤ 100) adds the latest N messages, oldest first;
+    full history lives behind the paginated /messages route.
+    """
+    serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated]
     def get_queryset(self):
         return Conversation.objects.filter(owner=self.request.user)
 
+    def retrieve(self, request, *args, **kwargs):
+        conv = self.get_object()
+        data = self.get_serializer(conv).data
+        try:
+            tail = min(max(int(request.query_params.get("tail", 0)), 0), MAX_DETAIL_TAIL)
+        except ValueError:
+            tail = 0
+        if tail:
+            # plain dicts straight from .values(): no per-field serializer work
+            rows = list(conv.messages.order_by("-created_at", "-id").values(*_TAIL_FIELDS)[:tail])
+            rows.reverse()
+            data["messages"] = rows
+        return Response(data)
+
 class ConversationMessagesView(generics.ListAPIView):
+    """
+    ?order=asc|desc&page_size=N (max 200), then follow `next`/`previous` cursors.
+    ?after=<message id> returns only messages newer than that one, always oldest first (?order is ignored).
+    """
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = pagination.PageNumberPagination
+    pagination_class = MessageCursorPagination
     def get_queryset(self):
         conv = get_object_or_404(Conversation, pk=self.kwargs["pk"], owner=self.request.user)
-        order = self.request.query_params.get("order","asc")
-        self.pagination_class.page_size = int(self.request.query_params.get("page_size", 50))
-        return conv.messages.all().order_by("created_at" if order=="asc" else "-created_at")
+        qs = conv.messages.all()
+        after = self.request.query_params.get("after")
+        if after:
+            anchor = conv.messages.filter(pk=after).values("created_at", "id").first() if after.isdigit() else None
+            if anchor is None:
+                raise NotFound("after: no such message in this conversation")
+            qs = qs.filter(Q(created_at__gt=anchor["created_at"]) |
+                           Q(created_at=anchor["created_at"], id__gt=anchor["id"]))
+        return qs
 
 class CreateUserMessageView(generics.CreateAPIView):
     serializer_class = MessageSerializer
@@ -44,12 +96,13 @@ class CreateUserMessageView(generics.CreateAPIView):
     def create(self, request, *args, **kwargs):
         conv = get_object_or_404(Conversation, pk=kwargs["pk"], owner=request.user)
         content = request.data.get("content","")
-        msg = Message.objects.create(conversation=conv, role="user", content=content)
+        msg = Message.objects.create(conversation=conv, role="user", content=content, meta=with_token_count(content))
+        conversation_stats.message_created(msg)  # also bumps updated_at
         if not conv.title:
             preview = (content.strip().split("\n",1)[0])[:60]
             prefix = (conv.character.strip() + " — ") if conv.character else ""
             conv.title = (prefix + preview).strip()
-        conv.save(update_fields=["title","updated_at"])
+            conv.save(update_fields=["title"])
         return Response(MessageSerializer(msg).data, status=201)
 
 
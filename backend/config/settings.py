@@ -73,3 +73,103 @@ CSRF_TRUSTED_ORIGINS = [
 # Google
 GOOGLE_OAUTH_CLIENT_ID = os.getenv("GOOGLE_OAUTH_CLIENT_ID","")
 
+# Chat streaming
+# True when served by an ASGI server (uvicorn/daphne): /api/chat/stream uses the async view
+CHAT_STREAM_ASYNC = os.getenv("CHAT_STREAM_ASYNC","False") == "True"
+# assistant rows are persisted every CHAT_STREAM_FLUSH_MS or CHAT_STREAM_FLUSH_CHARS, whichever comes first
+CHAT_STREAM_FLUSH_MS = int(os.getenv("CHAT_STREAM_FLUSH_MS","250"))
+CHAT_STREAM_FLUSH_CHARS = int(os.getenv("CHAT_STREAM_FLUSH_CHARS","512"))
+# token deltas arriving within CHAT_STREAM_COALESCE_MS of the last frame are merged into one SSE frame
+# (capped at CHAT_STREAM_COALESCE_CHARS); the first token is always sent immediately. 0 = one frame per delta
+CHAT_STREAM_COALESCE_MS = float(os.getenv("CHAT_STREAM_COALESCE_MS","25"))
+CHAT_STREAM_COALESCE_CHARS = int(os.getenv("CHAT_STREAM_COALESCE_CHARS","2048"))
+# replies are generated in the background (CHAT_PRODUCER_WORKERS threads per process for the sync view) and
+# published frame by frame to a per-reply channel that every stream of the reply follows, including
+# GET /api/chat/<message_id>/stream (resume with Last-Event-ID, or watch from another tab).
+# Channel backend: "local" (per-process ring), "cache" (CACHES[CHAT_REPLAY_CACHE_ALIAS], shared by workers)
+# or a dotted path to a replay.ReplayBuffer subclass
+CHAT_PRODUCER_WORKERS = int(os.getenv("CHAT_PRODUCER_WORKERS","32"))
+# a reply nobody has watched for CHAT_DISCONNECT_GRACE seconds (tab closed, not resumed) is stopped and its
+# upstream request closed; negative = always generate to the end
+CHAT_DISCONNECT_GRACE = float(os.getenv("CHAT_DISCONNECT_GRACE","10"))
+CHAT_REPLAY_BACKEND = os.getenv("CHAT_REPLAY_BACKEND","local")
+CHAT_REPLAY_CACHE_ALIAS = os.getenv("CHAT_REPLAY_CACHE_ALIAS","default")
+CHAT_REPLAY_TTL = int(os.getenv("CHAT_REPLAY_TTL","300"))
+CHAT_REPLAY_MAX_FRAMES = int(os.getenv("CHAT_REPLAY_MAX_FRAMES","4096"))
+CHAT_REPLAY_POLL_MS = int(os.getenv("CHAT_REPLAY_POLL_MS","50"))
+# admission control for POST /api/chat/stream: a per-user token bucket (CHAT_ADMIT_RATE requests/minute, bursts
+# of CHAT_ADMIT_BURST), at most CHAT_ADMIT_USER_CONCURRENCY replies generating per user and
+# CHAT_ADMIT_GLOBAL_CONCURRENCY overall (match the upstream rate limit; defaults to CHAT_PRODUCER_WORKERS, and
+# with "local" state behind the sync view is capped at it). Over the limits a request waits up to
+# CHAT_ADMIT_MAX_WAIT seconds in a queue served round-robin across users, else gets 429 with Retry-After.
+# State: "local" (per process) or "cache" (CACHES[CHAT_ADMIT_CACHE_ALIAS], shared by workers)
+CHAT_ADMISSION_ENABLED = os.getenv("CHAT_ADMISSION_ENABLED","True") == "True"
+CHAT_ADMIT_BACKEND = os.getenv("CHAT_ADMIT_BACKEND","local")
+CHAT_ADMIT_CACHE_ALIAS = os.getenv("CHAT_ADMIT_CACHE_ALIAS","default")
+CHAT_ADMIT_RATE = float(os.getenv("CHAT_ADMIT_RATE","30"))
+CHAT_ADMIT_BURST = int(os.getenv("CHAT_ADMIT_BURST","10"))
+CHAT_ADMIT_USER_CONCURRENCY = int(os.getenv("CHAT_ADMIT_USER_CONCURRENCY","3"))
+CHAT_ADMIT_GLOBAL_CONCURRENCY = int(os.getenv("CHAT_ADMIT_GLOBAL_CONCURRENCY",str(CHAT_PRODUCER_WORKERS)))
+CHAT_ADMIT_MAX_WAIT = float(os.getenv("CHAT_ADMIT_MAX_WAIT","10"))
+CHAT_ADMIT_USER_QUEUE = int(os.getenv("CHAT_ADMIT_USER_QUEUE","4"))
+CHAT_ADMIT_MAX_QUEUE = int(os.getenv("CHAT_ADMIT_MAX_QUEUE","256"))
+CHAT_ADMIT_LEASE_TTL = int(os.getenv("CHAT_ADMIT_LEASE_TTL","600"))
+CHAT_ADMIT_POLL_MS = int(os.getenv("CHAT_ADMIT_POLL_MS","50"))
+# history sent upstream: newest turns that fit CHAT_HISTORY_TOKEN_BUDGET and the model context
+# (minus system prompt, new turn and OPENAI_MAX_OUTPUT_TOKENS), read from at most CHAT_HISTORY_MAX_MESSAGES rows
+CHAT_MODEL_CONTEXT_TOKENS = int(os.getenv("CHAT_MODEL_CONTEXT_TOKENS","128000"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET","4000"))
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES","50"))
+# rolling summary: once unsummarized turns exceed CHAT_SUMMARY_TRIGGER_TOKENS, all but the newest
+# CHAT_SUMMARY_KEEP_TOKENS are condensed in the background into Conversation.summary (an extra LLM call; off by default)
+CHAT_SUMMARY_ENABLED = os.getenv("CHAT_SUMMARY_ENABLED","False") == "True"
+CHAT_SUMMARY_TRIGGER_TOKENS = int(os.getenv("CHAT_SUMMARY_TRIGGER_TOKENS","6000"))
+CHAT_SUMMARY_KEEP_TOKENS = int(os.getenv("CHAT_SUMMARY_KEEP_TOKENS","2000"))
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS","400"))
+
+
+# Exact-match LLM reply cache (off by default). Backend: "memory" (per process) or "django" (CACHES[CHAT_CACHE_ALIAS]).
+# Requests with temperature above CHAT_CACHE_MAX_TEMPERATURE always go upstream.
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED","False") == "True"
+CHAT_CACHE_BACKEND = os.getenv("CHAT_CACHE_BACKEND","memory")
+CHAT_CACHE_ALIAS = os.getenv("CHAT_CACHE_ALIAS","default")
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL","3600"))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES","1024"))
+CHAT_CACHE_MAX_TEMPERATURE = float(os.getenv("CHAT_CACHE_MAX_TEMPERATURE","0.5"))
+
+# LLM backend (services/llm_providers.py): "openai", "openai-compatible" (CHAT_LLM_BASE_URL, e.g. vLLM /
+# llama.cpp / `manage.py fake_llm_server`), "fake" (in-process deterministic tokens), or a dotted path.
+CHAT_LLM_PROVIDER = os.getenv("CHAT_LLM_PROVIDER","openai")
+CHAT_LLM_BASE_URL = os.getenv("CHAT_LLM_BASE_URL","")
+CHAT_LLM_API_KEY = os.getenv("CHAT_LLM_API_KEY","")
+# fake provider: reply length (tokens) and first-token latency (ms) are "N" or "uniform:a,b" / "normal:mean,sd" /
+# "lognormal:median,sigma" / "exp:mean"; tokens are paced at CHAT_FAKE_LLM_TOKENS_PER_SEC (0 = unthrottled)
+CHAT_FAKE_LLM_TOKENS = os.getenv("CHAT_FAKE_LLM_TOKENS","200")
+CHAT_FAKE_LLM_TOKENS_PER_SEC = float(os.getenv("CHAT_FAKE_LLM_TOKENS_PER_SEC","50"))
+CHAT_FAKE_LLM_TTFT_MS = os.getenv("CHAT_FAKE_LLM_TTFT_MS","300")
+CHAT_FAKE_LLM_SEED = int(os.getenv("CHAT_FAKE_LLM_SEED","0"))
+
+# Shared LLM client (services/llm_client.py): httpx pool/keep-alive, timeouts in seconds, and jittered
+# exponential retry of failures before the first token. CHAT_LLM_HEDGE fires a second request when the first
+# token is slower than the recent p95 (CHAT_LLM_HEDGE_AFTER until enough samples) and keeps the faster stream.
+CHAT_LLM_POOL_SIZE = int(os.getenv("CHAT_LLM_POOL_SIZE","20"))
+CHAT_LLM_KEEPALIVE = int(os.getenv("CHAT_LLM_KEEPALIVE","10"))
+CHAT_LLM_KEEPALIVE_EXPIRY = float(os.getenv("CHAT_LLM_KEEPALIVE_EXPIRY","30"))
+CHAT_LLM_CONNECT_TIMEOUT = float(os.getenv("CHAT_LLM_CONNECT_TIMEOUT","5"))
+CHAT_LLM_READ_TIMEOUT = float(os.getenv("CHAT_LLM_READ_TIMEOUT","60"))
+CHAT_LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("CHAT_LLM_FIRST_TOKEN_TIMEOUT","20"))
+CHAT_LLM_MAX_RETRIES = int(os.getenv("CHAT_LLM_MAX_RETRIES","2"))
+CHAT_LLM_BACKOFF_BASE = float(os.getenv("CHAT_LLM_BACKOFF_BASE","0.25"))
+CHAT_LLM_BACKOFF_MAX = float(os.getenv("CHAT_LLM_BACKOFF_MAX","4"))
+CHAT_LLM_HEDGE = os.getenv("CHAT_LLM_HEDGE","False") == "True"
+CHAT_LLM_HEDGE_AFTER = float(os.getenv("CHAT_LLM_HEDGE_AFTER","1.5"))
+CHAT_LLM_HEDGE_QUANTILE = float(os.getenv("CHAT_LLM_HEDGE_QUANTILE","0.95"))
+
+# Per-reply stage timings and Prometheus histograms (TTFT, stream duration, tokens, DB time) labelled by persona,
+# served on /metrics. Off by default: no spans are recorded and no DB wrapper is installed.
+# CHAT_METRICS_TOKEN, when set, is required as a bearer token on /metrics
+CHAT_METRICS_ENABLED = os.getenv("CHAT_METRICS_ENABLED","False") == "True"
+CHAT_METRICS_TOKEN = os.getenv("CHAT_METRICS_TOKEN","")
+
+# /api/search backend: "auto" picks FTS5 on SQLite / tsvector on Postgres; "icontains" is the plain LIKE scan
+CHAT_SEARCH_BACKEND = os.getenv("CHAT_SEARCH_BACKEND","auto")
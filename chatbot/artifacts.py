@@ -0,0 +1,30 @@
+"""
+artifacts.py
+Where files derived from a KB are kept (embedding matrices, compiled KBs).
+
+They are build outputs, not sources, so they go to a cache directory instead of
+next to the KB: PERSONA_CACHE_DIR, or `chatbot-personas` under XDG_CACHE_HOME
+(~/.cache by default). Each KB directory gets its own subdirectory, named by a
+digest of its absolute path, so same-named KBs from different directories (the
+repo's, a test's temp copy, a benchmark's synthetic one) never share files.
+"""
+
+from __future__ import annotations
+import hashlib, os
+
+
+def cache_dir() -> str:
+    explicit = os.getenv("PERSONA_CACHE_DIR")
+    if explicit:
+        return explicit
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "chatbot-personas")
+
+
+def artifact_path(kb_path: str, suffix: str) -> str:
+    """`<cache>/<digest of the KB's directory>/<kb name without .jsonl><suffix>`; the directory may not exist yet."""
+    kb_path = os.path.abspath(kb_path)
+    folder, name = os.path.split(kb_path)
+    stem = name[:-len(".jsonl")] if name.endswith(".jsonl") else name
+    digest = hashlib.sha256(folder.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir(), digest, stem + suffix)
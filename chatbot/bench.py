@@ -0,0 +1,163 @@
+"""
+bench.py
+Micro-benchmarks for the persona prompt builder.
+
+Usage (from the repo root):
+    python -m chatbot.bench [--persona bronn] [--iterations 2000] [--json]
+    python -m chatbot.bench --scaling [--persona bronn|all] [--sizes 100,1000,10000,100000] [--mode hybrid] [--compiled] [--json]
+
+The default run times build_system_prompt with compiled prompt fragments against
+recompiling the static prefix on every call (the pre-compilation behaviour).
+
+--scaling grows a synthetic KB from the persona's real entries (extra Zipf-distributed
+tags/summary words so postings lists grow like a real KB would) and reports, per size,
+the cold load (parse + index build), warm retrieval and warm prompt build latency.
+--mode picks the retrieval mode (lexical/semantic/hybrid); for the embedding modes
+the cold load includes embedding the KB (derived files go to a cache dir inside the temp dir).
+--compiled also compiles each synthetic KB (bot.compile_persona) and reports the
+cold load from the .pkb artifact next to the JSONL one (both in the temp dir).
+"""
+
+from __future__ import annotations
+import argparse, contextlib, gc, json, os, random, tempfile, time
+from typing import Any, Callable, Dict, Iterable, List
+
+from . import bot
+
+_QUERIES = [
+    "Tell me about the Blackwater",
+    "who are you?",
+    "[[OOC]] what happened at the trial by combat",
+    "what do you think of Tyrion and his gold",
+    "any advice for a sellsword",
+]
+
+def _per_call_us(fn: Callable[[str], str], queries: List[str], iterations: int) -> float:
+    for q in queries: fn(q)  # warm caches
+    t0 = time.perf_counter()
+    for i in range(iterations):
+        fn(queries[i % len(queries)])
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+def bench_prompt_build(persona: str, iterations: int = 2000) -> Dict[str, float]:
+    kb_path = os.path.join(bot._THIS_DIR, f"{persona}_kb.jsonl")
+    style_path = os.path.join(bot._THIS_DIR, f"{persona}_style.yml")
+    character = persona.title()
+
+    def compiled(q: str) -> str:
+        return bot.build_system_prompt(character, q, kb_path=kb_path, style_path=style_path)
+
+    def uncompiled(q: str) -> str:
+        assets = bot.get_persona_assets(kb_path, style_path)
+        assets._prompts.clear()
+        return bot.build_system_prompt(character, q, kb_path=kb_path, style_path=style_path)
+
+    before = _per_call_us(uncompiled, _QUERIES, iterations)
+    after = _per_call_us(compiled, _QUERIES, iterations)
+    return {"persona": persona, "iterations": iterations,
+            "uncompiled_us": round(before, 2), "compiled_us": round(after, 2),
+            "speedup": round(before / after, 2) if after else 0.0}
+
+PERSONAS = ["arya", "bronn", "cersei", "daenerys", "jon", "tyrion"]
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+_SYNTH_VOCAB = 5000
+
+def _synth_word(rng: random.Random) -> str:
+    # Zipf-ish: a few synthetic words are in many entries, most in a handful
+    return "w%d" % int(_SYNTH_VOCAB ** rng.random())
+
+def write_synthetic_kb(persona: str, size: int, path: str, seed: int = 0) -> None:
+    """`size` entries cycling through the persona's real KB, each with a few synthetic tags and summary words."""
+    real = bot._load_kb(os.path.join(bot._THIS_DIR, f"{persona}_kb.jsonl"))
+    rng = random.Random(f"{seed}:{persona}:{size}")
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(size):
+            e = dict(real[i % len(real)])
+            e["id"] = "%s-SYN-%06d" % (persona.upper(), i)
+            e["tags"] = list(e.get("tags") or []) + [_synth_word(rng) for _ in range(3)]
+            e["summary"] = " ".join(_synth_word(rng) for _ in range(4)) + " " + (e.get("summary") or "")
+            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+
+def _scaling_queries(rng: random.Random, n: int = 20) -> List[str]:
+    return [q + " " + " ".join(_synth_word(rng) for _ in range(2)) for q in _QUERIES for _ in range(n // len(_QUERIES))]
+
+def _cold_load_ms(kb_path: str, style_path: str) -> float:
+    bot.ASSETS.clear()
+    gc.collect()  # don't time freeing the previous size's entries
+    t0 = time.perf_counter()
+    assets = bot.get_persona_assets(kb_path, style_path)
+    assets.retriever  # noqa: B018 -- build it inside the timed region
+    return (time.perf_counter() - t0) * 1000
+
+@contextlib.contextmanager
+def _persona_cache_dir(path: str):
+    """Point PERSONA_CACHE_DIR at `path` for the block, so synthetic KBs leave nothing behind."""
+    old = os.environ.get("PERSONA_CACHE_DIR")
+    os.environ["PERSONA_CACHE_DIR"] = path
+    try:
+        yield
+    finally:
+        if old is None:
+            os.environ.pop("PERSONA_CACHE_DIR", None)
+        else:
+            os.environ["PERSONA_CACHE_DIR"] = old
+
+def bench_kb_scaling(persona: str, sizes: Iterable[int] = DEFAULT_SIZES, iterations: int = 500,
+                     compiled: bool = False) -> List[Dict[str, Any]]:
+    style_path = os.path.join(bot._THIS_DIR, f"{persona}_style.yml")
+    character = persona.title()
+    queries = _scaling_queries(random.Random(persona))
+    rows: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as tmp, _persona_cache_dir(os.path.join(tmp, "cache")):
+        for size in sizes:
+            kb_path = os.path.join(tmp, f"{persona}_{size}_kb.jsonl")
+            write_synthetic_kb(persona, size, kb_path)
+            load_ms = _cold_load_ms(kb_path, style_path)
+            assets = bot.get_persona_assets(kb_path, style_path)
+            n = max(20, min(iterations, iterations * 1000 // max(1, size)))
+            retrieve_us = _per_call_us(lambda q: assets.retriever.top_k(q, bot.DEFAULT_TOP_K), queries, n)
+            prompt_us = _per_call_us(
+                lambda q: bot.build_system_prompt(character, q, kb_path=kb_path, style_path=style_path), queries, n)
+            row = {"persona": persona, "kb_entries": size, "iterations": n, "load_ms": round(load_ms, 2),
+                   "retrieve_us": round(retrieve_us, 2), "prompt_us": round(prompt_us, 2)}
+            del assets
+            if compiled:
+                bot.compile_persona(kb_path, style_path)
+                row["compiled_load_ms"] = round(_cold_load_ms(kb_path, style_path), 2)
+            rows.append(row)
+            bot.ASSETS.clear()
+    return rows
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--persona", default="bronn", help='persona name, or "all" (--scaling only)')
+    ap.add_argument("--iterations", type=int, default=2000)
+    ap.add_argument("--scaling", action="store_true", help="sweep synthetic KB sizes instead of compiled vs uncompiled")
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated KB sizes for --scaling")
+    ap.add_argument("--compiled", action="store_true", help="--scaling: also time loading the compiled .pkb artifact")
+    ap.add_argument("--mode", choices=bot.RETRIEVAL_MODES, help="retrieval mode (default: PERSONA_RETRIEVAL_MODE / lexical)")
+    ap.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = ap.parse_args(argv)
+    if args.mode:
+        os.environ["PERSONA_RETRIEVAL_MODE"] = args.mode  # styles without retrieval.mode follow this
+    if args.scaling:
+        personas = PERSONAS if args.persona == "all" else [args.persona]
+        sizes = [int(x) for x in args.sizes.split(",") if x]
+        rows = [r for p in personas for r in bench_kb_scaling(p, sizes, min(args.iterations, 500), args.compiled)]
+        if args.json:
+            print(json.dumps(rows))
+        else:
+            for r in rows:
+                print(f"{r['persona']:>9} {r['kb_entries']:>7} entries: load {r['load_ms']:>9} ms, "
+                      f"retrieve {r['retrieve_us']:>9} us, prompt {r['prompt_us']} us"
+                      + (f", compiled load {r['compiled_load_ms']} ms" if "compiled_load_ms" in r else ""))
+        return
+    res = bench_prompt_build(args.persona, args.iterations)
+    if args.json:
+        print(json.dumps(res))
+    else:
+        print(f"{res['persona']}: uncompiled {res['uncompiled_us']} us/call, "
+              f"compiled {res['compiled_us']} us/call ({res['speedup']}x)")
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,12 @@ bot.py
 Character-aware prompt + lightweight retrieval.
 
 Exports:
-- build_system_prompt(character, user_query, kb_path=None, style_path=None, k=5) -> str
+- build_system_prompt(character, user_query, kb_path=None, style_path=None, k=None, kb_token_budget=None) -> str
+- get_persona_assets(kb_path, style_path) -> PersonaAssets (process-wide, mtime-checked cache;
+  loads `<name>_kb.pkb` from compile_persona when present and current, see kbpack.py)
+- compile_persona(kb_path, style_path) -> validation errors + compiled artifact
+- retrieval modes (style `retrieval.mode` / PERSONA_RETRIEVAL_MODE): "lexical" (default),
+  "semantic" or "hybrid" (embedding cosine, see embeddings.py)
 - CharacterBot (optional wrapper; not required by the backend)
 
 Behavior:
@@ -12,7 +17,8 @@ Behavior:
 """
 
 from __future__ import annotations
-import os, json, re, random
+import os, json, re, random, threading, heapq, time, logging
+from collections import OrderedDict
 from typing import Any, Dict, Generator, List, Optional, Tuple
 
 try:
@@ -20,6 +26,9 @@ try:
 except Exception:
     yaml = None
 
+from . import embeddings, kbpack
+
+log = logging.getLogger(__name__)
 _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 _WORD_RE = re.compile(r"[A-Za-z0-9_']+")
 
@@ -42,29 +51,17 @@ def _render_template(tmpl: str, ctx: Dict[str, Any]) -> str:
 # ---------- loading ----------
 
 def _load_kb(path: str) -> List[Dict[str, Any]]:
+    # lenient runtime path: unparseable rows are skipped (with a warning); compile_persona rejects them
     out: List[Dict[str, Any]] = []
     if not os.path.exists(path): return out
     with open(path, "r", encoding="utf-8") as f:
-        for line in f:
+        for lineno, line in enumerate(f, 1):
             line = line.strip()
             if not line: continue
             try:
-                row = json.loads(line)
-            except Exception:
-                continue
-            out.append({
-                "id": row.get("id"),
-                "tags": [str(t).lower() for t in row.get("tags", [])],
-                "aliases": [str(a).lower() for a in row.get("aliases", [])],
-                "summary": str(row.get("summary", "")).strip(),
-                "ic_reply": str(row.get("ic_reply", "")).strip(),
-                "era": str(row.get("era", "")),
-                "canon": list(row.get("canon", [])),
-                "ooc_notes": str(row.get("ooc_notes", "")),
-                "weight": int(row.get("weight", 0)),
-                "source": row.get("source", {}),
-                "entities": list(row.get("entities", [])),
-            })
+                out.append(kbpack.normalize_entry(json.loads(line)))
+            except Exception as e:
+                log.warning("%s:%d: skipping malformed KB row (%s)", path, lineno, e)
     return out
 
 def _load_style(path: str) -> Dict[str, Any]:
@@ -82,80 +79,398 @@ def _load_style(path: str) -> Dict[str, Any]:
         except Exception:
             return {}
 
+# ---------- asset cache ----------
+# KB/style files are parsed once per process and reused until their mtime/size
+# changes on disk. Entries are kept in LRU order so memory stays bounded.
+
+_FileSig = Optional[Tuple[int, int]]
+
+def _file_sig(path: str) -> _FileSig:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+class PersonaAssets:
+    """
+    Parsed KB + style for one persona, tagged with the file signatures it was read
+    from (KB, style, compiled artifact). With a compiled artifact, `kb` is a lazy
+    kbpack.PackedEntries and `index` a CompiledIndex over its postings.
+    """
+    __slots__ = ("kb_path", "style_path", "kb", "style", "sig", "_index", "_retriever", "_prompts")
+
+    def __init__(self, kb_path: str, style_path: str, kb: List[Dict[str, Any]],
+                 style: Dict[str, Any], sig: Tuple[_FileSig, ...]):
+        self.kb_path, self.style_path = kb_path, style_path
+        self.kb, self.style, self.sig = kb, style, sig
+        self._index: Optional["RetrievalIndex"] = None
+        self._retriever: Any = None
+        self._prompts: Dict[Tuple[str, bool], "CompiledPrompt"] = {}
+
+    @property
+    def index(self) -> "RetrievalIndex":
+        # built on first use; assets are immutable once loaded so this is race-safe
+        if self._index is None:
+            self._index = RetrievalIndex(self.kb, self.style)
+        return self._index
+
+    @property
+    def retriever(self) -> Any:
+        """`index`, or a SemanticRetriever over it when the retrieval mode asks for embeddings."""
+        if self._retriever is None:
+            self._retriever = _make_retriever(self)
+        return self._retriever
+
+    def prompt(self, character: str, is_ooc: bool) -> "CompiledPrompt":
+        key = (character, is_ooc)
+        cp = self._prompts.get(key)
+        if cp is None:
+            if len(self._prompts) >= 64: self._prompts.clear()  # display-name churn guard
+            cp = self._prompts[key] = _compile_prompt(character, self.style, is_ooc)
+        return cp
+
+class AssetRegistry:
+    def __init__(self, max_personas: int = 32):
+        self.max_personas = max(1, int(max_personas))
+        self._items: "OrderedDict[Tuple[str, str], PersonaAssets]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.reloads = self.evictions = 0
+
+    def get(self, kb_path: str, style_path: str) -> PersonaAssets:
+        key = (os.path.abspath(kb_path), os.path.abspath(style_path))
+        sig = (_file_sig(key[0]), _file_sig(key[1]), _file_sig(kbpack.artifact_path(key[0])))
+        with self._lock:
+            cur = self._items.get(key)
+            if cur is not None and cur.sig == sig:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return cur
+        # parse outside the lock; a concurrent duplicate load is harmless
+        assets = _load_assets(key[0], key[1], sig)
+        with self._lock:
+            if cur is None: self.misses += 1
+            else: self.reloads += 1
+            self._items[key] = assets
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_personas:
+                self._items.popitem(last=False)
+                self.evictions += 1
+        return assets
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                    "reloads": self.reloads, "evictions": self.evictions}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = self.reloads = self.evictions = 0
+
+def _load_assets(kb_path: str, style_path: str, sig: Tuple[_FileSig, ...]) -> PersonaAssets:
+    style = _load_style(style_path)
+    packed = kbpack.open_fresh(kb_path, _ranking(style)[:3])
+    if packed is None:
+        return PersonaAssets(kb_path, style_path, _load_kb(kb_path), style, sig)
+    assets = PersonaAssets(kb_path, style_path, packed.entries, style, sig)
+    assets._index = CompiledIndex(packed, style)
+    return assets
+
+ASSETS = AssetRegistry(max_personas=int(os.getenv("PERSONA_CACHE_SIZE", "32")))
+
+def get_persona_assets(kb_path: str, style_path: str) -> PersonaAssets:
+    return ASSETS.get(kb_path, style_path)
+
 # ---------- retrieval ----------
 
-def _score_entry(user_tokens: List[str], entry: Dict[str, Any], tag_w: int, alias_w: int, sum_w: int) -> int:
-    score = 0
-    for tag in entry["tags"]:
-        for tok in _tokenize(tag):
-            if tok in user_tokens: score += tag_w
-    for alias in entry["aliases"]:
-        for tok in _tokenize(alias):
-            if tok in user_tokens: score += alias_w
-    for tok in _tokenize(entry["summary"])[:15]:
-        if tok in user_tokens: score += sum_w
-    return score
-
-def _tie_break(a: Dict[str, Any], b: Dict[str, Any], rules: List[str]) -> int:
+def _ranking(style: Dict[str, Any]) -> Tuple[int, int, int, List[str]]:
+    rconf = (style.get("retrieval") or {}).get("ranking") or {}
+    tag_w = int(rconf.get("tag_weight", 2))
+    alias_w = int(rconf.get("alias_weight", 2))
+    sum_w = int(rconf.get("summary_overlap_weight", 1))
+    tie = (style.get("retrieval") or {}).get("tie_breakers", []) or []
+    return tag_w, alias_w, sum_w, tie
+
+def _tie_key(e: Dict[str, Any], rules: List[str]) -> Tuple[int, ...]:
+    canon = e.get("canon", [])
+    return _tie_values(int(e.get("weight", 0)), "book" in canon and "show" in canon, rules)
+
+def _tie_values(weight: int, dual_canon: bool, rules: List[str]) -> Tuple[int, ...]:
+    # Comparing these tuples lexicographically is the same as applying the
+    # tie-breaker rules in order: the first rule that differs decides.
+    key: List[int] = []
     for rule in rules:
         r = str(rule or "").lower()
         if r == "higher weight":
-            aw, bw = a.get("weight", 0), b.get("weight", 0)
-            if aw != bw: return (aw > bw) - (aw < bw)
+            key.append(weight)
         elif r == "book+show over single-canon":
-            a_both = "book" in a.get("canon", []) and "show" in a.get("canon", [])
-            b_both = "book" in b.get("canon", []) and "show" in b.get("canon", [])
-            if a_both != b_both: return 1 if a_both else -1
-    return 0
+            key.append(int(dual_canon))
+    return tuple(key)
+
+class RetrievalIndex:
+    """
+    Inverted index over a persona KB: token -> [(entry position, weighted hits)].
+    Each token that appears in an entry's tags, aliases or first 15 summary tokens
+    contributes `count * field_weight`, so a query's score for an entry is the sum
+    of its distinct tokens' postings -- the same number the old per-entry scan gave.
+    """
+    __slots__ = ("entries", "postings", "tie")
+
+    def __init__(self, kb: List[Dict[str, Any]], style: Dict[str, Any]):
+        tag_w, alias_w, sum_w, tie = _ranking(style)
+        self.entries = kb
+        self.tie = tie
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for pos, e in enumerate(kb):
+            weights: Dict[str, int] = {}
+            for tag in e["tags"]:
+                for tok in _tokenize(tag): weights[tok] = weights.get(tok, 0) + tag_w
+            for alias in e["aliases"]:
+                for tok in _tokenize(alias): weights[tok] = weights.get(tok, 0) + alias_w
+            for tok in _tokenize(e["summary"])[:15]:
+                weights[tok] = weights.get(tok, 0) + sum_w
+            for tok, w in weights.items():
+                if w: self.postings.setdefault(tok, []).append((pos, w))
+
+    def scores(self, user_input: str) -> Dict[int, int]:
+        acc: Dict[int, int] = {}
+        for tok in set(_tokenize(user_input)):
+            for pos, w in self.postings.get(tok, ()):
+                acc[pos] = acc.get(pos, 0) + w
+        return acc
+
+    def top_k(self, user_input: str, k: int = 5, min_score: int = 1) -> List[Dict[str, Any]]:
+        """
+        Best `k` entries, highest first. Ranked by (score, tie-breakers, earlier in KB)
+        through a bounded heap, so k=1 is exactly the old single-best pick.
+        """
+        if k <= 0: return []
+        min_score = max(1, min_score)
+        cands = ((s, self._tie(pos), -pos)
+                 for pos, s in self.scores(user_input).items() if s >= min_score)
+        return [self.entries[-neg_pos] for _s, _t, neg_pos in heapq.nlargest(k, cands)]
+
+    def top(self, user_input: str) -> Optional[Dict[str, Any]]:
+        hits = self.top_k(user_input, 1)
+        return hits[0] if hits else None
+
+    def _tie(self, pos: int) -> Tuple[int, ...]:
+        return _tie_key(self.entries[pos], self.tie)
+
+class CompiledIndex(RetrievalIndex):
+    """RetrievalIndex over a compiled artifact's postings and tie-breaker arrays; nothing is built at load."""
+    __slots__ = ("packed",)
+
+    def __init__(self, packed: "kbpack.PackedKB", style: Dict[str, Any]):
+        self.packed = packed
+        self.entries = packed.entries
+        self.tie = _ranking(style)[3]
+        self.postings = {}  # unused; lookups go through packed.postings()
+
+    def scores(self, user_input: str) -> Dict[int, int]:
+        acc: Dict[int, int] = {}
+        for tok in set(_tokenize(user_input)):
+            for pos, w in self.packed.postings(tok):
+                acc[pos] = acc.get(pos, 0) + w
+        return acc
+
+    def _tie(self, pos: int) -> Tuple[int, ...]:
+        return _tie_values(self.packed.weight[pos], bool(self.packed.dual[pos]), self.tie)
+
+class SemanticRetriever:
+    """
+    RetrievalIndex's top_k/top over embedding cosine similarity. "semantic" ranks
+    by cosine alone; "hybrid" by `w * cosine + (1 - w) * lexical / best lexical`
+    for the query. An entry qualifies with cosine >= min_similarity or (hybrid)
+    lexical score >= min_score; ties use the same tie-breakers as the lexical index.
+    """
+    __slots__ = ("lexical", "vectors", "hybrid", "weight", "min_similarity")
+
+    def __init__(self, lexical: RetrievalIndex, vectors: "embeddings.VectorIndex", *, hybrid: bool = True,
+                 weight: float = 0.5, min_similarity: float = 0.2):
+        self.lexical, self.vectors = lexical, vectors
+        self.hybrid, self.weight, self.min_similarity = hybrid, float(weight), float(min_similarity)
+
+    @property
+    def entries(self) -> List[Dict[str, Any]]:
+        return self.lexical.entries
+
+    def scores(self, user_input: str, min_score: int = 1):
+        """Float array over KB positions; -inf where the entry doesn't qualify."""
+        np = embeddings.np
+        sims = self.vectors.similarities(user_input)
+        ok = sims >= self.min_similarity
+        if not self.hybrid:
+            return np.where(ok, sims, -np.inf)
+        lex = np.zeros(len(sims), dtype=np.float32)
+        for pos, s in self.lexical.scores(user_input).items():
+            lex[pos] = s
+        best = lex.max() if len(lex) else 0.0
+        fused = self.weight * np.maximum(sims, 0.0) + (1 - self.weight) * (lex / best if best else lex)
+        return np.where(ok | (lex >= max(1, min_score)), fused, -np.inf)
+
+    def top_k(self, user_input: str, k: int = 5, min_score: int = 1) -> List[Dict[str, Any]]:
+        entries = self.lexical.entries
+        if k <= 0 or not entries: return []
+        np = embeddings.np
+        scores = self.scores(user_input, min_score)
+        # shortlist everything scoring at least the k-th best, so entries tied at the
+        # cutoff all reach the tie-breakers, then order the survivors with them
+        keep = scores > -np.inf
+        if k < len(scores):
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            keep &= scores >= kth
+        ranked = heapq.nlargest(k, ((float(scores[pos]), self.lexical._tie(int(pos)), -int(pos))
+                                    for pos in np.flatnonzero(keep)))
+        return [entries[-neg_pos] for _s, _t, neg_pos in ranked]
+
+    def top(self, user_input: str) -> Optional[Dict[str, Any]]:
+        hits = self.top_k(user_input, 1)
+        return hits[0] if hits else None
+
+RETRIEVAL_MODES = ("lexical", "semantic", "hybrid")
+
+def _make_retriever(assets: PersonaAssets) -> Any:
+    rconf = assets.style.get("retrieval") or {}
+    mode = str(rconf.get("mode") or os.getenv("PERSONA_RETRIEVAL_MODE", "lexical")).lower()
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"unknown retrieval mode {mode!r} (expected one of {', '.join(RETRIEVAL_MODES)})")
+    if mode == "lexical":
+        return assets.index
+    if embeddings.np is None:
+        log.warning("Retrieval mode %r needs numpy; using lexical retrieval for %s.", mode, assets.kb_path)
+        return assets.index
+    embedder = embeddings.get_embedder(rconf.get("embedder"))
+    vectors = embeddings.VectorIndex.load_or_build(assets.kb, assets.kb_path, embedder)
+    return SemanticRetriever(assets.index, vectors, hybrid=(mode == "hybrid"),
+                             weight=float(rconf.get("semantic_weight", 0.5)),
+                             min_similarity=float(rconf.get("min_similarity", 0.2)))
 
 def _retrieve_top(user_input: str, kb: List[Dict[str, Any]], style: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    toks = _tokenize(user_input)
-    if not toks: return None
-    rconf = (style.get("retrieval") or {}).get("ranking") or {}
-    tag_w = int(rconf.get("tag_weight", 2))
-    alias_w = int(rconf.get("alias_weight", 2))
-    sum_w = int(rconf.get("summary_overlap_weight", 1))
-    tie = (style.get("retrieval") or {}).get("tie_breakers", []) or []
-    best, best_s = None, 0
-    for e in kb:
-        s = _score_entry(toks, e, tag_w, alias_w, sum_w)
-        if s > best_s:
-            best, best_s = e, s
-        elif s == best_s and s > 0 and best is not None:
-            if _tie_break(e, best, tie) > 0: best = e
-    return best if best_s > 0 else None
+    # Ad-hoc KB/style pairs; cached personas should use PersonaAssets.index instead.
+    return RetrievalIndex(kb, style).top(user_input)
 
 # ---------- system prompt (IC default, OOC on [[OOC]]) ----------
 
+DEFAULT_TOP_K = 5
+DEFAULT_KB_TOKEN_BUDGET = 400
+
+def _approx_tokens(text: str) -> int:
+    # ~4 chars/token for English; good enough for budgeting, no tokenizer dependency
+    return (len(text) + 3) // 4
+
+def _hit_lines(hit: Dict[str, Any], is_ooc: bool, seed: bool) -> List[str]:
+    lines: List[str] = []
+    if is_ooc:
+        canon = ", ".join(hit.get("canon", []))
+        era = hit.get("era", "")
+        notes = hit.get("ooc_notes", "")
+        src = hit.get("source", {})
+        src_line = f"{src.get('title','')} ({src.get('url','')})" if src else ""
+        meta = " • ".join([p for p in [
+            f"canon: {canon}" if canon else "",
+            f"era: {era}" if era else "",
+            f"notes: {notes}" if notes else "",
+            f"source: {src_line}" if src_line else "",
+        ] if p])
+        if meta: lines.append(f"- [[KB]] {meta}")
+        if hit.get("summary"): lines.append(f"- [[KB]] {hit['summary'].strip()}")
+    else:
+        if hit.get("summary"): lines.append(f"- [[KB]] {hit['summary'].strip()}")
+        # only the best hit seeds the reply; more seeds just blur the voice
+        if seed and hit.get("ic_reply"): lines.append(f"- [[IC seed]] {hit['ic_reply'].strip()}")
+    return lines
+
+def _kb_lines(hits: List[Dict[str, Any]], is_ooc: bool, budget: int) -> List[str]:
+    out: List[str] = []
+    used = 0
+    for i, hit in enumerate(hits):
+        lines = _hit_lines(hit, is_ooc, seed=(i == 0))
+        cost = sum(_approx_tokens(l) for l in lines)
+        if out and used + cost > budget: break
+        out.extend(lines)
+        used += cost
+    return out
+
 def build_system_prompt(
     character: str,
     user_query: str,
     *,
     kb_path: Optional[str] = None,
     style_path: Optional[str] = None,
-    k: int = 5,
+    k: Optional[int] = None,
+    kb_token_budget: Optional[int] = None,
+    timings: Optional[Dict[str, float]] = None,
 ) -> str:
+    """
+    `k` / `kb_token_budget` default to the style's `retrieval.top_k` /
+    `retrieval.kb_token_budget` (5 and 400). Hits are added best-first until the
+    next one would overflow the budget; the best hit is always kept.
+    If `timings` is given, seconds spent in "assets" (load + index/vectors), "retrieval"
+    and "render" are added to it.
+    """
+    clock = time.perf_counter if timings is not None else None
+    t0 = clock() if clock else 0.0
     kb_path = kb_path or os.path.join(_THIS_DIR, "bronns_kb.jsonl")
     style_path = style_path or os.path.join(_THIS_DIR, "bronns_style.yml")
-    kb = _load_kb(kb_path)
-    style = _load_style(style_path)
+    assets = get_persona_assets(kb_path, style_path)
+    retriever = assets.retriever
+    style = assets.style
+    if clock:
+        t1 = clock(); timings["assets"] = timings.get("assets", 0.0) + t1 - t0
 
-    sys_ic = ((style.get("system") or {}).get("ic_template")) or (
+    toggle = ((style.get("ooc_mode") or {}).get("toggle", "[[OOC]]"))
+    is_ooc = user_query.strip().startswith(toggle)
+    cleaned_query = user_query.strip()[len(toggle):].strip() if is_ooc else user_query
+
+    rconf = style.get("retrieval") or {}
+    k = int(rconf.get("top_k", DEFAULT_TOP_K) if k is None else k)
+    budget = int(rconf.get("kb_token_budget", DEFAULT_KB_TOKEN_BUDGET) if kb_token_budget is None else kb_token_budget)
+    hits = retriever.top_k(cleaned_query, k, int(rconf.get("min_score", 1)))
+    if clock:
+        t2 = clock(); timings["retrieval"] = timings.get("retrieval", 0.0) + t2 - t1
+    prompt = assets.prompt(character, is_ooc).render(_kb_lines(hits, is_ooc, budget))
+    if clock:
+        timings["render"] = timings.get("render", 0.0) + clock() - t2
+    return prompt
+
+class CompiledPrompt:
+    """
+    Query-independent parts of a system prompt for one (persona, character, IC/OOC):
+    rendered template + style go in `prefix`, guardrails in `suffix`. Only the
+    `# Knowledge` block is spliced in per call, which also keeps the prefix
+    byte-stable for upstream prompt caching.
+    """
+    __slots__ = ("prefix", "suffix")
+
+    def __init__(self, prefix: str, suffix: str):
+        self.prefix, self.suffix = prefix, suffix
+
+    def render(self, kb_lines: List[str]) -> str:
+        if kb_lines:
+            return (self.prefix + "\n\n# Knowledge\n" + "\n".join(kb_lines) + "\n" + self.suffix).strip()
+        return (self.prefix + "\n" + self.suffix).strip()
+
+def _system_templates(style: Dict[str, Any]) -> Dict[str, Any]:
+    """`system:` as a mapping; a plain string is shorthand for its ic_template."""
+    system = style.get("system") or {}
+    return {"ic_template": system} if isinstance(system, str) else system
+
+def _compile_prompt(character: str, style: Dict[str, Any], is_ooc: bool) -> CompiledPrompt:
+    system = _system_templates(style)
+    sys_ic = system.get("ic_template") or (
         f"You are {character}. "
         "Speak strictly in-character: terse, blunt, sardonic, streetwise. "
         "Use first-person as the character. Never refer to yourself as an AI or assistant. "
         "Do not break character unless the user explicitly prefixes [[OOC]]."
     )
-    sys_ooc = ((style.get("system") or {}).get("ooc_template")) or (
+    sys_ooc = system.get("ooc_template") or (
         f"You are an out-of-character narrator about {character}. "
         "Briefly describe thoughts, intentions, and world context relevant to this moment. "
         "Be concise and neutral; do not roleplay here."
     )
 
-    toggle = ((style.get("ooc_mode") or {}).get("toggle", "[[OOC]]"))
-    is_ooc = user_query.strip().startswith(toggle)
-    cleaned_query = user_query.strip()[len(toggle):].strip() if is_ooc else user_query
-
     ctx = {
         "character": character,
         "tone": style.get("tone", ""),
@@ -163,28 +478,6 @@ def build_system_prompt(
         "length_policy": style.get("length_policy", {}),
     }
 
-    hit = _retrieve_top(cleaned_query, kb, style)
-
-    kb_lines: List[str] = []
-    if hit:
-        if is_ooc:
-            canon = ", ".join(hit.get("canon", []))
-            era = hit.get("era", "")
-            notes = hit.get("ooc_notes", "")
-            src = hit.get("source", {})
-            src_line = f"{src.get('title','')} ({src.get('url','')})" if src else ""
-            meta = " • ".join([p for p in [
-                f"canon: {canon}" if canon else "",
-                f"era: {era}" if era else "",
-                f"notes: {notes}" if notes else "",
-                f"source: {src_line}" if src_line else "",
-            ] if p])
-            if meta: kb_lines.append(f"- [[KB]] {meta}")
-            if hit.get("summary"): kb_lines.append(f"- [[KB]] {hit['summary'].strip()}")
-        else:
-            if hit.get("summary"): kb_lines.append(f"- [[KB]] {hit['summary'].strip()}")
-            if hit.get("ic_reply"): kb_lines.append(f"- [[IC seed]] {hit['ic_reply'].strip()}")
-
     raw_style = style.get("_raw", "").strip()
 
     template = sys_ooc if is_ooc else sys_ic
@@ -201,26 +494,115 @@ def build_system_prompt(
     parts: List[str] = []
     parts.append(system_text)
     if raw_style: parts.append("\n# Style\n" + raw_style)
-    if kb_lines: parts.append("\n# Knowledge\n" + "\n".join(kb_lines))
-    parts.append("\n# Instructions\n- " + "\n- ".join(guardrails))
-    return "\n".join(parts).strip()
+    return CompiledPrompt("\n".join(parts), "\n# Instructions\n- " + "\n- ".join(guardrails))
+
+# ---------- offline compile (manage.py compile_personas) ----------
+
+def _check_int(conf: Dict[str, Any], key: str, where: str, errors: List[str], minimum: int = 0) -> None:
+    v = conf.get(key)
+    if v is not None and (isinstance(v, bool) or not isinstance(v, int) or v < minimum):
+        errors.append(f"{where}.{key} must be an integer >= {minimum}")
+
+def validate_style(path: str) -> List[str]:
+    """Problems that would make the style silently fall back to defaults (or fail) at prompt time."""
+    if not os.path.exists(path):
+        return ["file not found"]
+    if yaml is None:
+        return ["PyYAML is not installed; the style would be used as raw text"]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            style = yaml.safe_load(f) or {}
+    except yaml.YAMLError as e:
+        return [f"invalid YAML ({e})".replace("\n", " ")]
+    if not isinstance(style, dict):
+        return ["top level must be a mapping"]
+    errors: List[str] = []
+    system = style.get("system")
+    if system is not None and not isinstance(system, str):
+        if not isinstance(system, dict):
+            errors.append("system must be a string or a mapping with ic_template / ooc_template")
+        else:
+            errors.extend(f"system.{k} must be a string" for k in ("ic_template", "ooc_template")
+                          if k in system and not isinstance(system[k], str))
+    rconf = style.get("retrieval")
+    if rconf is not None and not isinstance(rconf, dict):
+        errors.append("retrieval must be a mapping")
+    elif rconf:
+        _check_int(rconf, "top_k", "retrieval", errors)
+        _check_int(rconf, "kb_token_budget", "retrieval", errors)
+        _check_int(rconf, "min_score", "retrieval", errors)
+        ranking = rconf.get("ranking") or {}
+        if not isinstance(ranking, dict):
+            errors.append("retrieval.ranking must be a mapping")
+        else:
+            for key in ("tag_weight", "alias_weight", "summary_overlap_weight"):
+                _check_int(ranking, key, "retrieval.ranking", errors)
+        mode = "lexical" if rconf.get("mode") is None else str(rconf["mode"]).lower()
+        if mode not in RETRIEVAL_MODES:
+            errors.append(f"retrieval.mode must be one of {', '.join(RETRIEVAL_MODES)}")
+        elif mode != "lexical" and embeddings.np is None:
+            errors.append(f"retrieval.mode {mode} needs numpy, which is not installed")
+    toggle = (style.get("ooc_mode") or {}).get("toggle") if isinstance(style.get("ooc_mode"), dict) else None
+    if toggle is not None and not isinstance(toggle, str):
+        errors.append("ooc_mode.toggle must be a string")
+    if not errors:
+        for is_ooc in (False, True):
+            try:
+                _compile_prompt("Character", style, is_ooc)
+            except Exception as e:
+                errors.append(f"{'OOC' if is_ooc else 'IC'} prompt does not compile ({type(e).__name__}: {e})")
+    return errors
+
+def compile_persona(kb_path: str, style_path: str, *, write: bool = True) -> Dict[str, Any]:
+    """
+    Validate a KB/style pair and, when the KB has no errors, write its compiled
+    artifact (kbpack.artifact_path). Every rejected KB row and style problem is
+    reported under "errors" as "<file>: <problem>".
+    """
+    kb_name, style_name = os.path.basename(kb_path), os.path.basename(style_path)
+    entries, kb_errors = kbpack.read_kb(kb_path)
+    errors = [f"{kb_name} {e}" for e in kb_errors] + [f"{style_name}: {e}" for e in validate_style(style_path)]
+    style = _load_style(style_path)
+    index = RetrievalIndex(entries, style)
+    report: Dict[str, Any] = {"kb": kb_path, "entries": len(entries), "tokens": len(index.postings),
+                              "postings": sum(len(p) for p in index.postings.values()),
+                              "errors": errors, "artifact": None, "bytes": 0}
+    if write and not kb_errors:
+        out = kbpack.artifact_path(kb_path)
+        report["bytes"] = kbpack.write_artifact(out, kb_path, entries, index.postings, _ranking(style)[:3])
+        report["artifact"] = out
+    return report
 
 # ---------- optional high-level wrapper ----------
 
 class CharacterBot:
     def __init__(self, *, kb_path: Optional[str] = None, style_path: Optional[str] = None,
-                 model: str = "gpt-4o-mini", temperature: float = 0.3, use_openai: bool = True):
+                 model: str = "gpt-4o-mini", temperature: float = 0.3, use_openai: bool = True,
+                 top_k: Optional[int] = None, kb_token_budget: Optional[int] = None, client: Any = None):
+        self.top_k, self.kb_token_budget = top_k, kb_token_budget
         self.kb_path = kb_path or os.path.join(_THIS_DIR, "bronns_kb.jsonl")
         self.style_path = style_path or os.path.join(_THIS_DIR, "bronns_style.yml")
-        self.kb = _load_kb(self.kb_path); self.style = _load_style(self.style_path)
         self.model = os.getenv("OPENAI_CHAT_MODEL", model)
         self.temperature = float(os.getenv("OPENAI_TEMPERATURE", str(temperature)))
         self.use_openai = use_openai
-        self._client = None
+        # pass a shared client (e.g. the backend's get_llm_client().client) to reuse its connection pool
+        self._client = client
         self.fallbacks = self.style.get("fallbacks", [
             "Gold first. Talk later.", "Not worth my neck.", "Find another sellsword.", "I’ve nothing to say."
         ])
 
+    @property
+    def assets(self) -> PersonaAssets:
+        return get_persona_assets(self.kb_path, self.style_path)
+
+    @property
+    def kb(self) -> List[Dict[str, Any]]:
+        return self.assets.kb
+
+    @property
+    def style(self) -> Dict[str, Any]:
+        return self.assets.style
+
     @property
     def client(self):
         if self._client is None:
@@ -228,6 +610,11 @@ class CharacterBot:
             self._client = OpenAI()
         return self._client
 
+    def retrieve(self, user_input: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        rconf = self.style.get("retrieval") or {}
+        if k is None: k = self.top_k if self.top_k is not None else int(rconf.get("top_k", DEFAULT_TOP_K))
+        return self.assets.retriever.top_k(user_input, k, int(rconf.get("min_score", 1)))
+
     def _is_ooc(self, text: str) -> Tuple[bool, str]:
         toggle = ((self.style.get("ooc_mode") or {}).get("toggle", "[[OOC]]"))
         t = text.strip()
@@ -235,7 +622,8 @@ class CharacterBot:
 
     def build_messages(self, character: str, user_input: str, history: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
         _ooc, cleaned = self._is_ooc(user_input)
-        sys = build_system_prompt(character, cleaned, kb_path=self.kb_path, style_path=self.style_path)
+        sys = build_system_prompt(character, cleaned, kb_path=self.kb_path, style_path=self.style_path,
+                                  k=self.top_k, kb_token_budget=self.kb_token_budget)
         msgs: List[Dict[str, str]] = [{"role": "system", "content": sys}]
         if history: msgs.extend(history)
         msgs.append({"role": "user", "content": cleaned})
@@ -243,7 +631,7 @@ class CharacterBot:
 
     def respond(self, character: str, user_input: str, history: Optional[List[Dict[str, str]]] = None) -> str:
         if not self.use_openai:
-            hit = _retrieve_top(user_input, self.kb, self.style)
+            hit = self.assets.retriever.top(user_input)
             if hit: return hit.get("ic_reply") or hit.get("summary") or random.choice(self.fallbacks)
             return random.choice(self.fallbacks)
         msgs = self.build_messages(character, user_input, history)
@@ -255,7 +643,7 @@ class CharacterBot:
 
     def stream(self, character: str, user_input: str, history: Optional[List[Dict[str, str]]] = None) -> Generator[str, None, None]:
         if not self.use_openai:
-            hit = _retrieve_top(user_input, self.kb, self.style)
+            hit = self.assets.retriever.top(user_input)
             yield (hit.get("ic_reply") or hit.get("summary") or random.choice(self.fallbacks)) if hit else random.choice(self.fallbacks); return
         msgs = self.build_messages(character, user_input, history)
         try:
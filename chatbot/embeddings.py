@@ -0,0 +1,163 @@
+"""
+embeddings.py
+Optional semantic retrieval over persona KBs.
+
+Each KB entry's summary, tags and aliases are embedded once into a float32
+matrix (rows L2-normalised) saved as `<name>_kb.vec.npy` in the persona cache
+directory (see artifacts.py), with a small `<name>_kb.vec.json` recording the
+embedder and a digest of the embedded texts. Later loads memory-map the matrix instead of re-embedding; a changed KB
+or embedder rebuilds it. A query is embedded and scored against every row with
+one matrix-vector product (cosine), optionally fused with the lexical score.
+
+Embedders are pluggable: anything with `name`, `dim` and
+`embed(texts) -> float32 array (len(texts), dim)`. The default HashingEmbedder
+hashes words and character n-grams into a fixed number of buckets, so it runs
+offline with no model download, network or GPU; it catches inflections and
+shared word pieces ("knighted" ~ "knighthood"), not true synonyms. Plug in a
+real sentence-embedding model via `retrieval.embedder` (dotted path) for those.
+
+NumPy is optional: without it, semantic/hybrid modes fall back to lexical.
+"""
+
+from __future__ import annotations
+import hashlib, importlib, json, logging, os, re, zlib
+from typing import Any, Dict, List, Optional, Protocol, Sequence, Tuple
+from . import artifacts
+
+try:
+    import numpy as np  # optional; semantic retrieval is disabled without it
+except Exception:
+    np = None
+
+log = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"[A-Za-z0-9']+")
+# function words share n-grams with everything and only add noise to the cosine
+_STOPWORDS = frozenset("""
+a an and are as at be but by did do does for from had has have he her him his how i in is it its me my of on or
+our she so that the their them they this to was we were what when where which who why with you your
+""".split())
+
+class Embedder(Protocol):
+    name: str  # identifies model + parameters; stored with the matrix so a change triggers a rebuild
+    dim: int
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray": ...
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of lowercase words plus their character n-grams
+    (word padded as "<word>"), L2-normalised; common function words are skipped.
+    Deterministic across processes (crc32, not hash()), so saved matrices stay valid.
+    """
+
+    def __init__(self, dim: int = 512, ngrams: Tuple[int, int] = (3, 4), word_weight: float = 2.0):
+        self.dim = int(dim)
+        self.ngrams = (int(ngrams[0]), int(ngrams[1]))
+        self.word_weight = float(word_weight)
+        self._cache: Dict[str, Dict[int, float]] = {}  # word -> hashed features; KB words repeat a lot
+        self.name = f"hashing-v2:dim={self.dim}:ngrams={self.ngrams[0]}-{self.ngrams[1]}:w={self.word_weight}"
+
+    def _word(self, word: str) -> Dict[int, float]:
+        feats = self._cache.get(word)
+        if feats is None:
+            feats = {}
+            padded = f"<{word}>"
+            grams = [(f"w:{word}", self.word_weight)]
+            for n in range(self.ngrams[0], self.ngrams[1] + 1):
+                grams.extend((padded[i:i + n], 1.0) for i in range(len(padded) - n + 1))
+            for gram, w in grams:
+                h = zlib.crc32(gram.encode("utf-8"))
+                idx = h % self.dim
+                feats[idx] = feats.get(idx, 0.0) + (w if h & 0x80000000 else -w)
+            if len(self._cache) >= 100_000: self._cache.clear()
+            self._cache[word] = feats
+        return feats
+
+    def _features(self, text: str) -> Dict[int, float]:
+        feats: Dict[int, float] = {}
+        for word in _WORD_RE.findall((text or "").lower().replace("_", " ")):
+            if word in _STOPWORDS:
+                continue
+            for idx, v in self._word(word).items():
+                feats[idx] = feats.get(idx, 0.0) + v
+        return feats
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            feats = self._features(text)
+            if feats:
+                out[row, list(feats)] = list(feats.values())
+        return _normalize(out)
+
+def _normalize(m: "np.ndarray") -> "np.ndarray":
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (m / norms).astype(np.float32, copy=False)
+
+_EMBEDDERS: Dict[str, Embedder] = {}
+
+def get_embedder(spec: Optional[str] = None) -> Embedder:
+    """
+    `spec` is "hashing" (default) or a dotted path to an Embedder class/factory,
+    e.g. "myproject.embed.MiniLM". Instances are shared per spec.
+    """
+    spec = (spec or os.getenv("PERSONA_EMBEDDER") or "hashing").strip()
+    emb = _EMBEDDERS.get(spec)
+    if emb is None:
+        if spec == "hashing":
+            emb = HashingEmbedder()
+        else:
+            module, _, attr = spec.rpartition(".")
+            emb = getattr(importlib.import_module(module), attr)()
+        _EMBEDDERS[spec] = emb
+    return emb
+
+def entry_text(e: Dict[str, Any]) -> str:
+    """What gets embedded for a KB entry: summary + tags + aliases."""
+    tags = " ".join(t.replace("_", " ") for t in e.get("tags", []))
+    return " ".join(p for p in (e.get("summary", ""), tags, " ".join(e.get("aliases", []))) if p)
+
+def vector_paths(kb_path: str) -> Tuple[str, str]:
+    return artifacts.artifact_path(kb_path, ".vec.npy"), artifacts.artifact_path(kb_path, ".vec.json")
+
+class VectorIndex:
+    """Row i is the unit embedding of KB entry i; `similarities(q)` is cosine against every row."""
+    __slots__ = ("embedder", "matrix")
+
+    def __init__(self, embedder: Embedder, matrix: "np.ndarray"):
+        self.embedder, self.matrix = embedder, matrix
+
+    @classmethod
+    def load_or_build(cls, kb: List[Dict[str, Any]], kb_path: Optional[str], embedder: Embedder) -> "VectorIndex":
+        texts = [entry_text(e) for e in kb]
+        digest = hashlib.sha256("\x1e".join(texts).encode("utf-8")).hexdigest()
+        meta = {"embedder": embedder.name, "dim": embedder.dim, "rows": len(texts), "digest": digest}
+        npy, meta_path = vector_paths(kb_path) if kb_path else (None, None)
+        if npy and os.path.exists(npy) and os.path.exists(meta_path):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    if json.load(f) == meta:
+                        return cls(embedder, np.load(npy, mmap_mode="r"))
+            except Exception as e:
+                log.warning("Ignoring unreadable vector index %s (%s); rebuilding.", npy, e)
+        matrix = embedder.embed(texts) if texts else np.zeros((0, embedder.dim), dtype=np.float32)
+        if npy:
+            try:
+                os.makedirs(os.path.dirname(npy), exist_ok=True)
+                # write then rename so a concurrent reader never maps a half-written file
+                tmp = f"{npy}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    np.save(f, matrix)
+                os.replace(tmp, npy)
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump(meta, f)
+                matrix = np.load(npy, mmap_mode="r")
+            except OSError as e:  # read-only cache: keep it in memory
+                log.warning("Could not save vector index for %s to %s (%s); using it in memory.", kb_path, npy, e)
+        return cls(embedder, matrix)
+
+    def similarities(self, query: str) -> "np.ndarray":
+        q = self.embedder.embed([query])[0]
+        return self.matrix @ q
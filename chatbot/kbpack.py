@@ -0,0 +1,304 @@
+"""
+kbpack.py
+Compiled persona KB artifacts (`<name>_kb.pkb`), written by `manage.py compile_personas`
+to the persona cache directory (see artifacts.py), not next to the KB.
+
+The artifact holds the validated, normalised KB entries and the lexical
+retrieval index (token -> postings) in flat arrays, so loading is an mmap plus a
+small JSON header instead of parsing every JSONL line and rebuilding the index:
+
+    b"PKB\\0" | u16 version | u16 reserved | u32 header length | header JSON | sections (8-byte aligned)
+
+Sections (offsets relative to the first section and lengths in the header,
+native byte order recorded there):
+    entry_offsets  u64[n+1]  slices of entry_blob
+    entry_blob     one compact JSON array per entry, fields in ENTRY_FIELDS order
+    entry_weight   i32[n]    tie-breaker inputs, so ranking never decodes an entry
+    entry_dual     u8[n]     1 when canon has both book and show
+    token_offsets  u32[V+1]  slices of token_blob; tokens sorted, looked up by bisection
+    token_blob     UTF-8 tokens
+    post_offsets   u32[V+1]  slices of post_pos / post_weight per token
+    post_pos       u32[P]    entry position
+    post_weight    u32[P]    weighted hits
+
+Entries decode lazily, one KBEntry (__slots__, dict-style access) at a time, so
+only retrieved hits are ever materialised. The header records the source KB's
+size and sha256 and the ranking weights the postings were built with; a stale
+or mismatched artifact is ignored and the JSONL is loaded instead.
+"""
+
+from __future__ import annotations
+import bisect, hashlib, json, logging, mmap, os, struct, sys
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from . import artifacts
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"PKB\0"
+FORMAT_VERSION = 1
+_HEAD = struct.Struct("<4sHHI")
+ENTRY_FIELDS = ("id", "tags", "aliases", "summary", "ic_reply", "era", "canon", "ooc_notes", "weight", "source", "entities")
+
+def artifact_path(kb_path: str) -> str:
+    return artifacts.artifact_path(kb_path, ".pkb")
+
+# ---------- entries ----------
+
+def normalize_entry(row: Dict[str, Any]) -> Dict[str, Any]:
+    """The shape every KB consumer sees (tags/aliases lowercased, defaults filled)."""
+    return {
+        "id": row.get("id"),
+        "tags": [str(t).lower() for t in row.get("tags", [])],
+        "aliases": [str(a).lower() for a in row.get("aliases", [])],
+        "summary": str(row.get("summary", "")).strip(),
+        "ic_reply": str(row.get("ic_reply", "")).strip(),
+        "era": str(row.get("era", "")),
+        "canon": list(row.get("canon", [])),
+        "ooc_notes": str(row.get("ooc_notes", "")),
+        "weight": int(row.get("weight", 0)),
+        "source": row.get("source", {}),
+        "entities": list(row.get("entities", [])),
+    }
+
+class KBEntry:
+    """A decoded KB entry; reads like the dicts `_load_kb` returns (e["summary"], e.get("canon", []))."""
+    __slots__ = ENTRY_FIELDS
+
+    def __init__(self, *values: Any):
+        for name, value in zip(ENTRY_FIELDS, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default) if key in ENTRY_FIELDS else default
+
+    def __contains__(self, key: object) -> bool:
+        return key in ENTRY_FIELDS
+
+    def keys(self) -> Tuple[str, ...]:
+        return ENTRY_FIELDS
+
+    def __repr__(self) -> str:
+        return f"KBEntry(id={self.id!r})"
+
+def _check_str_list(row: Dict[str, Any], key: str, errors: List[str]) -> None:
+    v = row.get(key, [])
+    if not isinstance(v, list) or not all(isinstance(x, str) for x in v):
+        errors.append(f"{key!r} must be a list of strings")
+
+def validate_row(row: Any) -> List[str]:
+    if not isinstance(row, dict):
+        return ["row is not a JSON object"]
+    errors: List[str] = []
+    if not isinstance(row.get("id"), str) or not row["id"].strip():
+        errors.append("missing or empty 'id'")
+    if not isinstance(row.get("summary"), str) or not row["summary"].strip():
+        errors.append("missing or empty 'summary'")
+    for key in ("tags", "aliases", "canon", "entities"):
+        _check_str_list(row, key, errors)
+    for key in ("ic_reply", "era", "ooc_notes"):
+        if not isinstance(row.get(key, ""), str):
+            errors.append(f"{key!r} must be a string")
+    if isinstance(row.get("weight", 0), bool) or not isinstance(row.get("weight", 0), int):
+        errors.append("'weight' must be an integer")
+    if not isinstance(row.get("source", {}), dict):
+        errors.append("'source' must be an object")
+    return errors
+
+def read_kb(path: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Normalised entries plus "line N: problem" messages for every row that was rejected."""
+    entries: List[Dict[str, Any]] = []
+    errors: List[str] = []
+    seen: Dict[str, int] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line: continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                errors.append(f"line {lineno}: invalid JSON ({e})")
+                continue
+            problems = validate_row(row)
+            rid = row.get("id") if isinstance(row, dict) else None
+            if isinstance(rid, str) and rid in seen:
+                problems.append(f"duplicate id {rid!r} (first on line {seen[rid]})")
+            if problems:
+                errors.extend(f"line {lineno}: {p}" for p in problems)
+                continue
+            seen[rid] = lineno
+            entries.append(normalize_entry(row))
+    return entries, errors
+
+# ---------- writing ----------
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def write_artifact(out_path: str, kb_path: str, entries: Sequence[Dict[str, Any]],
+                   postings: Dict[str, List[Tuple[int, int]]], ranking: Sequence[int]) -> int:
+    """Write atomically (temp file + rename); returns the artifact size in bytes."""
+    blobs = [json.dumps([e[k] for k in ENTRY_FIELDS], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+             for e in entries]
+    entry_offsets = array("Q", [0])
+    for b in blobs: entry_offsets.append(entry_offsets[-1] + len(b))
+    tokens = sorted(postings)
+    token_bytes = [t.encode("utf-8") for t in tokens]
+    token_offsets, post_offsets = array("I", [0]), array("I", [0])
+    post_pos, post_weight = array("I"), array("I")
+    for tb, tok in zip(token_bytes, tokens):
+        token_offsets.append(token_offsets[-1] + len(tb))
+        for pos, w in postings[tok]:
+            post_pos.append(pos); post_weight.append(w)
+        post_offsets.append(len(post_pos))
+    sections = [
+        ("entry_offsets", entry_offsets.tobytes()),
+        ("entry_blob", b"".join(blobs)),
+        ("entry_weight", array("i", [int(e["weight"]) for e in entries]).tobytes()),
+        ("entry_dual", bytes(int("book" in e["canon"] and "show" in e["canon"]) for e in entries)),
+        ("token_offsets", token_offsets.tobytes()),
+        ("token_blob", b"".join(token_bytes)),
+        ("post_offsets", post_offsets.tobytes()),
+        ("post_pos", post_pos.tobytes()),
+        ("post_weight", post_weight.tobytes()),
+    ]
+    header: Dict[str, Any] = {
+        "entries": len(entries), "tokens": len(tokens), "postings": len(post_pos),
+        "byteorder": sys.byteorder, "ranking": list(ranking),
+        "source": {"size": os.path.getsize(kb_path), "sha256": _sha256(kb_path)},
+    }
+    offset, layout = 0, {}
+    for name, data in sections:
+        layout[name] = [offset, len(data)]
+        offset = _align(offset + len(data))
+    header["sections"] = layout
+    raw = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, FORMAT_VERSION, 0, len(raw)) + raw)
+        base = _align(f.tell())
+        for name, data in sections:
+            f.write(b"\0" * (base + layout[name][0] - f.tell()))
+            f.write(data)
+    os.replace(tmp, out_path)
+    return os.path.getsize(out_path)
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+# ---------- reading ----------
+
+class _Tokens:
+    """Sorted token table as a lazy sequence, so bisect can search it without building a dict."""
+    __slots__ = ("offsets", "blob")
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self.offsets, self.blob = offsets, blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+class PackedEntries(Sequence):
+    """Entries decoded on access; the list-like `kb` of a compiled PersonaAssets."""
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self._offsets, self._blob = offsets, blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        return KBEntry(*json.loads(bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])))
+
+    def __iter__(self) -> Iterator[KBEntry]:
+        return (self[i] for i in range(len(self)))
+
+class PackedKB:
+    """A memory-mapped artifact. Raises ValueError for foreign, truncated or other-version files."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _reserved, header_len = _HEAD.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("not a compiled persona KB")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"format version {version}, this build reads {FORMAT_VERSION}")
+        self.header: Dict[str, Any] = json.loads(self._mm[_HEAD.size:_HEAD.size + header_len])
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"compiled on a {self.header['byteorder']}-endian machine")
+        view = memoryview(self._mm)
+        base = _align(_HEAD.size + header_len)
+        for name, (off, length) in self.header["sections"].items():
+            if base + off + length > len(view):
+                raise ValueError(f"truncated (section {name})")
+
+        def section(name: str, fmt: Optional[str] = None) -> memoryview:
+            off, length = self.header["sections"][name]
+            sec = view[base + off:base + off + length]
+            return sec.cast(fmt) if fmt else sec
+
+        self.entries = PackedEntries(section("entry_offsets", "Q"), section("entry_blob"))
+        self.weight = section("entry_weight", "i")
+        self.dual = section("entry_dual", "B")
+        self._tokens = _Tokens(section("token_offsets", "I"), section("token_blob"))
+        self._post_offsets = section("post_offsets", "I")
+        self._post_pos = section("post_pos", "I")
+        self._post_weight = section("post_weight", "I")
+
+    def postings(self, token: str) -> Iterable[Tuple[int, int]]:
+        i = bisect.bisect_left(self._tokens, token)
+        if i == len(self._tokens) or self._tokens[i] != token:
+            return ()
+        a, b = self._post_offsets[i], self._post_offsets[i + 1]
+        return zip(self._post_pos[a:b], self._post_weight[a:b])
+
+    def stale_reason(self, kb_path: str, ranking: Sequence[int]) -> Optional[str]:
+        if list(ranking) != self.header["ranking"]:
+            return "style ranking weights changed"
+        try:
+            st = os.stat(kb_path)
+        except OSError:
+            return None  # compiled artifact without its source (e.g. a slim deploy) is fine
+        src = self.header["source"]
+        if st.st_size != src["size"]:
+            return "KB changed since it was compiled"
+        # same size but touched after compiling (edit or fresh checkout): compare content
+        if st.st_mtime > os.path.getmtime(self.path) and _sha256(kb_path) != src["sha256"]:
+            return "KB changed since it was compiled"
+        return None
+
+def open_fresh(kb_path: str, ranking: Sequence[int]) -> Optional[PackedKB]:
+    """The compiled artifact for `kb_path` if there is a usable, up-to-date one; otherwise None (caller reads JSONL)."""
+    path = artifact_path(kb_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        packed = PackedKB(path)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        log.warning("Ignoring %s (%s); loading %s instead.", path, e, kb_path)
+        return None
+    reason = packed.stale_reason(kb_path, ranking)
+    if reason:
+        log.warning("Ignoring %s (%s; run manage.py compile_personas); loading %s instead.", path, reason, kb_path)
+        return None
+    return packed
@@ -137,13 +137,16 @@ export async function streamReply(
     method: "POST",
     headers: { "Content-Type": "application/json" },
     credentials: "include",
-    body: JSON.stringify({ conversation_id: conversationId, prompt, create_user_message: false }),
+    // compact: token frames arrive as unnamed events whose data is the delta as a JSON string
+    body: JSON.stringify({ conversation_id: conversationId, prompt, create_user_message: false, stream_format: "compact" }),
   });
   if (!res.ok || !res.body) throw new Error("Failed to open stream");
 
-  const reader = res.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  let buf = "";
+  // Token frames carry `id:` (characters received so far). If the connection drops before `end`,
+  // resume from the last id instead of re-posting, which would pay for a second generation.
+  let messageId = "";
+  let lastId = "0";
+  let ended = false;
 
   const flush = (block: string) => {
     const events = block.split("\n\n").filter(Boolean);
@@ -151,31 +154,58 @@ export async function streamReply(
       const lines = raw.split("\n");
       let event = "message";
       let data = "";
+      let id = "";
       for (const ln of lines) {
         if (ln.startsWith("event:")) event = ln.slice(6).trim();
         if (ln.startsWith("data:")) data += ln.slice(5).trim();
+        if (ln.startsWith("id:")) id = ln.slice(3).trim();
       }
       if (!data) continue;
       try {
         const j = JSON.parse(data);
-        if (event === "start" && j.message_id) onStart?.(j.message_id);
+        if (event === "start" && j.message_id && !messageId) {
+          messageId = String(j.message_id);
+          onStart?.(messageId);
+        }
+        if (event === "message" && typeof j === "string") onChunk(j);
         if (event === "token" && typeof j.delta === "string") onChunk(j.delta);
-        if (event === "end") onEnd?.();
+        if (event === "end") {
+          ended = true;
+          onEnd?.();
+        }
       } catch {
         if (event === "token") onChunk(data);
       }
+      if (id) lastId = id;
     }
   };
 
-  for (;;) {
-    const { value, done } = await reader.read();
-    if (done) break;
-    buf += decoder.decode(value, { stream: true });
-    const parts = buf.split("\n\n");
-    buf = parts.pop() || "";
-    for (const p of parts) flush(p);
+  const pump = async (body: ReadableStream<Uint8Array>) => {
+    const reader = body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    let buf = "";
+    try {
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buf += decoder.decode(value, { stream: true });
+        const parts = buf.split("\n\n");
+        buf = parts.pop() || "";
+        for (const p of parts) flush(p);
+      }
+    } catch {
+      return; // dropped mid-event: the partial block is replayed on resume
+    }
+    if (buf) flush(buf);
+  };
+
+  await pump(res.body);
+  for (let attempt = 0; !ended && messageId && attempt < 3; attempt++) {
+    await new Promise((r) => setTimeout(r, 500 * attempt));
+    const q = new URLSearchParams({ last_event_id: lastId, stream_format: "compact" });
+    const resumed = await fetch(`/api/dj/chat/${messageId}/stream?${q}`, { credentials: "include" }).catch(() => null);
+    if (resumed?.ok && resumed.body) await pump(resumed.body);
   }
-  if (buf) flush(buf);
 }
 
 // list existing messages for a conversation (adjust the shape if your API differs)